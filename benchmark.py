@@ -0,0 +1,436 @@
+'''Benchmarks of the engine hot paths and of whole frames, run with the SDL dummy drivers.
+
+    python benchmark.py                          # run every benchmark
+    python benchmark.py -k frame                 # only the ones with "frame" in their name
+    python benchmark.py --save baseline.json     # keep the results
+    python benchmark.py --compare baseline.json  # flag the benchmarks slower than the baseline
+'''
+from typing import Callable, Dict, List
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import numpy as np
+import pygame
+
+import data.engine as e
+from data.audio import AudioManager
+from data.navigation import NavGraph
+from data.netplay import NET_POSITION_SCALE, NPC_NET_FIELDS
+from data.network import SnapshotChannel, SnapshotReceiver
+import main
+
+
+# name -> function(): returns the function to time
+micro_benchmarks:Dict[str,Callable] = {}
+# name -> function(): returns the function drawing one frame
+frame_scenarios:Dict[str,Callable] = {}
+open_worlds:List[main.World] = [] # worlds made by the running scenario, see make_game
+
+
+def benchmark(name:str):
+    def register(setup):
+        micro_benchmarks[name] = setup
+        return setup
+    return register
+
+
+def scenario(name:str):
+    def register(setup):
+        frame_scenarios[name] = setup
+        return setup
+    return register
+
+
+def measure(function:Callable, min_time:float, repeat:int)->float:
+    '''return: best number of calls per second over `repeat` runs of at least `min_time` seconds'''
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        duration = time.perf_counter() - start
+        if duration >= min_time / 10:
+            break
+        number *= 10
+    number = max(1, int(number * min_time / duration))
+    best = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        best = max(best, number / (time.perf_counter() - start))
+    return best
+
+
+def measure_frames(frame:Callable, frames:int, warmup:int)->Dict[str,float]:
+    '''return: frame time distribution (in ms) of `frames` calls to `frame`'''
+    for _ in range(warmup):
+        frame()
+    times = []
+    for _ in range(frames):
+        start = time.perf_counter()
+        frame()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    def percentile(p):
+        return times[min(len(times)-1, int(len(times)*p))] * 1000
+    return {'fps': len(times) / sum(times),
+            'p50_ms': percentile(0.5),
+            'p90_ms': percentile(0.9),
+            'p99_ms': percentile(0.99),
+            'max_ms': times[-1] * 1000}
+
+
+# engine hot paths
+@benchmark('generate_chunk')
+def bench_generate_chunk():
+    positions = iter(range(10**9))
+    return lambda: main.generate_chunk(next(positions), 1)
+
+
+@benchmark('get_draw_rect')
+def bench_get_draw_rect():
+    player = e.Entity(0,100,5,13,'player')
+    scroll = e.Vector(-150, -6)
+    rect = pygame.Rect(10, 66, 40, 100)
+    return lambda: main.get_draw_rect(rect, 0.5, player, scroll)
+
+
+@benchmark('colliderects')
+def bench_colliderects():
+    rects = [pygame.Rect(x*16, 160, 16, 16) for x in range(2000)]
+    rect = pygame.Rect(800, 150, 5, 13)
+    return lambda: e.colliderects(rect, rects)
+
+
+def walking_entity(platforms, collect_data=True):
+    entity = e.Entity(0,100,5,13,'player')
+    movement = e.Vector(2, 3)
+    def move():
+        if entity.x > 1000:
+            entity.set_pos(0, 100)
+        entity.move(movement, platforms, collect_data=collect_data)
+    return move
+
+
+@benchmark('Physics_obj.move list')
+def bench_move_list():
+    return walking_entity([pygame.Rect(x*16, 160, 16, 16) for x in range(2000)])
+
+
+@benchmark('Physics_obj.move spatial hash')
+def bench_move_spatial_hash():
+    index = e.SpatialHash(16)
+    for x in range(2000):
+        index.insert(pygame.Rect(x*16, 160, 16, 16))
+    return walking_entity(index)
+
+
+@benchmark('Physics_obj.move without data')
+def bench_move_without_data():
+    index = e.SpatialHash(16)
+    for x in range(2000):
+        index.insert(pygame.Rect(x*16, 160, 16, 16))
+    return walking_entity(index, collect_data=False)
+
+
+def npc_grid(count:int)->e.EntityGrid:
+    rng = random.Random(0)
+    grid = e.EntityGrid(32)
+    for i in range(count):
+        grid.update(i, rng.uniform(0, 2000), rng.uniform(0, 300), 5, 13)
+    return grid
+
+
+@benchmark('EntityGrid.nearest 1000 NPCs')
+def bench_grid_nearest():
+    grid = npc_grid(1000)
+    return lambda: grid.nearest(1000, 150, 4)
+
+
+@benchmark('EntityGrid.pairs 1000 NPCs')
+def bench_grid_pairs():
+    grid = npc_grid(1000)
+    return grid.pairs
+
+
+def navigation_graph()->NavGraph:
+    graph = NavGraph(main.CHUNK_SIZE, 16, main.NPC_SIZE, main.NPC_SPEED, main.JUMP_SPEED,
+                     main.GRAVITY, main.MAX_FALL_SPEED)
+    for chunk_y in range(-1, 3):
+        for chunk_x in range(-1, 8):
+            chunk = main.generate_chunk(chunk_x, chunk_y)
+            graph.add_chunk((chunk_x, chunk_y), np.isin(chunk.tiles, main.SOLID_TILES))
+    graph.update()
+    return graph
+
+
+@benchmark('NavGraph.build_chunk')
+def bench_nav_build():
+    graph = navigation_graph()
+    return lambda: graph.build_chunk((0, 1))
+
+
+@benchmark('NavGraph.find_path 50 tiles')
+def bench_nav_find_path():
+    graph = navigation_graph()
+    return lambda: graph.find_path((0, 9), (50, 9))
+
+
+@benchmark('AudioManager 1000 sound sources')
+def bench_audio():
+    audio = AudioManager()
+    audio.add_banks(main.assets.sounds, main.assets.manifest['sounds'])
+    rng = random.Random(0)
+    sources = [(rng.uniform(-1000, 1000), rng.uniform(-200, 200)) for _ in range(1000)]
+    def play():
+        for x, y in sources:
+            audio.play('jump', x, y)
+        audio.flush()
+    return play
+
+
+def npc_snapshots(count:int, ticks:int)->List:
+    '''return: (tick, ids, values) of `count` NPCs walking for `ticks` ticks, as sent by NetServer'''
+    rng = np.random.default_rng(0)
+    ids = np.arange(count, dtype=np.int64)
+    values = np.zeros((count, NPC_NET_FIELDS), dtype=np.int32)
+    values[:, :2] = rng.uniform(0, 2000 * NET_POSITION_SCALE, (count, 2))
+    speed = rng.integers(-1, 2, count) * NET_POSITION_SCALE
+    snapshots = []
+    for tick in range(ticks):
+        values = values.copy()
+        values[:, 0] += speed
+        values[:, 3] = (values[:, 3] + 1) % 8
+        snapshots.append((tick, ids, values))
+    return snapshots
+
+
+@benchmark('SnapshotChannel.encode 1000 NPCs')
+def bench_snapshot_encode():
+    snapshots = npc_snapshots(1000, 16)
+    channel = SnapshotChannel(NPC_NET_FIELDS)
+    for tick, ids, values in snapshots[:8]:
+        channel.encode(tick, ids, values, {})
+    channel.ack(0)
+    tick, ids, values = snapshots[8]
+    return lambda: channel.encode(tick, ids, values, {}) # 8 ticks after the baseline
+
+
+@benchmark('SnapshotReceiver.decode 1000 NPCs')
+def bench_snapshot_decode():
+    snapshots = npc_snapshots(1000, 16)
+    channel = SnapshotChannel(NPC_NET_FIELDS)
+    receiver = SnapshotReceiver()
+    receiver.decode(channel.encode(*snapshots[0], {}))
+    channel.ack(0)
+    message = channel.encode(*snapshots[8], {})
+    def decode():
+        receiver.acked = 0
+        receiver.decode(message)
+    return decode
+
+
+@benchmark('Entity animation tick')
+def bench_entity_animation():
+    entity = e.Entity(0, 0, 5, 13, 'player')
+    entity.set_action('idle')
+    def tick():
+        entity.change_frame(1)
+        entity.get_frame()
+    return tick
+
+
+@benchmark('EntityManager.change_frame 1000 NPCs')
+def bench_manager_animation():
+    manager = e.EntityManager()
+    for i in range(1000):
+        manager.add(i, 0, 5, 13, 'player', 'run' if i % 2 else 'idle')
+    return manager.change_frame
+
+
+@benchmark('Entity.display')
+def bench_entity_display():
+    surface = pygame.Surface(main.DISPLAY_SIZE)
+    entity = e.Entity(50,50,5,13,'player')
+    entity.set_flip(True)
+    scroll = e.Vector(0, 0)
+    def display():
+        entity.change_frame(1)
+        entity.display(surface, scroll)
+    return display
+
+
+@benchmark('swap_color')
+def bench_swap_color():
+    image = e.animation_database['data/images/entities/player/idle/idle_0']
+    return lambda: e.swap_color(image, (255,255,255), (200,30,30))
+
+
+# whole frames
+def make_game()->main.Game:
+    '''return: a Game on a new World, closed once its scenario is timed'''
+    random.seed(0)
+    world = main.World()
+    open_worlds.append(world)
+    return main.Game(world, pygame.display.get_surface())
+
+
+def frame_function(game:main.Game, inputs:main.Inputs, extra:Callable=None)->Callable:
+    def frame():
+        game.world.step(inputs)
+        game.render()
+        if extra is not None:
+            extra()
+    return frame
+
+
+@scenario('frame idle')
+def frame_idle():
+    return frame_function(make_game(), main.Inputs())
+
+
+@scenario('frame running through new chunks')
+def frame_running():
+    game = make_game()
+    game.world.player.set_pos(200, 100)
+    game.world.step(main.Inputs())
+    def frame():
+        # run on the grass at 4 chunks per frame, always reaching terrain never seen before
+        player = game.world.player
+        player.set_pos(player.x + main.CHUNK_SIZE*16*4, player.y)
+        game.world.step(main.Inputs(right=True))
+        game.render()
+    return frame
+
+
+@scenario('frame 500 entities')
+def frame_entities():
+    game = make_game()
+    entities = [e.Entity(random.randint(0, 300), random.randint(0, 150), 5, 13, 'player') for _ in range(500)]
+    for entity in entities:
+        entity.set_action('run')
+        entity.set_flip(random.random() < 0.5)
+    def draw_entities():
+        for entity in entities:
+            entity.change_frame(1)
+            entity.display(game.display, game.world.scroll)
+    return frame_function(game, main.Inputs(), draw_entities)
+
+
+@scenario('frame 1000 NPCs')
+def frame_npcs():
+    game = make_game()
+    game.world.spawn_npcs(1000)
+    return frame_function(game, main.Inputs())
+
+
+@scenario('frame digging the ground')
+def frame_digging():
+    game = make_game()
+    world = game.world
+    dug = []
+    def dig():
+        # destructible terrain: a 3x3 hole dug near the player every frame, the previous one filled back
+        if dug:
+            world.fill_tiles(dug.pop(), main.TileType.DIRT)
+        hole = pygame.Rect(int(world.player.x // 16) + random.randint(-6, 4), 11, 3, 3)
+        world.fill_tiles(hole, main.TileType.NOTHING)
+        dug.append(hole)
+    return frame_function(game, main.Inputs(), dig)
+
+
+@scenario('frame 10000 particles')
+def frame_particles():
+    game = make_game()
+    images = []
+    for size in range(1, 6):
+        image = pygame.Surface((size, size)).convert()
+        image.fill((255,255,255))
+        image.set_colorkey((0,0,0))
+        images.append(image)
+    e.particle_images['benchmark'] = images
+    particles = e.ParticleSystem()
+    def draw_particles():
+        while len(particles) < 10000:
+            particles.add(random.uniform(0, 300), random.uniform(0, 200), 'benchmark',
+                          [random.uniform(-1, 1), random.uniform(-1, 1)], random.uniform(0.02, 0.1),
+                          0, random.choice([None, (255,80,80)]))
+        particles.update()
+        particles.draw(game.display, (0, 0))
+    return frame_function(game, main.Inputs(), draw_particles)
+
+
+def compare(results:Dict, baseline:Dict, threshold:float)->List[str]:
+    '''return: descriptions of the benchmarks slower than the baseline by more than `threshold`'''
+    slower = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        if 'ops_per_sec' in result:
+            ratio = old['ops_per_sec'] / result['ops_per_sec']
+        else:
+            ratio = result['p50_ms'] / old['p50_ms']
+        if ratio > 1 + threshold:
+            slower.append(f'{name}: {ratio:.2f}x slower')
+    return slower
+
+
+def main_benchmark(argv:List[str]=None)->int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', dest='pattern', default='', help='only run benchmarks containing PATTERN')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds per timing run')
+    parser.add_argument('--repeat', type=int, default=3, help='timing runs per micro benchmark')
+    parser.add_argument('--frames', type=int, default=300, help='frames timed per scenario')
+    parser.add_argument('--save', metavar='PATH', help='write the results to a JSON file')
+    parser.add_argument('--compare', metavar='PATH', help='JSON results to compare with')
+    parser.add_argument('--threshold', type=float, default=0.15,
+                        help='relative slowdown reported by --compare (default 0.15)')
+    args = parser.parse_args(argv)
+
+    main.init_pygame(headless=True)
+    main.load_assets()
+    gc.freeze() # as main.main
+
+    results = {}
+    for name, setup in micro_benchmarks.items():
+        if args.pattern in name:
+            ops = measure(setup(), args.min_time, args.repeat)
+            results[name] = {'ops_per_sec': ops}
+            print(f'{name:<36}{ops:>14,.0f} ops/s')
+    for name, setup in frame_scenarios.items():
+        if args.pattern in name:
+            try:
+                stats = measure_frames(setup(), args.frames, warmup=10)
+            finally:
+                # removes their temporary chunk directories
+                while open_worlds:
+                    open_worlds.pop().close()
+            results[name] = stats
+            print(f'{name:<36}{stats["fps"]:>10.1f} fps  p50 {stats["p50_ms"]:.2f}ms  '
+                  f'p90 {stats["p90_ms"]:.2f}ms  p99 {stats["p99_ms"]:.2f}ms  max {stats["max_ms"]:.2f}ms')
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            slower = compare(results, json.load(f), args.threshold)
+        for line in slower:
+            print('SLOWER', line)
+        if slower:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_benchmark())
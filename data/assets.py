@@ -0,0 +1,128 @@
+from typing import Dict, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import hashlib, json, os, struct, time
+import pygame
+
+import data.engine as e
+
+
+# cache file: source mtime (ns), source size, width, height, then the RGB pixels
+CACHE_HEADER = struct.Struct('<qqii')
+
+
+class Assets(object):
+    '''Loads the images and sounds listed in a JSON manifest (see data/assets.json).
+    Files are decoded in parallel on a thread pool. Decoded images are kept in `cache_dir`,
+    keyed by the source modification time and size, so later launches skip decoding.
+    Only the final `convert` is done on the calling thread (it needs the display).
+    * images: name -> converted Surface
+    * sounds: name -> list of Sound
+    * timings: (asset, seconds, 'decoded'|'cached'|'sound') for each file loaded'''
+
+    def __init__(self, manifest:str='data/assets.json', cache_dir:str='.asset_cache', workers:int=4):
+        with open(manifest) as f:
+            self.manifest = json.load(f)
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.images:Dict[str,pygame.Surface] = {}
+        self.sounds:Dict[str,List[pygame.mixer.Sound]] = {}
+        self.music:str = self.manifest.get('music')
+        self.timings:List[Tuple[str,float,str]] = []
+        self.duration = 0
+
+    def cache_path(self, path:str)->str:
+        return os.path.join(self.cache_dir, hashlib.sha1(path.encode()).hexdigest() + '.rgb')
+
+    def decode(self, path:str)->Tuple[bytes,Tuple[int,int],str]:
+        '''return: (RGB pixels, size, source) of an image, from the cache when it is up to date
+        (runs on the worker threads)'''
+        stat = os.stat(path)
+        cache_path = self.cache_path(path) if self.cache_dir else None
+        if cache_path is not None and os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                data = f.read()
+            if len(data) >= CACHE_HEADER.size:
+                mtime, size, width, height = CACHE_HEADER.unpack_from(data)
+                if mtime == stat.st_mtime_ns and size == stat.st_size:
+                    return data[CACHE_HEADER.size:], (width, height), 'cached'
+        image = pygame.image.load(path)
+        pixels = pygame.image.tobytes(image, 'RGB')
+        if cache_path is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temporary_path = cache_path + '.tmp'
+            with open(temporary_path, 'wb') as f:
+                f.write(CACHE_HEADER.pack(stat.st_mtime_ns, stat.st_size, *image.get_size()))
+                f.write(pixels)
+            os.replace(temporary_path, cache_path)
+        return pixels, image.get_size(), 'decoded'
+
+    def load_images(self, executor:ThreadPoolExecutor, paths:List[str])->Dict[str,pygame.Surface]:
+        '''return: converted images by path'''
+        def timed_decode(path):
+            start = time.perf_counter()
+            result = self.decode(path)
+            return result, time.perf_counter() - start
+        images = {}
+        for path, ((pixels, size, source), duration) in zip(paths, executor.map(timed_decode, paths)):
+            start = time.perf_counter()
+            images[path] = pygame.image.frombytes(pixels, size, 'RGB').convert()
+            self.timings.append((path, duration + time.perf_counter() - start, source))
+        return images
+
+    def load_sound(self, path:str)->Tuple[pygame.mixer.Sound,float]:
+        start = time.perf_counter()
+        sound = pygame.mixer.Sound(path)
+        return sound, time.perf_counter() - start
+
+    def load(self, sounds:bool=True)->'Assets':
+        '''Load everything listed in the manifest (after the display is set up).
+        The engine's animations and particle images are loaded too.
+        * sounds: False to skip the sounds (e.g. without audio device)'''
+        start = time.perf_counter()
+        image_entries = self.manifest.get('images', {})
+        animations = self.manifest.get('animations')
+        particles = self.manifest.get('particles')
+        animation_paths = e.animation_image_paths(animations) if animations else []
+        particle_paths = {}
+        if particles and os.path.isdir(particles):
+            particle_paths = e.particle_image_paths(particles)
+        paths = [entry['path'] for entry in image_entries.values()] + animation_paths
+        paths += [path for frames in particle_paths.values() for path in frames]
+        sound_paths = []
+        if sounds:
+            sound_paths = [path for entry in self.manifest.get('sounds', {}).values() for path in entry['paths']]
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            # sounds decode in the background while the images are converted
+            sound_futures = {path: executor.submit(self.load_sound, path) for path in sound_paths}
+            images = self.load_images(executor, list(dict.fromkeys(paths)))
+            loaded_sounds = {}
+            for path, future in sound_futures.items():
+                loaded_sounds[path], duration = future.result()
+                self.timings.append((path, duration, 'sound'))
+
+        for name, entry in image_entries.items():
+            image = images[entry['path']]
+            if 'colorkey' in entry:
+                image.set_colorkey(entry['colorkey'])
+            self.images[name] = image
+        if animations:
+            e.load_animations(animations, images)
+        if particle_paths:
+            e.load_particle_images(particles, images)
+        for name, entry in self.manifest.get('sounds', {}).items():
+            if not sounds:
+                continue
+            self.sounds[name] = [loaded_sounds[path] for path in entry['paths']]
+            if 'volume' in entry:
+                for sound in self.sounds[name]:
+                    sound.set_volume(entry['volume'])
+        self.duration = time.perf_counter() - start
+        return self
+
+    def report(self)->str:
+        '''return: load time of each asset, slowest first'''
+        lines = [f'{len(self.timings)} assets loaded in {self.duration*1000:.1f}ms']
+        for path, duration, source in sorted(self.timings, key=lambda timing: -timing[1]):
+            lines.append(f'{duration*1000:8.2f}ms  {source:<8} {path}')
+        return '\n'.join(lines)
@@ -0,0 +1,111 @@
+from typing import Any, Dict, List, Tuple
+import math, random, time
+import pygame
+
+
+class SoundGroup(object):
+    '''Variants of one sound (e.g. footsteps) sharing their limits.
+    * max_voices: copies playing at once at most
+    * cooldown: seconds after a play during which the group stays silent
+    * max_distance: pixels from the listener past which the sound is not heard,
+      the volume decreases linearly up to there. None: heard everywhere at full volume'''
+
+    def __init__(self, name:str, sounds:List[pygame.mixer.Sound], max_voices:int=4, cooldown:float=0,
+                 max_distance:float=None):
+        self.name = name
+        self.sounds = sounds
+        self.max_voices = max_voices
+        self.cooldown = cooldown
+        self.max_distance = max_distance
+        self.queue:List[Tuple[float,float]] = [] # (distance, horizontal offset) of the nearest requests
+        self.voices:List[pygame.mixer.Channel] = [] # channels playing the group
+        self.ready = 0 # time when the cooldown ends
+
+
+class AudioManager(object):
+    '''Plays the sounds of the game, a bounded amount whatever the number of sound sources.
+    `play` only queues a request (dropped at once when the group is cooling down, out of
+    range or already has `max_voices` nearer requests). `flush`, once per frame, plays the
+    nearest requests of each group within its voice limit, attenuated and panned by their
+    position relative to the listener (see `set_listener`). Channels in use are never stolen.
+    * pan_width: horizontal distance from the listener at which a sound is fully panned'''
+
+    def __init__(self, pan_width:float=150, seed:int=None):
+        self.pan_width = pan_width
+        self.groups:Dict[str,SoundGroup] = {}
+        self.listener = (0, 0)
+        self.rng = random.Random(seed) # picks the variants, leaves the global generator alone
+        self.now = 0 # time of the last flush
+        self.stats:Dict[str,int] = {'requested': 0, 'played': 0, 'culled': 0, 'limited': 0}
+
+    def add_group(self, name:str, sounds:List[pygame.mixer.Sound], max_voices:int=4, cooldown:float=0,
+                  max_distance:float=None)->SoundGroup:
+        group = self.groups[name] = SoundGroup(name, sounds, max_voices, cooldown, max_distance)
+        return group
+
+    def add_banks(self, sounds:Dict[str,List[pygame.mixer.Sound]], settings:Dict[str,Dict[str,Any]])->None:
+        '''Add a group per loaded sound bank (see Assets.sounds), limited as in `settings`
+        (the "sounds" entries of the asset manifest: "voices", "cooldown", "distance")'''
+        for name, bank in sounds.items():
+            entry = settings.get(name, {})
+            self.add_group(name, bank, entry.get('voices', 4), entry.get('cooldown', 0), entry.get('distance'))
+
+    def set_listener(self, x:float, y:float)->None:
+        self.listener = (x, y)
+
+    def play(self, name:str, x:float=None, y:float=None)->None:
+        '''Ask for a sound of group `name`, made at world position (x, y) (None: at the listener)'''
+        self.stats['requested'] += 1
+        group = self.groups.get(name)
+        if group is None or not group.sounds:
+            return
+        if self.now < group.ready:
+            self.stats['limited'] += 1
+            return
+        offset = distance = 0
+        if x is not None:
+            offset = x - self.listener[0]
+            distance = math.hypot(offset, y - self.listener[1])
+        if group.max_distance is not None and distance > group.max_distance:
+            self.stats['culled'] += 1
+            return
+        queue = group.queue
+        if len(queue) < group.max_voices:
+            queue.append((distance, offset))
+            return
+        self.stats['limited'] += 1
+        farthest = max(range(len(queue)), key=lambda i: queue[i][0])
+        if distance < queue[farthest][0]:
+            queue[farthest] = (distance, offset)
+
+    def flush(self, now:float=None)->int:
+        '''Play the queued requests, see the class description.
+        * now: current time in seconds, time.perf_counter() by default
+        return: number of sounds started'''
+        self.now = now = time.perf_counter() if now is None else now
+        played = 0
+        for group in self.groups.values():
+            if not group.queue:
+                continue
+            sounds = group.sounds
+            voices = [channel for channel in group.voices if channel.get_busy() and channel.get_sound() in sounds]
+            for distance, offset in sorted(group.queue):
+                if len(voices) >= group.max_voices or now < group.ready:
+                    self.stats['limited'] += 1
+                    continue
+                channel = self.rng.choice(sounds).play()
+                if channel is None:
+                    self.stats['limited'] += 1 # no free channel
+                    break
+                volume = 1
+                if group.max_distance:
+                    volume = max(0, 1 - distance / group.max_distance)
+                pan = max(-1, min(1, offset / self.pan_width))
+                channel.set_volume(volume * min(1, 1 - pan), volume * min(1, 1 + pan))
+                voices.append(channel)
+                group.ready = now + group.cooldown
+                played += 1
+            group.queue.clear()
+            group.voices = voices
+        self.stats['played'] += played
+        return played
@@ -0,0 +1,177 @@
+from typing import Any, Callable, Dict, List, Tuple
+import heapq, time
+import numpy as np
+
+import data.engine as e
+
+
+class State(object):
+    '''One state of a StateMachine.
+    * act: function(slots), run on every update with the EntityManager slots (index array)
+      of the entities in this state, meant for cheap vectorized steering
+    * decide: function(entity id), the expensive part (target selection, pathing...)
+      run by the scheduler every `interval` ticks for each entity.
+      return: name of the state to switch to, None to stay'''
+
+    def __init__(self, name:str, act:Callable=None, decide:Callable=None, interval:int=30):
+        self.name = name
+        self.act = act
+        self.decide = decide
+        self.interval = interval
+
+
+class StateMachine(object):
+    '''The states of an entity type, entities start in the first one'''
+
+    def __init__(self, *states:State):
+        self.states = list(states)
+        self.names = {state.name: state for state in states}
+
+
+class Scheduler(object):
+    '''Tasks to run at a given tick. Each tick runs the due tasks, oldest first, until
+    `budget` seconds are spent or `max_tasks` ran (at least one task runs per tick).
+    The others are late and run first on the next ticks.
+    * budget: None for no time limit, the tasks run then only depend on `max_tasks`
+      (reproducible runs)'''
+
+    def __init__(self, budget:float=None, max_tasks:int=None):
+        self.budget = budget
+        self.max_tasks = max_tasks
+        self.queue:List[Tuple[int,int,Any]] = [] # (tick, order, key)
+        self.tasks:Dict[Any,int] = {} # key -> order of its task, one task per key
+        self.functions:Dict[Any,Callable] = {}
+        self.order = 0
+        self.ran = 0 # tasks run by the last `run`
+
+    def __len__(self)->int:
+        return len(self.tasks)
+
+    def schedule(self, tick:int, key:Any, function:Callable)->None:
+        '''Run `function(key)` at `tick`, replacing the task of `key` if any'''
+        self.order += 1
+        self.tasks[key] = self.order
+        self.functions[key] = function
+        heapq.heappush(self.queue, (tick, self.order, key))
+
+    def cancel(self, key:Any)->None:
+        self.tasks.pop(key, None)
+        self.functions.pop(key, None)
+
+    def run(self, tick:int)->int:
+        '''return: number of tasks run'''
+        queue = self.queue
+        tasks = self.tasks
+        deadline = None if self.budget is None else time.perf_counter() + self.budget
+        ran = 0
+        while queue and queue[0][0] <= tick:
+            if ran and ((self.max_tasks is not None and ran >= self.max_tasks) or
+                        (deadline is not None and time.perf_counter() >= deadline)):
+                break
+            _, order, key = heapq.heappop(queue)
+            if tasks.get(key) != order:
+                continue # cancelled or rescheduled
+            del tasks[key]
+            self.functions.pop(key)(key)
+            ran += 1
+        self.ran = ran
+        return ran
+
+    def late(self, tick:int)->int:
+        '''return: number of tasks due at `tick` or before, still waiting'''
+        return sum(1 for due, order, key in self.queue if due <= tick and self.tasks.get(key) == order)
+
+    def get_state(self)->Dict[str,Any]:
+        '''return: the tasks waiting (tick, order, key), without their functions'''
+        return {'order': self.order,
+                'tasks': [list(task) for task in self.queue if self.tasks.get(task[2]) == task[1]]}
+
+    def set_state(self, state:Dict[str,Any], function:Callable)->None:
+        '''Replace the tasks by the ones of a `get_state`, all running `function`'''
+        self.order = state['order']
+        self.queue = [tuple(task) for task in state['tasks']]
+        heapq.heapify(self.queue)
+        self.tasks = {key: order for _, order, key in self.queue}
+        self.functions = {key: function for key in self.tasks}
+
+
+class BehaviourSystem(object):
+    '''State machines driving the entities of an EntityManager, one machine per entity type.
+    The state of each entity is kept in the manager's `state` array. Decisions are spread
+    over the ticks by `scheduler`.
+    Level of detail: the entities that are not visible act and decide `offscreen_period`
+    times less often (visibility is given to `update`).'''
+
+    def __init__(self, manager:e.EntityManager, scheduler:Scheduler=None, offscreen_period:int=8):
+        self.manager = manager
+        self.scheduler = scheduler or Scheduler()
+        self.offscreen_period = offscreen_period
+        self.states:List[State] = [] # of every machine, `state` holds indexes in this list
+        self.state_ids:Dict[Tuple[Any,str],int] = {} # (entity type, state name) -> index
+        self.machines:Dict[Any,StateMachine] = {}
+        self.visible = np.zeros(0, dtype=bool) # by slot, as given to the last update
+        self.tick = 0
+        self.decide_task = self.decide # scheduled for every decision
+        manager.add_field('state', np.int32, default=-1)
+
+    def add_machine(self, e_type:Any, machine:StateMachine)->None:
+        '''Drive the entities of type `e_type` by `machine`'''
+        self.machines[e_type] = machine
+        for state in machine.states:
+            self.state_ids[(e_type, state.name)] = len(self.states)
+            self.states.append(state)
+
+    def add(self, entity_id:int)->None:
+        '''Start driving an entity of the manager (its first decision is spread over the interval)'''
+        manager = self.manager
+        slot = manager.index(entity_id)
+        e_type = manager.types[manager.type[slot]]
+        state = self.machines[e_type].states[0]
+        manager.state[slot] = self.state_ids[(e_type, state.name)]
+        self.schedule(entity_id, 1 + entity_id % state.interval)
+
+    def remove(self, entity_id:int)->None:
+        self.scheduler.cancel(entity_id)
+
+    def set_state(self, entity_id:int, name:str)->None:
+        manager = self.manager
+        slot = manager.index(entity_id)
+        manager.state[slot] = self.state_ids[(manager.types[manager.type[slot]], name)]
+
+    def get_state(self, entity_id:int)->State:
+        return self.states[self.manager.state[self.manager.index(entity_id)]]
+
+    def schedule(self, entity_id:int, delay:int)->None:
+        self.scheduler.schedule(self.tick + delay, entity_id, self.decide_task)
+
+    def decide(self, entity_id:int)->None:
+        manager = self.manager
+        if entity_id not in manager:
+            return
+        slot = manager.index(entity_id)
+        state = self.states[manager.state[slot]]
+        if state.decide is not None:
+            name = state.decide(entity_id)
+            if name is not None and name != state.name:
+                self.set_state(entity_id, name)
+                state = self.states[manager.state[slot]]
+        interval = state.interval
+        if slot < len(self.visible) and not self.visible[slot]:
+            interval *= self.offscreen_period
+        self.schedule(entity_id, interval)
+
+    def update(self, visible:np.ndarray=None)->None:
+        '''Run the `act` of every state then the decisions due.
+        * visible: boolean mask of the entities seen by the camera, all by default'''
+        manager = self.manager
+        n = len(manager)
+        self.tick += 1
+        self.visible = np.ones(n, dtype=bool) if visible is None else visible
+        acting = self.visible | ((manager.ids[:n] + self.tick) % self.offscreen_period == 0)
+        states = manager.state[:n]
+        for index, state in enumerate(self.states):
+            if state.act is not None:
+                slots = np.flatnonzero(acting & (states == index))
+                if len(slots):
+                    state.act(slots)
+        self.scheduler.run(self.tick)
@@ -1,5 +1,9 @@
-from typing import Any, List, Tuple, Dict
-import pygame, math, os
+from typing import Any, List, Set, Tuple, Dict
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+import pygame, itertools, math, os
+import numpy as np
 from pygame.locals import *
 
 
@@ -36,52 +40,524 @@ def colliderects(rect:pygame.Rect,rects:List[pygame.Rect])->List[pygame.Rect]:
     return [rects[i] for i in rect.collidelistall(rects)]
 
 
+# static collision index
+class SpatialHash(object):
+    '''Uniform grid of static rects, used in place of a flat list of platforms.
+    Each rect is registered under an `owner` (e.g. a chunk position) so that all
+    the rects of an owner can be dropped at once.'''
+
+    def __init__(self, cell_size:int=16):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.owners = {}
+        self.solid = {} # cell -> number of rects covering all of it
+        self.version = 0 # changed by every insert and remove
+        self.key_arrays = {} # see `sorted_keys`
+
+    def cell_range(self, rect:pygame.Rect)->Tuple[range,range]:
+        size = self.cell_size
+        return (range(rect.left // size, (rect.right - 1) // size + 1),
+                range(rect.top // size, (rect.bottom - 1) // size + 1))
+
+    def covers(self, rect:pygame.Rect, cell_x:int, cell_y:int)->bool:
+        size = self.cell_size
+        return (rect.left <= cell_x * size and rect.right >= (cell_x + 1) * size and
+                rect.top <= cell_y * size and rect.bottom >= (cell_y + 1) * size)
+
+    def insert(self, rect:pygame.Rect, owner:Any=None)->None:
+        columns, rows = self.cell_range(rect)
+        for cell_y in rows:
+            for cell_x in columns:
+                self.cells.setdefault((cell_x, cell_y), []).append(rect)
+                if self.covers(rect, cell_x, cell_y):
+                    self.solid[(cell_x, cell_y)] = self.solid.get((cell_x, cell_y), 0) + 1
+        self.owners.setdefault(owner, []).append(rect)
+        self.version += 1
+
+    def remove(self, rect:pygame.Rect, owner:Any=None)->None:
+        columns, rows = self.cell_range(rect)
+        for cell_y in rows:
+            for cell_x in columns:
+                cell = self.cells.get((cell_x, cell_y))
+                if cell is not None and rect in cell:
+                    cell.remove(rect)
+                    if not cell:
+                        del self.cells[(cell_x, cell_y)]
+                    if self.covers(rect, cell_x, cell_y):
+                        self.solid[(cell_x, cell_y)] -= 1
+                        if not self.solid[(cell_x, cell_y)]:
+                            del self.solid[(cell_x, cell_y)]
+        rects = self.owners.get(owner)
+        if rects is not None and rect in rects:
+            rects.remove(rect)
+            if not rects:
+                del self.owners[owner]
+        self.version += 1
+
+    def remove_owner(self, owner:Any)->None:
+        '''Drop every rect registered by `owner`'''
+        for rect in list(self.owners.get(owner, ())):
+            self.remove(rect, owner)
+
+    def __contains__(self, owner:Any)->bool:
+        return owner in self.owners
+
+    def query(self, rect:pygame.Rect)->List[pygame.Rect]:
+        '''return: rects registered in the cells touched by `rect` (they may not collide with it)'''
+        result = []
+        columns, rows = self.cell_range(rect)
+        for cell_y in rows:
+            for cell_x in columns:
+                cell = self.cells.get((cell_x, cell_y))
+                if cell:
+                    result.extend(cell)
+        if len(columns) > 1 or len(rows) > 1:
+            # rects spanning several cells are found once per cell
+            result = list({id(r): r for r in result}.values())
+        return result
+
+    def query_swept(self, rect:pygame.Rect, delta_x:float, delta_y:float)->List[pygame.Rect]:
+        '''return: rects that `rect` may touch while moving by (delta_x, delta_y)'''
+        swept = rect.union(rect.move(int(delta_x), int(delta_y))).inflate(2, 2)
+        return self.query(swept)
+
+    def occupied_cells(self)->np.ndarray:
+        '''return: sorted keys (see `cell_keys`) of the cells holding rects'''
+        return self.sorted_keys('occupied', self.cells)
+
+    def solid_cells(self)->np.ndarray:
+        '''return: sorted keys of the cells entirely covered by a rect'''
+        return self.sorted_keys('solid', self.solid)
+
+    def sorted_keys(self, name:str, cells:Dict[Tuple[int,int],Any])->np.ndarray:
+        '''return: sorted keys of `cells`, rebuilt only after the grid changed'''
+        cached = self.key_arrays.get(name)
+        if cached is None or cached[0] != self.version:
+            positions = np.fromiter(itertools.chain.from_iterable(cells), dtype=np.int64,
+                                    count=2*len(cells)).reshape(-1, 2)
+            cached = self.key_arrays[name] = (self.version,
+                                              np.sort(self.cell_keys(positions[:,0], positions[:,1])))
+        return cached[1]
+
+    @staticmethod
+    def touching(cells:np.ndarray, cell_size:int, low:np.ndarray, high:np.ndarray)->np.ndarray:
+        '''return: for each area from `low` to `high` (inclusive pixel positions, one row each),
+        whether it touches one of `cells` (sorted keys)'''
+        result = np.zeros(len(low), dtype=bool)
+        if not len(cells) or not len(low):
+            return result
+        first = low // cell_size
+        counts = high // cell_size - first + 1
+        for offset_y in range(int(counts[:,1].max())):
+            for offset_x in range(int(counts[:,0].max())):
+                keys = SpatialHash.cell_keys(first[:,0] + offset_x, first[:,1] + offset_y)
+                found = cells[np.minimum(np.searchsorted(cells, keys), len(cells)-1)] == keys
+                result |= found & (offset_x < counts[:,0]) & (offset_y < counts[:,1])
+        return result
+
+    @staticmethod
+    def cell_keys(cell_x:np.ndarray, cell_y:np.ndarray)->np.ndarray:
+        '''return: one integer per cell position, for vectorized lookups'''
+        return (cell_x.astype(np.int64) << 32) + cell_y
+
+
+# dynamic collision index
+class EntityGrid(object):
+    '''Loose uniform grid of moving rects (e.g. entities), for "who is near" queries.
+    Each rect is kept in the cell of its center only, so moving one is cheap, and
+    queries look half the largest registered size further. Query costs depend on the
+    number of rects around the queried area, not on the total.
+    Rects are given as (x, y, width, height) and registered under a hashable `key`.
+    They are stored in arrays (a row per key) so that batches of rects update at once.'''
+    no_cell = np.iinfo(np.int64).min
+
+    def __init__(self, cell_size:int=32, capacity:int=256):
+        self.cell_size = cell_size
+        self.cells:Dict[int,Dict[int,None]] = {} # cell key -> rows, in insertion order
+        self.rows:Dict[Any,int] = {} # key -> row
+        self.keys:List[Any] = [] # row -> key
+        self.free_rows:List[int] = []
+        self.bounds = np.zeros((capacity, 4)) # x, y, width, height of each row
+        self.cell_of = np.full(capacity, self.no_cell, dtype=np.int64)
+        self.margin = 0 # half the largest size registered
+        self.last_keys:List[Any] = [] # keys and rows of the last update_many
+        self.last_rows = None
+
+    def __len__(self)->int:
+        return len(self.rows)
+
+    def __contains__(self, key:Any)->bool:
+        return key in self.rows
+
+    def get(self, key:Any)->Tuple[float,float,float,float]:
+        return tuple(self.bounds[self.rows[key]].tolist())
+
+    def cell_key(self, x:float, y:float)->int:
+        return (int(x // self.cell_size) << 32) + int(y // self.cell_size)
+
+    def add_row(self, key:Any)->int:
+        if self.free_rows:
+            row = self.free_rows.pop()
+            self.keys[row] = key
+        else:
+            row = len(self.keys)
+            self.keys.append(key)
+            if row == len(self.bounds):
+                self.bounds = np.concatenate([self.bounds, np.zeros_like(self.bounds)])
+                self.cell_of = np.concatenate([self.cell_of, np.full_like(self.cell_of, self.no_cell)])
+        self.rows[key] = row
+        return row
+
+    def move_to_cell(self, row:int, cell:int)->None:
+        old = int(self.cell_of[row])
+        if old != self.no_cell:
+            rows = self.cells[old]
+            del rows[row]
+            if not rows:
+                del self.cells[old]
+        self.cells.setdefault(cell, {})[row] = None
+        self.cell_of[row] = cell
+
+    def update(self, key:Any, x:float, y:float, width:float, height:float)->None:
+        '''Insert a rect or move it'''
+        row = self.rows.get(key)
+        if row is None:
+            row = self.add_row(key)
+            self.last_keys = []
+        cell = self.cell_key(x + width/2, y + height/2)
+        if self.cell_of[row] != cell:
+            self.move_to_cell(row, cell)
+        self.bounds[row] = (x, y, width, height)
+        self.margin = max(self.margin, width/2, height/2)
+
+    def update_many(self, keys:List[Any], bounds:np.ndarray)->None:
+        '''Insert or move many rects at once, `bounds` holding one (x, y, width, height) per key.
+        Only the rects changing cell are visited one by one.'''
+        keys = list(keys)
+        if not keys:
+            return
+        if keys == self.last_keys:
+            rows = self.last_rows
+        else:
+            rows = np.array([self.rows[key] if key in self.rows else self.add_row(key) for key in keys])
+        centers = ((bounds[:,:2] + bounds[:,2:]/2) // self.cell_size).astype(np.int64)
+        cells = SpatialHash.cell_keys(centers[:,0], centers[:,1])
+        for i in np.flatnonzero(self.cell_of[rows] != cells).tolist():
+            self.move_to_cell(int(rows[i]), int(cells[i]))
+        self.bounds[rows] = bounds
+        self.margin = max(self.margin, float(bounds[:,2:].max()) / 2)
+        self.last_keys = keys
+        self.last_rows = rows
+
+    def remove(self, key:Any)->None:
+        row = self.rows.pop(key)
+        cell = int(self.cell_of[row])
+        rows = self.cells[cell]
+        del rows[row]
+        if not rows:
+            del self.cells[cell]
+        self.cell_of[row] = self.no_cell
+        self.keys[row] = None
+        self.free_rows.append(row)
+        self.last_keys = []
+
+    def clear(self)->None:
+        self.cells.clear()
+        self.rows.clear()
+        self.keys.clear()
+        self.free_rows.clear()
+        self.cell_of[:] = self.no_cell
+        self.last_keys = []
+
+    def candidates(self, left:float, top:float, right:float, bottom:float)->np.ndarray:
+        '''return: rows in the cells whose rects may overlap the area'''
+        size = self.cell_size
+        margin = self.margin
+        cells = self.cells
+        result = []
+        columns = range(int((left - margin) // size), int((right + margin) // size) + 1)
+        lines = range(int((top - margin) // size), int((bottom + margin) // size) + 1)
+        if len(columns) * len(lines) > len(cells):
+            # large area: fewer occupied cells than cells in it
+            for cell, rows in cells.items():
+                cell_y = ((cell + 0x80000000) & 0xffffffff) - 0x80000000
+                if (cell - cell_y) >> 32 in columns and cell_y in lines:
+                    result.extend(rows)
+        else:
+            for cell_x in columns:
+                for cell_y in lines:
+                    rows = cells.get((cell_x << 32) + cell_y)
+                    if rows:
+                        result.extend(rows)
+        return np.array(result, dtype=np.int64)
+
+    def query_rect(self, rect:pygame.Rect)->List[Any]:
+        '''return: keys of the rects overlapping `rect`'''
+        rows = self.candidates(rect.left, rect.top, rect.right, rect.bottom)
+        x, y, width, height = self.bounds[rows].T
+        overlap = (x < rect.right) & (rect.left < x + width) & (y < rect.bottom) & (rect.top < y + height)
+        keys = self.keys
+        return [keys[row] for row in rows[overlap].tolist()]
+
+    def query_radius(self, x:float, y:float, radius:float)->List[Tuple[float,Any]]:
+        '''return: (squared distance, key) of the rects whose center is within `radius` of (x, y)'''
+        rows = self.candidates(x - radius, y - radius, x + radius, y + radius)
+        left, top, width, height = self.bounds[rows].T
+        distances = (left + width/2 - x) ** 2 + (top + height/2 - y) ** 2
+        near = distances <= radius * radius
+        keys = self.keys
+        return [(distance, keys[row]) for distance, row in zip(distances[near].tolist(), rows[near].tolist())]
+
+    def nearest(self, x:float, y:float, k:int=1, exclude:Any=None)->List[Any]:
+        '''return: keys of the (up to) `k` rects whose center is the closest to (x, y), closest first.
+        The searched area grows until it holds `k` rects.'''
+        wanted = min(k, len(self) - (exclude in self.rows))
+        if wanted <= 0:
+            return []
+        radius = self.cell_size
+        while True:
+            found = [item for item in self.query_radius(x, y, radius) if item[1] != exclude]
+            if len(found) >= wanted:
+                found.sort(key=lambda item: item[0])
+                return [key for _, key in found[:k]]
+            radius *= 2
+
+    def pairs(self)->List[Tuple[Any,Any]]:
+        '''return: every pair of overlapping rects, once each (found for all the rects at once)'''
+        rows = np.array(list(self.rows.values()), dtype=np.int64)
+        n = len(rows)
+        if n < 2:
+            return []
+        bounds = self.bounds[rows]
+        size = self.cell_size
+        reach = int(-(-2 * self.margin // size)) # cells between centers of overlapping rects
+        cells = ((bounds[:,:2] + bounds[:,2:]/2) // size).astype(np.int64)
+        order = np.argsort(SpatialHash.cell_keys(cells[:,0], cells[:,1]), kind='stable')
+        sorted_cells = SpatialHash.cell_keys(cells[order,0], cells[order,1])
+        firsts, seconds = [], []
+        for offset in [(dx, dy) for dx in range(-reach, reach + 1) for dy in range(-reach, reach + 1)]:
+            if offset < (0, 0):
+                continue # each pair of cells is visited once
+            targets = SpatialHash.cell_keys(cells[:,0] + offset[0], cells[:,1] + offset[1])
+            start = np.searchsorted(sorted_cells, targets, 'left')
+            counts = np.searchsorted(sorted_cells, targets, 'right') - start
+            total = int(counts.sum())
+            if not total:
+                continue
+            first = np.repeat(np.arange(n), counts)
+            second = order[np.repeat(start - np.cumsum(counts) + counts, counts) + np.arange(total)]
+            if offset == (0, 0):
+                keep = first < second
+                first, second = first[keep], second[keep]
+            firsts.append(first)
+            seconds.append(second)
+        if not firsts:
+            return []
+        first = np.concatenate(firsts)
+        second = np.concatenate(seconds)
+        a = bounds[first]
+        b = bounds[second]
+        overlap = ((a[:,0] < b[:,0] + b[:,2]) & (b[:,0] < a[:,0] + a[:,2]) &
+                   (a[:,1] < b[:,1] + b[:,3]) & (b[:,1] < a[:,1] + a[:,3]))
+        keys = self.keys
+        return [(keys[i], keys[j]) for i, j in zip(rows[first[overlap]].tolist(), rows[second[overlap]].tolist())]
+
+
 # 2d physics object
+# collision markers: left, right, top, bottom (shared, do not modify)
+NO_MARKERS = (False,False,False,False)
+RIGHT_MARKERS = (True,False,False,False)
+LEFT_MARKERS = (False,True,False,False)
+BOTTOM_MARKERS = (False,False,True,False)
+TOP_MARKERS = (False,False,False,True)
+
+
+def sweep(rect:pygame.Rect, delta:int, direction:float, axis:int,
+          platforms:List[pygame.Rect])->Tuple[int,List[pygame.Rect]]:
+    '''Move `rect` by `delta` pixels along `axis` (0: x, 1: y), stopping at the first platform
+    in the way. `direction` is the sign of the movement (which may be less than a pixel).
+    return: (distance moved, platforms touched at that distance)'''
+    if direction == 0:
+        return 0, [platforms[i] for i in rect.collidelistall(platforms)]
+    if axis == 0:
+        swept = pygame.Rect(min(rect.x, rect.x + delta), rect.y, rect.width + abs(delta), rect.height)
+    else:
+        swept = pygame.Rect(rect.x, min(rect.y, rect.y + delta), rect.width, rect.height + abs(delta))
+    hits = [platforms[i] for i in swept.collidelistall(platforms)]
+    if not hits:
+        return delta, hits
+    if direction > 0:
+        faces = [block.left if axis == 0 else block.top for block in hits]
+        contact = min(faces)
+        moved = contact - (rect.right if axis == 0 else rect.bottom)
+    else:
+        faces = [block.right if axis == 0 else block.bottom for block in hits]
+        contact = max(faces)
+        moved = contact - (rect.left if axis == 0 else rect.top)
+    return moved, [block for block, face in zip(hits, faces) if face == contact]
+
+
+def first_impact(rect:pygame.Rect, delta_x:int, delta_y:int,
+                 platforms:List[pygame.Rect])->Tuple[float,int]:
+    '''Time of impact of `rect` moving by (delta_x, delta_y) in a straight line.
+    Platforms already overlapping `rect` are ignored.
+    return: (fraction of the movement done when `rect` first runs into a platform, axis it is
+    blocked on (0: x, 1: y), platforms it runs into then), (1, None, []) when nothing is in the way'''
+    swept = rect.union(rect.move(delta_x, delta_y))
+    first, blocked, hits = 1, None, []
+    for block in [platforms[i] for i in swept.collidelistall(platforms)]:
+        enter, leave, axis = -math.inf, math.inf, None
+        for block_axis, (start, end, block_start, block_end, delta) in enumerate((
+                (rect.left, rect.right, block.left, block.right, delta_x),
+                (rect.top, rect.bottom, block.top, block.bottom, delta_y))):
+            if delta > 0:
+                axis_enter, axis_leave = (block_start - end) / delta, (block_end - start) / delta
+            elif delta < 0:
+                axis_enter, axis_leave = (block_end - start) / delta, (block_start - end) / delta
+            elif start < block_end and block_start < end:
+                continue # overlapping on this axis during the whole movement
+            else:
+                break # never overlapping on this axis
+            if axis_enter >= enter: # reaching a corner: on top of or under the platform, not against its side
+                enter, axis = axis_enter, block_axis
+            leave = min(leave, axis_leave)
+        else:
+            if axis is None or not 0 <= enter < leave:
+                continue
+            if enter < first:
+                first, blocked, hits = enter, axis, [block]
+            elif enter == first and axis == blocked:
+                hits.append(block)
+    return first, blocked, hits
+
+
+def escape_distance(rect:pygame.Rect, platforms:'List[pygame.Rect]|SpatialHash', axis:int, direction:int,
+                    limit:float=math.inf)->float:
+    '''return: pixels `rect` has to move along `axis` (0: x, 1: y) in `direction` (1 or -1)
+    to overlap none of `platforms`, math.inf if more than `limit`'''
+    moved = rect.copy()
+    distance = 0
+    while True:
+        blocks = platforms.query(moved) if isinstance(platforms, SpatialHash) else platforms
+        hits = [blocks[i] for i in moved.collidelistall(blocks)]
+        if not hits:
+            return distance
+        if axis == 0:
+            step = max(block.right - moved.left if direction > 0 else moved.right - block.left for block in hits)
+            moved.x += step * direction
+        else:
+            step = max(block.bottom - moved.top if direction > 0 else moved.bottom - block.top for block in hits)
+            moved.y += step * direction
+        distance += step
+        if distance > limit:
+            return math.inf
+
+
 class Physics_obj(object):
-   
+
     def __init__(self,x,y,x_size,y_size):
         self.width = x_size
         self.height = y_size
         self.rect = pygame.Rect(x,y,self.width,self.height)
         self.x = x
         self.y = y
-       
-    def move(self,movement:Tuple[int,int],platforms:List[pygame.Rect],ramps=[]):
-        self.x += movement.x
-        self.rect.x = int(self.x)
-        block_hit_list = colliderects(self.rect,platforms)
-        collision_types = {'top':False,'bottom':False,'right':False,'left':False,'slant_bottom':False,'data':[]}
+        # reused by every call to move
+        self.collision_types = {'top':False,'bottom':False,'right':False,'left':False,'slant_bottom':False,'data':[]}
+
+    def move(self,movement:Tuple[int,int],platforms:List[pygame.Rect],ramps=[],collect_data:bool=True):
+        '''Move by `movement`, stopping against `platforms` (a list of rects or a SpatialHash).
+        The movement is swept as a whole: up to the first platform in the way (see `first_impact`),
+        then it slides along that platform on the other axis. Fast objects can not pass through
+        thin platforms, even diagonally.
+        return: collision types, the same dict for every call of this object.
+        Its 'data' lists [platform, markers] of the platforms touched, unless `collect_data` is False.
+        A rect starting inside platforms (e.g. a tile put on it) is first pushed out by the shortest
+        way, as if it had moved into them the other way.'''
+        collision_types = self.collision_types
+        collision_types['top'] = collision_types['bottom'] = False
+        collision_types['right'] = collision_types['left'] = False
+        collision_types['slant_bottom'] = False
+        collision_types['data'].clear()
+        index = platforms
+        if isinstance(platforms, SpatialHash):
+            platforms = platforms.query_swept(self.rect, movement.x, movement.y)
+        if self.rect.collidelist(platforms) != -1:
+            embedded = [platforms[i] for i in self.rect.collidelistall(platforms)]
+            self.push_out(index, embedded, collect_data)
+            if isinstance(index, SpatialHash):
+                platforms = index.query_swept(self.rect, movement.x, movement.y)
         # added collision data to "collision_types". ignore the poorly chosen variable name
-        for block in block_hit_list:
-            #left, right, top, bottom
-            markers = [False,False,False,False]
-            if movement.x > 0:
-                self.rect.right = block.left
+        deltas = (int(self.x + movement.x) - self.rect.x, int(self.y + movement.y) - self.rect.y)
+        directions = (movement.x, movement.y)
+        self.x += movement.x
+        self.y += movement.y
+        fraction, axis, hits = first_impact(self.rect, deltas[0], deltas[1], platforms)
+        if axis is None:
+            self.rect.move_ip(deltas)
+            return collision_types
+        # at the impact: against the platforms on the blocked axis, the other one truncated towards the
+        # start (the rect and platforms are on whole pixels, so it can not overlap anything there)
+        other = 1 - axis
+        lead = int(deltas[other] * fraction)
+        if axis == 0:
+            self.rect.x = hits[0].left - self.rect.width if deltas[0] > 0 else hits[0].right
+            self.rect.y += lead
+        else:
+            self.rect.y = hits[0].top - self.rect.height if deltas[1] > 0 else hits[0].bottom
+            self.rect.x += lead
+        self.touch(axis, directions[axis], hits, collect_data)
+        # then slide along them
+        moved, touched = sweep(self.rect, deltas[other] - lead, directions[other], other, platforms)
+        if other == 0:
+            self.rect.x += moved
+        else:
+            self.rect.y += moved
+        if touched:
+            self.touch(other, directions[other], touched, collect_data)
+        return collision_types
+
+    def push_out(self, platforms:'List[pygame.Rect]|SpatialHash', embedded:List[pygame.Rect],
+                 collect_data:bool)->None:
+        '''Move the rect out of the `embedded` platforms (and any other it would then overlap)
+        along the axis and direction needing the shortest move, up first on ties'''
+        best = (math.inf, 1, -1)
+        for axis, direction in ((1, -1), (0, -1), (0, 1), (1, 1)):
+            distance = escape_distance(self.rect, platforms, axis, direction, best[0])
+            if distance < best[0]:
+                best = (distance, axis, direction)
+        distance, axis, direction = best
+        if distance == math.inf:
+            return
+        if axis == 0:
+            self.rect.x += distance * direction
+        else:
+            self.rect.y += distance * direction
+        self.touch(axis, -direction, embedded, collect_data)
+
+    def touch(self, axis:int, direction:float, touched:List[pygame.Rect], collect_data:bool)->None:
+        '''Record the platforms `touched` while moving in `direction` along `axis`
+        and stop there on that axis'''
+        collision_types = self.collision_types
+        markers = NO_MARKERS
+        if axis == 0:
+            if direction > 0:
                 collision_types['right'] = True
-                markers[0] = True
-            elif movement.x < 0:
-                self.rect.left = block.right
+                markers = RIGHT_MARKERS
+            elif direction < 0:
                 collision_types['left'] = True
-                markers[1] = True
-            collision_types['data'].append([block,markers])
+                markers = LEFT_MARKERS
             self.x = self.rect.x
-        self.y += movement.y
-        self.rect.y = int(self.y)
-        block_hit_list = colliderects(self.rect,platforms)
-        for block in block_hit_list:
-            markers = [False,False,False,False]
-            if movement.y > 0:
-                self.rect.bottom = block.top
+        else:
+            if direction > 0:
                 collision_types['bottom'] = True
-                markers[2] = True
-            elif movement.y < 0:
-                self.rect.top = block.bottom
+                markers = BOTTOM_MARKERS
+            elif direction < 0:
                 collision_types['top'] = True
-                markers[3] = True
-            collision_types['data'].append([block,markers])
+                markers = TOP_MARKERS
             self.change_y = 0
             self.y = self.rect.y
-        return collision_types
+        if collect_data:
+            collision_types['data'].extend([block,markers] for block in touched)
 
 # 3d collision detection
 # todo: add 3d physics-based movement
@@ -128,9 +604,9 @@ class Entity(object):
         self.size_x = size_x
         self.size_y = size_y
         self.obj = Physics_obj(x,y,size_x,size_y)
-        self.animation = None
+        self.animation:Animation = None
         self.image = None
-        self.animation_frame = 0
+        self.animation_frame = 0 # ticks since the animation started
         self.animation_tags = []
         self.flip = False
         self.offset = [0,0]
@@ -150,8 +626,8 @@ class Entity(object):
         self.obj.rect.x = x
         self.obj.rect.y = y
  
-    def move(self,momentum:Tuple[int,int],platforms:List[pygame.Rect],ramps=[])->Dict:
-        collisions = self.obj.move(momentum,platforms,ramps)
+    def move(self,momentum:Tuple[int,int],platforms:'List[pygame.Rect]|SpatialHash',ramps=[],collect_data:bool=True)->Dict:
+        collisions = self.obj.move(momentum,platforms,ramps,collect_data)
         self.x = self.obj.x
         self.y = self.obj.y
         return collisions
@@ -165,8 +641,8 @@ class Entity(object):
     def set_animation_tags(self,tags):
         self.animation_tags = tags
  
-    def set_animation(self,sequence):
-        self.animation = sequence
+    def set_animation(self,animation:'Animation'):
+        self.animation = animation
         self.animation_frame = 0
  
     def set_action(self,action_id,force=False):
@@ -174,9 +650,9 @@ class Entity(object):
             pass
         else:
             self.action = action_id
-            anim = animation_higher_database[self.type][action_id]
-            self.animation = anim[0]
-            self.set_animation_tags(anim[1])
+            animation = animation_higher_database[self.type][action_id]
+            self.animation = animation
+            self.set_animation_tags(animation.tags)
             self.animation_frame = 0
 
     def get_entity_angle(self, entity_2):
@@ -212,92 +688,730 @@ class Entity(object):
  
     def change_frame(self,amount):
         self.animation_frame += amount
-        if self.animation != None:
-            while self.animation_frame < 0:
-                if 'loop' in self.animation_tags:
-                    self.animation_frame += len(self.animation)
-                else:
-                    self.animation = 0
-            while self.animation_frame >= len(self.animation):
-                if 'loop' in self.animation_tags:
-                    self.animation_frame -= len(self.animation)
-                else:
-                    self.animation_frame = len(self.animation)-1
+        animation = self.animation
+        if animation != None and not 0 <= self.animation_frame < animation.length:
+            self.animation_frame = animation.wrap(self.animation_frame)
  
-    def get_current_img(self):
+    def get_frame(self)->Tuple[Any,pygame.Surface]:
+        '''return: (frame id, untransformed image) of the current frame, None if there is no image'''
         if self.animation == None:
             if self.image != None:
-                return pygame.transform.flip(self.image,self.flip,False)
-            else:
-                return None
-        else:
-            return pygame.transform.flip(animation_database[self.animation[self.animation_frame]],
-                        self.flip, False)
+                return self.image, self.image
+            return None
+        frame_id = self.animation.frames[bisect_right(self.animation.end_ticks, self.animation_frame)]
+        return frame_id, animation_database[frame_id]
+
+    def get_current_img(self):
+        frame = self.get_frame()
+        if frame == None:
+            return None
+        return get_sprite_cache(self.type).get(frame[0], frame[1], self.flip)
 
     def get_drawn_img(self):
-        image_to_render = None
-        if self.animation == None:
-            if self.image != None:
-                image_to_render = pygame.transform.flip(self.image,self.flip,
-                                                        False).copy()
-        else:
-            image_to_render = pygame.transform.flip(animation_database[self.animation[self.animation_frame]],
-                                                    self.flip,False).copy()
-        if image_to_render != None:
-            center_x = image_to_render.get_width()/2
-            center_y = image_to_render.get_height()/2
-            image_to_render = pygame.transform.rotate(image_to_render,self.rotation)
-            if self.alpha != None:
-                image_to_render.set_alpha(self.alpha)
+        '''return: (image, center_x, center_y). The image is shared, copy it before modifying it.'''
+        frame = self.get_frame()
+        if frame != None:
+            center_x = frame[1].get_width()/2
+            center_y = frame[1].get_height()/2
+            image_to_render = get_sprite_cache(self.type).get(frame[0], frame[1], self.flip,
+                                                              self.rotation, self.alpha)
             return image_to_render, center_x, center_y
  
+    def get_drawn_rect(self,scroll)->pygame.Rect:
+        '''return: area of the surface covered by `display`, None if there is nothing to draw'''
+        drawn = self.get_drawn_img()
+        if drawn != None:
+            image_to_render, center_x, center_y = drawn
+            return pygame.Rect(int(int(self.x)-scroll.x+center_x-int(image_to_render.get_width()/2)),
+                               int(int(self.y)-scroll.y+center_y-int(image_to_render.get_height()/2)),
+                               image_to_render.get_width(), image_to_render.get_height())
+
     def display(self,surface,scroll):
-        image_to_render = None
-        if self.animation == None:
-            if self.image != None:
-                image_to_render = pygame.transform.flip(self.image,self.flip, False).copy()
-        else:
-            image_to_render = pygame.transform.flip(animation_database[self.animation[self.animation_frame]],
-                                                    self.flip, False).copy()
-        if image_to_render != None:
-            center_x = image_to_render.get_width()/2
-            center_y = image_to_render.get_height()/2
-            image_to_render = pygame.transform.rotate(image_to_render,self.rotation)
-            if self.alpha != None:
-                image_to_render.set_alpha(self.alpha)
+        drawn = self.get_drawn_img()
+        if drawn != None:
+            image_to_render, center_x, center_y = drawn
             blit_center(surface,image_to_render,(int(self.x)-scroll.x+center_x,
                                                  int(self.y)-scroll.y+center_y))
  
+# sprite transformations
+class SpriteCache(object):
+    '''Flipped, rotated and faded copies of sprites, keyed by
+    (frame id, flip, rotation bucket, alpha). Rotations are rounded to multiples of
+    `rotation_step` degrees. Least recently used sprites are dropped past `max_size`.'''
+
+    def __init__(self, max_size:int=256, rotation_step:float=1):
+        self.max_size = max_size
+        self.rotation_step = rotation_step
+        self.sprites = OrderedDict()
+
+    def get(self, frame_id:Any, image:pygame.Surface, flip:bool=False, rotation:float=0,
+            alpha:int=None)->pygame.Surface:
+        '''return: `image` transformed. The result is shared and must not be modified.'''
+        buckets = round(360 / self.rotation_step)
+        bucket = round(rotation / self.rotation_step) % buckets
+        if not flip and bucket == 0 and alpha == None:
+            return image
+        key = (frame_id, flip, bucket, alpha)
+        sprite = self.sprites.get(key)
+        if sprite is not None:
+            self.sprites.move_to_end(key)
+            return sprite
+        sprite = pygame.transform.flip(image, flip, False)
+        if bucket:
+            sprite = pygame.transform.rotate(sprite, bucket * self.rotation_step)
+        if alpha != None:
+            sprite.set_alpha(alpha)
+        self.sprites[key] = sprite
+        if len(self.sprites) > self.max_size:
+            self.sprites.popitem(last=False)
+        return sprite
+
+    def clear(self)->None:
+        self.sprites.clear()
+
+
+global sprite_caches
+sprite_caches = {}
+
+def get_sprite_cache(e_type:Any)->SpriteCache:
+    '''return: the sprite cache shared by all the entities of type `e_type`'''
+    global sprite_caches
+    cache = sprite_caches.get(e_type)
+    if cache is None:
+        cache = sprite_caches[e_type] = SpriteCache()
+    return cache
+
+# batched entities
+class EntityManager(object):
+    '''Many simple entities (e.g. NPCs) stored in arrays and updated all at once.
+    Gravity, movement and animation frames of every entity are advanced with numpy, only the
+    entities that may touch a platform during a step are moved one by one by `Physics_obj.move`.
+    Entities are referred to by the id returned by `add`. Methods taking `slots` accept an
+    index array or a boolean mask over the first `len(manager)` entries of the arrays.
+    * gravity, max_fall_speed: added to the vertical velocity every step, and its limit'''
+
+    def __init__(self, capacity:int=256, gravity:float=0.2, max_fall_speed:float=3):
+        self.gravity = gravity
+        self.max_fall_speed = max_fall_speed
+        self.count = 0
+        self.next_id = 0
+        self.slots:Dict[int,int] = {} # entity id -> index in the arrays
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.position = np.zeros((capacity, 2))
+        self.velocity = np.zeros((capacity, 2)) # movement of the next step
+        self.size = np.zeros((capacity, 2), dtype=np.int32)
+        self.type = np.zeros(capacity, dtype=np.int32) # index in `types`
+        self.animation = np.zeros(capacity, dtype=np.int32) # index in `animations`
+        self.frame = np.zeros(capacity, dtype=np.int32)
+        self.flip = np.zeros(capacity, dtype=bool)
+        self.on_ground = np.zeros(capacity, dtype=bool) # landed and has not moved since
+        self.blocked = np.zeros(capacity, dtype=np.int8) # -1: stopped by a wall on the left, 1: on the right
+        self.types:List[Any] = []
+        # animations in use, (entity type, action) with their frames put end to end
+        self.animations:List[Tuple[Any,str]] = []
+        self.animation_ids:Dict[Tuple[Any,str],int] = {}
+        self.animation_ticks = np.zeros(0, dtype=np.int64) # first tick of each animation in `frame_ends`
+        self.animation_length = np.zeros(0, dtype=np.int32) # in ticks
+        self.animation_loop = np.zeros(0, dtype=bool)
+        self.frame_ends = np.zeros(0, dtype=np.int64) # tick at which every frame ends (Animation.ends + animation_ticks)
+        self.frame_sprites = np.zeros(0, dtype=np.int32) # index in `sprites` of every frame, unflipped
+        # each frame image followed by its flipped copy
+        self.sprites:List[pygame.Surface] = []
+        self.sprite_ids:Dict[str,int] = {}
+        self.sprite_offsets = np.zeros((0, 2)) # drawn position - position (as Entity.display)
+        self.sprite_sizes = np.zeros((0, 2), dtype=np.int32)
+        self.sprite_margin = 0 # largest sprite size
+        self.obj = Physics_obj(0,0,1,1) # moves the entities that may collide
+        self.platforms_version = None # platforms of the last move, see `on_ground`
+        # per-entity arrays, kept in the same order (see `add_field`)
+        self.fields:List[str] = ['ids', 'position', 'velocity', 'size', 'type', 'animation', 'frame',
+                                 'flip', 'on_ground', 'blocked']
+        self.defaults:Dict[str,Any] = {}
+
+    def __len__(self)->int:
+        return self.count
+
+    def __contains__(self, entity_id:int)->bool:
+        return entity_id in self.slots
+
+    def index(self, entity_id:int)->int:
+        '''return: index of the entity in the arrays (changes when entities are removed)'''
+        return self.slots[entity_id]
+
+    def get_animation(self, e_type:Any, action_id:str)->int:
+        '''return: index in `animations` of an animation of animation_higher_database'''
+        global animation_database, animation_higher_database
+        key = (e_type, action_id)
+        animation = self.animation_ids.get(key)
+        if animation is None:
+            sequence = animation_higher_database[e_type][action_id]
+            frames = []
+            offsets = []
+            sizes = []
+            for frame_id in sequence.frames:
+                if frame_id not in self.sprite_ids:
+                    image = animation_database[frame_id]
+                    self.sprite_ids[frame_id] = len(self.sprites)
+                    self.sprites.append(image)
+                    self.sprites.append(get_sprite_cache(e_type).get(frame_id, image, True))
+                    width, height = image.get_size()
+                    offset = (width/2 - int(width/2), height/2 - int(height/2))
+                    offsets.extend([offset, offset])
+                    sizes.extend([(width, height), (width, height)])
+                    self.sprite_margin = max(self.sprite_margin, width, height)
+                frames.append(self.sprite_ids[frame_id])
+            animation = self.animation_ids[key] = len(self.animations)
+            self.animations.append(key)
+            start = self.frame_ends[-1] if len(self.frame_ends) else 0
+            self.animation_ticks = np.append(self.animation_ticks, start)
+            self.animation_length = np.append(self.animation_length, sequence.length).astype(np.int32)
+            self.animation_loop = np.append(self.animation_loop, sequence.loop)
+            self.frame_ends = np.append(self.frame_ends, start + sequence.ends)
+            self.frame_sprites = np.append(self.frame_sprites, frames).astype(np.int32)
+            self.sprite_offsets = np.concatenate([self.sprite_offsets, np.reshape(offsets, (-1, 2))])
+            self.sprite_sizes = np.concatenate([self.sprite_sizes, np.reshape(sizes, (-1, 2)).astype(np.int32)])
+        return animation
+
+    def add_field(self, name:str, dtype:Any=float, shape:Tuple[int,...]=(), default:Any=0)->np.ndarray:
+        '''Add an array attribute `name` holding a value per entity (e.g. for a game subsystem),
+        set to `default` for new entities and kept in order when entities are removed.
+        return: the whole array (replaced when the manager grows, use the attribute)'''
+        array = np.full((len(self.ids),) + shape, default, dtype=dtype)
+        setattr(self, name, array)
+        self.fields.append(name)
+        self.defaults[name] = default
+        return array
+
+    def grow(self)->None:
+        capacity = len(self.ids) * 2
+        for name in self.fields:
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+
+    def add(self, x:float, y:float, size_x:int, size_y:int, e_type:Any, action_id:str='idle')->int:
+        '''return: id of the new entity'''
+        if self.count == len(self.ids):
+            self.grow()
+        if e_type not in self.types:
+            self.types.append(e_type)
+        i = self.count
+        entity_id = self.next_id
+        self.next_id += 1
+        self.slots[entity_id] = i
+        self.ids[i] = entity_id
+        self.position[i] = (x, y)
+        self.velocity[i] = (0, 0)
+        self.size[i] = (size_x, size_y)
+        self.type[i] = self.types.index(e_type)
+        self.animation[i] = self.get_animation(e_type, action_id)
+        self.frame[i] = 0
+        self.flip[i] = False
+        self.on_ground[i] = False
+        self.blocked[i] = 0
+        for name, default in self.defaults.items():
+            getattr(self, name)[i] = default
+        self.count += 1
+        return entity_id
+
+    def remove(self, entity_id:int)->None:
+        '''Remove an entity, the last one takes its place in the arrays'''
+        i = self.slots.pop(entity_id)
+        last = self.count - 1
+        if i != last:
+            for name in self.fields:
+                array = getattr(self, name)
+                array[i] = array[last]
+            self.slots[int(self.ids[i])] = i
+        self.count = last
+
+    def clear(self)->None:
+        self.count = 0
+        self.slots.clear()
+
+    def get_state(self)->Tuple[Dict[str,Any],Dict[str,np.ndarray]]:
+        '''return: (meta, arrays) describing every entity, see `set_state`'''
+        n = self.count
+        meta = {'count': n, 'next_id': self.next_id, 'types': list(self.types),
+                'animations': [list(key) for key in self.animations]}
+        return meta, {name: getattr(self, name)[:n].copy() for name in self.fields}
+
+    def set_state(self, meta:Dict[str,Any], arrays:Dict[str,np.ndarray])->None:
+        '''Replace the entities by the ones of a `get_state` (of a manager with the same fields)'''
+        n = meta['count']
+        self.types = list(meta['types'])
+        for e_type, action_id in meta['animations']:
+            self.get_animation(e_type, action_id)
+        while len(self.ids) < n:
+            self.grow()
+        for name in self.fields:
+            getattr(self, name)[:n] = arrays[name]
+        self.count = n
+        self.next_id = meta['next_id']
+        self.slots = {entity_id: slot for slot, entity_id in enumerate(self.ids[:n].tolist())}
+        self.platforms_version = None
+
+    def rect(self, entity_id:int)->pygame.Rect:
+        i = self.slots[entity_id]
+        return pygame.Rect(int(self.position[i,0]), int(self.position[i,1]), *self.size[i].tolist())
+
+    def rects(self)->np.ndarray:
+        '''return: (x, y, width, height) of the collision rect of every entity'''
+        n = self.count
+        return np.column_stack([np.trunc(self.position[:n]), self.size[:n]])
+
+    def set_action(self, slots, action_id:str)->None:
+        '''Start animation `action_id` for the entities of `slots` not already doing it'''
+        n = self.count
+        selected = np.zeros(n, dtype=bool)
+        selected[slots] = True
+        types = self.type[:n]
+        for type_index in np.unique(types[selected]).tolist():
+            animation = self.get_animation(self.types[type_index], action_id)
+            changed = selected & (types == type_index) & (self.animation[:n] != animation)
+            self.animation[:n][changed] = animation
+            self.frame[:n][changed] = 0
+
+    def change_frame(self, amount:int=1)->None:
+        '''Advance the animation frame of every entity, as Entity.change_frame'''
+        n = self.count
+        frame = self.frame[:n]
+        frame += amount
+        length = self.animation_length[self.animation[:n]]
+        loop = self.animation_loop[self.animation[:n]]
+        np.copyto(frame, np.where(loop, frame % length, np.clip(frame, 0, length-1)))
+
+    def move(self, platforms:'List[pygame.Rect]|SpatialHash', active:np.ndarray=None)->None:
+        '''Move every entity by its velocity then apply gravity, stopping against `platforms`.
+        Entities landing lose their vertical velocity. `on_ground` and `blocked` are updated.
+        * active: boolean mask of the entities to move, the others are frozen'''
+        n = self.count
+        if active is None:
+            active = np.ones(n, dtype=bool)
+        position = self.position[:n]
+        velocity = self.velocity[:n]
+        on_ground = self.on_ground[:n]
+        movement = np.where(active[:,None], velocity, 0)
+        velocity[active, 1] = np.minimum(velocity[active, 1] + self.gravity, self.max_fall_speed)
+        self.blocked[:n][active] = 0
+
+        resting = np.zeros(n, dtype=bool)
+        if isinstance(platforms, SpatialHash):
+            # standing still on a platform that is still there: only falls back onto it
+            version = (id(platforms), platforms.version)
+            if version == self.platforms_version:
+                resting = active & on_ground & (movement[:,0] == 0) & (movement[:,1] >= 0)
+            self.platforms_version = version
+            landing = resting & (np.trunc(position[:,1] + movement[:,1]) != np.trunc(position[:,1]))
+            position[resting & ~landing, 1] += movement[resting & ~landing, 1]
+            position[landing, 1] = np.trunc(position[landing, 1])
+            velocity[landing, 1] = 0
+            active = active & ~resting
+        on_ground[active] = False
+
+        # entities whose swept rect touches an occupied cell are moved one by one
+        if isinstance(platforms, SpatialHash):
+            size = self.size[:n]
+            start = np.trunc(position).astype(np.int64)
+            end = np.trunc(position + movement).astype(np.int64)
+            low = np.minimum(start, end)
+            high = np.maximum(start, end) + size - 1
+            cell_size = platforms.cell_size
+            occupied = platforms.occupied_cells()
+            colliding = active & SpatialHash.touching(occupied, cell_size, low, high)
+            # walking on the ground (falling back onto a platform covering a cell under the feet,
+            # nothing in the way horizontally): resolved here as Physics_obj.move would
+            walking = colliding & (movement[:,1] >= 0) & ((start[:,1] + size[:,1]) % cell_size == 0)
+            slots = np.flatnonzero(walking)
+            if len(slots):
+                top = start[slots,1]
+                bottom = top + size[slots,1]
+                free_x = ~SpatialHash.touching(occupied, cell_size,
+                                               np.column_stack([low[slots,0], top]),
+                                               np.column_stack([high[slots,0], bottom - 1]))
+                supported = SpatialHash.touching(platforms.solid_cells(), cell_size,
+                                                 np.column_stack([end[slots,0], bottom]),
+                                                 np.column_stack([end[slots,0] + size[slots,0] - 1, bottom]))
+                slots = slots[free_x & supported]
+                position[slots,0] += movement[slots,0]
+                position[slots,1] = start[slots,1]
+                velocity[slots,1] = 0
+                on_ground[slots] = True
+                colliding[slots] = False
+                active = active.copy()
+                active[slots] = False
+        else:
+            colliding = active.copy()
+        free = active & ~colliding
+        position[free] += movement[free]
+
+        obj = self.obj
+        for i in np.flatnonzero(colliding).tolist():
+            x, y = position[i].tolist()
+            obj.x = x
+            obj.y = y
+            obj.rect.update(int(x), int(y), *self.size[i].tolist())
+            collisions = obj.move(Vector(*movement[i].tolist()), platforms, collect_data=False)
+            position[i] = (obj.x, obj.y)
+            if collisions['bottom']:
+                self.on_ground[i] = True
+                velocity[i,1] = 0
+            if collisions['right']:
+                self.blocked[i] = 1
+            elif collisions['left']:
+                self.blocked[i] = -1
+
+    def update(self, platforms:'List[pygame.Rect]|SpatialHash', active:np.ndarray=None)->None:
+        '''One step: move (see `move`) and animate every entity'''
+        self.move(platforms, active)
+        self.change_frame(1)
+
+    def visible_sprites(self, surface:pygame.Surface, scroll)->Tuple[np.ndarray,np.ndarray,np.ndarray]:
+        '''return: slots, index in `sprites` and drawn position on `surface` of the entities overlapping it'''
+        n = self.count
+        left = np.trunc(self.position[:n]) - (scroll.x, scroll.y)
+        width, height = surface.get_size()
+        margin = self.sprite_margin
+        visible = ((left[:,0] + margin > 0) & (left[:,0] < width) &
+                   (left[:,1] + margin > 0) & (left[:,1] < height))
+        slots = np.flatnonzero(visible)
+        frames = np.searchsorted(self.frame_ends, self.animation_ticks[self.animation[slots]] + self.frame[slots],
+                                 side='right')
+        sprite_ids = self.frame_sprites[frames] + self.flip[slots]
+        destinations = (left[slots] + self.sprite_offsets[sprite_ids]).astype(np.int32)
+        return slots, sprite_ids, destinations
+
+    def drawn_sprites(self, surface:pygame.Surface, scroll)->Set[Tuple[int,int,int,int,int,int]]:
+        '''return: (entity id, sprite, x, y, width, height) of every sprite `display` draws on `surface`,
+        to find the areas that changed since a previous frame'''
+        slots, sprite_ids, destinations = self.visible_sprites(surface, scroll)
+        rows = np.column_stack([self.ids[slots], sprite_ids, destinations, self.sprite_sizes[sprite_ids]])
+        return set(map(tuple, rows.tolist()))
+
+    def display(self, surface:pygame.Surface, scroll)->None:
+        '''Draw the entities overlapping `surface` (as Entity.display, without rotation nor alpha)'''
+        if not self.count:
+            return
+        _, sprite_ids, destinations = self.visible_sprites(surface, scroll)
+        sprites = self.sprites
+        surface.blits(zip([sprites[i] for i in sprite_ids.tolist()], destinations.tolist()), doreturn=False)
+
+# chunk rendering
+def surface_bytes(surf:pygame.Surface)->int:
+    '''return: approximate memory used by the pixels of `surf` (0 for None)'''
+    if surf is None:
+        return 0
+    return surf.get_width() * surf.get_height() * surf.get_bytesize()
+
+
+class ChunkCache(object):
+    '''Pre-rendered chunk surfaces keyed by chunk position.
+    Least recently used entries are evicted once the memory used by the cached
+    surfaces exceeds `budget` (in bytes). The budget should hold at least the
+    chunks visible in one frame or they will be re-rendered every frame.
+    A value of None is allowed for chunks with nothing to draw.'''
+
+    def __init__(self, budget:int=8*1024*1024):
+        self.budget = budget
+        self.surfaces = OrderedDict()
+        self.size = 0
+
+    def __contains__(self, key)->bool:
+        return key in self.surfaces
+
+    def __len__(self)->int:
+        return len(self.surfaces)
+
+    def __getitem__(self, key)->pygame.Surface:
+        self.surfaces.move_to_end(key)
+        return self.surfaces[key]
+
+    def __setitem__(self, key, surf:pygame.Surface):
+        self.invalidate(key)
+        self.surfaces[key] = surf
+        self.size += surface_bytes(surf)
+        while self.size > self.budget and len(self.surfaces) > 1:
+            _, evicted = self.surfaces.popitem(last=False)
+            self.size -= surface_bytes(evicted)
+
+    def invalidate(self, key)->None:
+        '''Drop the surface of chunk `key` so it is rendered again on next use'''
+        if key in self.surfaces:
+            self.size -= surface_bytes(self.surfaces.pop(key))
+
+    def clear(self)->None:
+        self.surfaces.clear()
+        self.size = 0
+
+
+# chunk streaming
+class ChunkStreamer(object):
+    '''Generates chunks in the background on a pool of workers.
+    * generate: function(chunk_x, chunk_y) returning a chunk. It must only depend on
+      its arguments (e.g. use a random generator seeded from them) so the chunks do not
+      depend on the order in which the workers run.
+    * is_loaded: function(chunk_x, chunk_y) telling if a chunk is already in the map
+    * executor: pool running `generate`, a ThreadPoolExecutor of `workers` threads by default.
+      With 0 workers the chunks are generated by `request`, so they are collected in the
+      order they were requested (reproducible runs).'''
+
+    def __init__(self, generate, is_loaded, workers:int=2, executor=None):
+        self.generate = generate
+        self.is_loaded = is_loaded
+        self.executor = executor
+        if executor is None and workers:
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending:Dict[Tuple[int,int],Future] = {}
+
+    def submit(self, chunk_x:int, chunk_y:int)->Future:
+        if self.executor is None:
+            future = Future()
+            future.set_result(self.generate(chunk_x, chunk_y))
+            return future
+        return self.executor.submit(self.generate, chunk_x, chunk_y)
+
+    def request(self, chunk_x:int, chunk_y:int)->None:
+        '''Schedule the generation of a chunk, unless it is loaded or already scheduled'''
+        position = (chunk_x, chunk_y)
+        if position not in self.pending and not self.is_loaded(chunk_x, chunk_y):
+            self.pending[position] = self.submit(chunk_x, chunk_y)
+
+    def wait(self, chunk_x:int, chunk_y:int)->Any:
+        '''return: the chunk, blocking until it is generated.
+        The chunk is not returned again by `collect`.'''
+        position = (chunk_x, chunk_y)
+        future = self.pending.pop(position, None)
+        if future is None:
+            future = self.submit(chunk_x, chunk_y)
+        return future.result()
+
+    def collect(self)->List[Tuple[Tuple[int,int],Any]]:
+        '''return: (position, chunk) of every chunk generated since the last call'''
+        done = [position for position, future in self.pending.items() if future.done()]
+        return [(position, self.pending.pop(position).result()) for position in done]
+
+    def prefetch(self, area:pygame.Rect, velocity:'Vector', distance:int)->None:
+        '''Request the chunks of `area` (in chunk coordinates) and the ones up to `distance`
+        chunks past it in the direction of `velocity`'''
+        ahead = area.move(distance * ((velocity.x > 0) - (velocity.x < 0)),
+                          distance * ((velocity.y > 0) - (velocity.y < 0)))
+        ahead.union_ip(area)
+        for chunk_y in range(ahead.top, ahead.bottom):
+            for chunk_x in range(ahead.left, ahead.right):
+                self.request(chunk_x, chunk_y)
+
+    def shutdown(self)->None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        self.pending.clear()
+
+
+# chunk storage
+class ChunkStore(object):
+    '''Chunks keyed by (chunk_x, chunk_y), with at most `max_chunks` chunks (or `max_bytes`)
+    kept in memory. `trim` writes the chunks furthest from a position to region files in
+    `path` (one file per `region_size` x `region_size` chunks, holding a fixed size record
+    per chunk) and `load` reads them back, so chunks come back as they were left.
+    * record_size: number of bytes of an encoded chunk
+    * encode: function(chunk) returning `record_size` bytes
+    * decode: function(chunk_x, chunk_y, data) returning a chunk
+    * sizeof: function(chunk) returning the memory used by a chunk, for `max_bytes`'''
+
+    def __init__(self, path:str, record_size:int, encode, decode, max_chunks:int=None,
+                 max_bytes:int=None, sizeof=None, region_size:int=16):
+        self.path = path
+        self.record_size = record_size
+        self.encode = encode
+        self.decode = decode
+        self.max_chunks = max_chunks
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof if sizeof is not None else (lambda chunk: record_size)
+        self.region_size = region_size
+        self.chunks:Dict[Tuple[int,int],Any] = {}
+        self.size = 0
+        os.makedirs(path, exist_ok=True)
+
+    def __contains__(self, position:Tuple[int,int])->bool:
+        return position in self.chunks
+
+    def __getitem__(self, position:Tuple[int,int])->Any:
+        return self.chunks[position]
+
+    def get(self, position:Tuple[int,int], default:Any=None)->Any:
+        return self.chunks.get(position, default)
+
+    def __setitem__(self, position:Tuple[int,int], chunk:Any):
+        if position in self.chunks:
+            self.size -= self.sizeof(self.chunks[position])
+        self.chunks[position] = chunk
+        self.size += self.sizeof(chunk)
+
+    def __len__(self)->int:
+        return len(self.chunks)
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def items(self):
+        return self.chunks.items()
+
+    def values(self):
+        return self.chunks.values()
+
+    def region(self, position:Tuple[int,int])->Tuple[str,int]:
+        '''return: (region file path, offset of the chunk record in it)'''
+        size = self.region_size
+        region_x, slot_x = divmod(position[0], size)
+        region_y, slot_y = divmod(position[1], size)
+        path = os.path.join(self.path, f'r.{region_x}.{region_y}.bin')
+        return path, (slot_y * size + slot_x) * (self.record_size + 1)
+
+    def write(self, position:Tuple[int,int], chunk:Any)->None:
+        '''Save a chunk to its region file'''
+        path, offset = self.region(position)
+        data = self.encode(chunk)
+        if len(data) != self.record_size:
+            raise ValueError(f'encoded chunk is {len(data)} bytes, expected {self.record_size}')
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.truncate(self.region_size * self.region_size * (self.record_size + 1))
+        with open(path, 'r+b') as f:
+            f.seek(offset)
+            f.write(b'\x01' + data)
+
+    def load(self, chunk_x:int, chunk_y:int)->Any:
+        '''return: the chunk saved on disk, None if it never was.
+        Does not make the chunk resident, safe to call from worker threads.'''
+        path, offset = self.region((chunk_x, chunk_y))
+        try:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                record = f.read(self.record_size + 1)
+        except FileNotFoundError:
+            return None
+        if len(record) != self.record_size + 1 or record[0] != 1:
+            return None
+        return self.decode(chunk_x, chunk_y, record[1:])
+
+    def saved(self)->List[Tuple[int,int]]:
+        '''return: positions of the chunks saved on disk'''
+        positions = []
+        size = self.region_size
+        for name in sorted(os.listdir(self.path)):
+            parts = name.split('.')
+            if len(parts) != 4 or parts[0] != 'r' or parts[3] != 'bin':
+                continue
+            region_x, region_y = int(parts[1]), int(parts[2])
+            with open(os.path.join(self.path, name), 'rb') as f:
+                data = f.read()
+            flags = data[::self.record_size + 1]
+            for slot in range(min(len(flags), size * size)):
+                if flags[slot] == 1:
+                    slot_y, slot_x = divmod(slot, size)
+                    positions.append((region_x * size + slot_x, region_y * size + slot_y))
+        return positions
+
+    def evict(self, position:Tuple[int,int])->None:
+        '''Write a resident chunk to disk and drop it from memory'''
+        chunk = self.chunks.pop(position)
+        self.size -= self.sizeof(chunk)
+        self.write(position, chunk)
+
+    def over_budget(self)->bool:
+        return ((self.max_chunks is not None and len(self.chunks) > self.max_chunks) or
+                (self.max_bytes is not None and self.size > self.max_bytes))
+
+    def trim(self, chunk_x:int, chunk_y:int)->List[Tuple[int,int]]:
+        '''Evict the chunks furthest from (chunk_x, chunk_y) until within budget.
+        return: positions of the evicted chunks'''
+        if not self.over_budget():
+            return []
+        furthest = sorted(self.chunks, key=lambda position: max(abs(position[0] - chunk_x),
+                                                                abs(position[1] - chunk_y)))
+        evicted = []
+        while self.over_budget():
+            position = furthest.pop()
+            self.evict(position)
+            evicted.append(position)
+        return evicted
+
+    def flush(self)->None:
+        '''Save every resident chunk to disk, keeping it in memory'''
+        for position, chunk in self.chunks.items():
+            self.write(position, chunk)
+
+
 # animation stuff
 animation_database = {}
-animation_higher_database = {}
+animation_higher_database = {} # entity type -> action -> Animation
+
+
+class Animation(object):
+    '''Frames of an animation and their durations, one object shared by every entity playing
+    it (do not modify). Entities only count the ticks since they started it, see `frame_at`.
+    * frames: image id of each frame (in animation_database)
+    * durations: ticks during which each frame is shown
+    * tags: of entity_animations.txt, "loop" to start again after the last frame'''
+
+    def __init__(self, frames:List[Any], durations:List[int], tags:List[str]=()):
+        self.frames = tuple(frames)
+        self.ends = np.cumsum(durations, dtype=np.int64) # tick at which each frame ends
+        self.ends.flags.writeable = False
+        self.end_ticks = self.ends.tolist() # bisect on a list beats numpy for one lookup
+        self.length = self.end_ticks[-1] # in ticks
+        self.tags = tuple(tags)
+        self.loop = 'loop' in self.tags
+
+    def __len__(self)->int:
+        return self.length
+
+    def wrap(self, tick:int)->int:
+        '''return: `tick` brought back into the animation, looping or held on the last frame'''
+        if self.loop:
+            return tick % self.length
+        return min(max(tick, 0), self.length - 1)
+
+    def frame_at(self, tick:int)->Any:
+        '''return: image id shown `tick` ticks after the start (0 <= tick < length)'''
+        return self.frames[bisect_right(self.end_ticks, tick)]
+
  
 # a sequence looks like [[0,1],[1,1],[2,1],[3,1],[4,2]]
 # the first numbers are the image name(as integer), while the second number shows the duration of it in the sequence
-def animation_sequence(sequence,base_path,colorkey=(255,255,255),transparency=255):
+# images: already loaded images by file path (see load_animations), the others are loaded from disk
+def animation_sequence(sequence,base_path,colorkey=(255,255,255),transparency=255,images=None,tags=())->Animation:
     global animation_database
-    result = []
+    frames = []
+    durations = []
     for frame in sequence:
         image_id = base_path + base_path.split('/')[-2] + '_' + str(frame[0])
-        image = pygame.image.load(image_id + '.png').convert()
+        if images is not None and image_id + '.png' in images:
+            image = images[image_id + '.png']
+        else:
+            image = pygame.image.load(image_id + '.png').convert()
         image.set_colorkey(colorkey)
         image.set_alpha(transparency)
-        animation_database[image_id] = image.copy()
-        for i in range(frame[1]):
-            result.append(image_id)
-    return result
+        animation_database[image_id] = image
+        frames.append(image_id)
+        durations.append(frame[1])
+    return Animation(frames, durations, tags)
  
  
 def get_frame(ID):
     global animation_database
     return animation_database[ID]
  
-def load_animations(path):
-    global animation_higher_database, e_colorkey
+def read_animations(path)->List[Tuple[str,str,str,List[List[int]],List[str]]]:
+    '''return: (entity type, animation id, animation path, sequence, tags)
+    for each line of `path`/entity_animations.txt'''
     f = open(path + 'entity_animations.txt','r')
     data = f.read()
     f.close()
+    animations = []
     for animation in data.split('\n'):
+        if not animation.strip():
+            continue
         sections = animation.split(' ')
         anim_path = sections[0]
         entity_info = anim_path.split('/')
@@ -310,10 +1424,94 @@ def load_animations(path):
         for timing in timings:
             sequence.append([n,int(timing)])
             n += 1
-        anim = animation_sequence(sequence,path + anim_path,e_colorkey)
+        animations.append((entity_type, animation_id, anim_path, sequence, tags))
+    return animations
+
+def animation_image_paths(path)->List[str]:
+    '''return: file paths of every frame listed in `path`/entity_animations.txt'''
+    paths = []
+    for entity_type, animation_id, anim_path, sequence, tags in read_animations(path):
+        base_path = path + anim_path
+        for frame in sequence:
+            paths.append(base_path + base_path.split('/')[-2] + '_' + str(frame[0]) + '.png')
+    return paths
+
+def load_animations(path, images=None):
+    '''* images: already loaded frames by file path, the others are loaded from disk'''
+    global animation_higher_database, e_colorkey
+    for entity_type, animation_id, anim_path, sequence, tags in read_animations(path):
+        animation = animation_sequence(sequence,path + anim_path,e_colorkey,images=images,tags=tags)
         if entity_type not in animation_higher_database:
             animation_higher_database[entity_type] = {}
-        animation_higher_database[entity_type][animation_id] = [anim.copy(),tags]
+        animation_higher_database[entity_type][animation_id] = animation
+
+# texture atlas
+class TextureAtlas(object):
+    '''Images packed into one converted surface (rows of images, tallest first).
+    Each image gets a small integer id, in the order of `images`, mapping to its area
+    of the atlas so that any of them can be drawn with an area blit of one source.
+    Transparent pixels of the images become `colorkey` (the global colorkey by default).'''
+
+    def __init__(self, images:Dict[Any,pygame.Surface], width:int=256, colorkey=None):
+        global e_colorkey
+        colorkey = e_colorkey if colorkey is None else colorkey
+        self.ids:Dict[Any,int] = {}
+        self.names:List[Any] = []
+        self.rects:List[pygame.Rect] = []
+        width = max([width] + [image.get_width() for image in images.values()])
+        areas = {}
+        x = y = row_height = 0
+        for name in sorted(images, key=lambda name: -images[name].get_height()):
+            image_width, image_height = images[name].get_size()
+            if x + image_width > width:
+                x = 0
+                y += row_height
+                row_height = 0
+            areas[name] = pygame.Rect(x, y, image_width, image_height)
+            x += image_width
+            row_height = max(row_height, image_height)
+        self.surface = pygame.Surface((width, max(1, y + row_height))).convert()
+        self.surface.fill(colorkey)
+        self.surface.set_colorkey(colorkey)
+        for name, image in images.items():
+            self.surface.blit(image, areas[name])
+            self.ids[name] = len(self.rects)
+            self.names.append(name)
+            self.rects.append(areas[name])
+
+    def __getitem__(self, name:Any)->int:
+        return self.ids[name]
+
+    def __contains__(self, name:Any)->bool:
+        return name in self.ids
+
+    def image(self, frame:int)->pygame.Surface:
+        '''return: subsurface of the atlas (sharing its pixels) for image id `frame`'''
+        return self.surface.subsurface(self.rects[frame])
+
+    def blit(self, surface:pygame.Surface, frame:int, pos:Tuple[int,int])->None:
+        surface.blit(self.surface, pos, self.rects[frame])
+
+    def blits(self, surface:pygame.Surface, frames:List[Tuple[int,Tuple[int,int]]])->None:
+        '''Draw many (image id, position) with one call'''
+        source = self.surface
+        rects = self.rects
+        surface.blits([(source, pos, rects[frame]) for frame, pos in frames], doreturn=False)
+
+
+global texture_atlas
+texture_atlas = None
+
+def build_atlas(images:Dict[Any,pygame.Surface]=None)->TextureAtlas:
+    '''Pack every loaded animation frame and `images` into the global texture atlas.
+    The animation frames are replaced by subsurfaces of the atlas.'''
+    global texture_atlas, animation_database
+    all_images = dict(animation_database)
+    all_images.update(images or {})
+    texture_atlas = TextureAtlas(all_images)
+    for image_id in animation_database:
+        animation_database[image_id] = texture_atlas.image(texture_atlas[image_id])
+    return texture_atlas
 
 # particles
 
@@ -330,19 +1528,31 @@ def particle_file_sort(l):
 global particle_images
 particle_images = {}
 
-def load_particle_images(path):
+def particle_image_paths(path)->Dict[str,List[str]]:
+    '''return: file paths of the frames of each particle type (folder of `path`)'''
+    paths = {}
+    for folder in os.listdir(path):
+        try:
+            img_list = particle_file_sort(os.listdir(path + '/' + folder))
+        except:
+            continue
+        paths[folder] = [path + '/' + folder + '/' + img for img in img_list]
+    return paths
+
+def load_particle_images(path, images=None):
+    '''* images: already loaded frames by file path, the others are loaded from disk'''
     global particle_images, e_colorkey
-    file_list = os.listdir(path)
-    for folder in file_list:
+    for folder, img_paths in particle_image_paths(path).items():
         try:
-            img_list = os.listdir(path + '/' + folder)
-            img_list = particle_file_sort(img_list)
-            images = []
-            for img in img_list:
-                images.append(pygame.image.load(path + '/' + folder + '/' + img).convert())
-            for img in images:
+            frames = []
+            for img_path in img_paths:
+                if images is not None and img_path in images:
+                    frames.append(images[img_path])
+                else:
+                    frames.append(pygame.image.load(img_path).convert())
+            for img in frames:
                 img.set_colorkey(e_colorkey)
-            particle_images[folder] = images.copy()
+            particle_images[folder] = frames
         except:
             pass
 
@@ -377,6 +1587,89 @@ class Particle(object):
         return running
         
 
+class ParticleSystem(object):
+    '''Particles stored in arrays and updated all at once, for large amounts of particles.
+    Takes the same parameters as `Particle`. Dead particles are removed by moving the
+    live ones to the front of the arrays, which are reused and grown when full.'''
+
+    def __init__(self, capacity:int=1024):
+        self.count = 0
+        self.position = np.zeros((capacity, 2))
+        self.motion = np.zeros((capacity, 2))
+        self.frame = np.zeros(capacity)
+        self.decay_rate = np.zeros(capacity)
+        self.last_frame = np.zeros(capacity, dtype=np.int32) # index of the last frame of the type
+        self.sprite_offset = np.zeros(capacity, dtype=np.int32) # index of frame 0 in `sprites`
+        # frames of every (type, color) in use, recolored once
+        self.offsets:Dict[Tuple[str,Tuple[int,int,int]],int] = {}
+        self.sprites:List[pygame.Surface] = []
+        self.half_sizes = np.zeros((0, 2), dtype=np.int32)
+
+    def __len__(self)->int:
+        return self.count
+
+    def get_offset(self, particle_type:str, color:Tuple[int,int,int])->int:
+        global particle_images
+        key = (particle_type, None if color is None else tuple(color))
+        offset = self.offsets.get(key)
+        if offset is None:
+            offset = self.offsets[key] = len(self.sprites)
+            frames = particle_images[particle_type]
+            if color is not None:
+                frames = [swap_color(img, (255,255,255), color) for img in frames]
+            self.sprites.extend(frames)
+            half_sizes = [(int(img.get_width()/2), int(img.get_height()/2)) for img in frames]
+            self.half_sizes = np.concatenate([self.half_sizes, np.array(half_sizes, dtype=np.int32)])
+        return offset
+
+    def grow(self)->None:
+        capacity = len(self.frame) * 2
+        for name in ('position', 'motion', 'frame', 'decay_rate', 'last_frame', 'sprite_offset'):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+
+    def add(self,x,y,particle_type,motion,decay_rate,start_frame,custom_color=None)->None:
+        global particle_images
+        if self.count == len(self.frame):
+            self.grow()
+        i = self.count
+        self.position[i] = (x, y)
+        self.motion[i] = motion
+        self.frame[i] = start_frame
+        self.decay_rate[i] = decay_rate
+        self.last_frame[i] = len(particle_images[particle_type])-1
+        self.sprite_offset[i] = self.get_offset(particle_type, custom_color)
+        self.count += 1
+
+    def update(self)->None:
+        '''Advance every particle by one step and remove the ones past their last frame'''
+        n = self.count
+        self.frame[:n] += self.decay_rate[:n]
+        self.position[:n] += self.motion[:n]
+        alive = self.frame[:n] <= self.last_frame[:n]
+        if not alive.all():
+            keep = np.flatnonzero(alive)
+            self.count = len(keep)
+            for array in (self.position, self.motion, self.frame, self.decay_rate,
+                          self.last_frame, self.sprite_offset):
+                array[:self.count] = array[keep]
+
+    def draw(self, surface:pygame.Surface, scroll)->None:
+        n = self.count
+        if not n:
+            return
+        frames = np.minimum(self.frame[:n].astype(np.int32), self.last_frame[:n])
+        sprite_ids = self.sprite_offset[:n] + frames
+        destinations = (self.position[:n] - (scroll[0], scroll[1]) - self.half_sizes[sprite_ids]).astype(np.int32)
+        sprites = self.sprites
+        surface.blits(zip([sprites[i] for i in sprite_ids.tolist()], destinations.tolist()), doreturn=False)
+
+    def clear(self)->None:
+        self.count = 0
+
+
 # other useful functions
 def swap_color(img:pygame.Surface, old_c:Tuple[int,int,int], new_c:Tuple[int,int,int])->None:
     '''
@@ -0,0 +1,340 @@
+from typing import Any, Dict, List, Set, Tuple
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import heapq, math
+import numpy as np
+
+
+# kinds of links between two nodes of a NavGraph
+WALK = 0
+JUMP = 1
+FALL = 2
+
+# (target node, cost in ticks, kind, horizontal velocity)
+Link = Tuple[Tuple[int,int],float,int,float]
+
+
+class NavGraph(object):
+    '''Platformer navigation graph over a chunked tile map.
+    Nodes are the tiles an entity can stand in, as world tile coordinates (x, y): empty tiles
+    above a solid one. Links walk to a neighbour, fall off a ledge or jump, as found by
+    simulating the entity's physics from the tile (the arcs are computed once, see
+    `trajectories`). Only the chunks added with `add_chunk` are known, links crossing into
+    unknown chunks are made once they are added.
+    The links of a chunk are rebuilt by `update` once it or a neighbour was added or removed
+    (chunks streamed in together are only built once, the ones far from the entities only
+    when they come near) and never modified afterwards, so `find_path` can run on other threads.
+    * chunk_size: tiles per chunk side
+    * size: (width, height) of the entity in pixels
+    * run_speed: horizontal speed (pixels per tick), arcs are also computed at half speed
+    * jump_speed, gravity, max_fall_speed: as the physics of the entity
+    * max_drop: furthest fall followed, in tiles (at most `chunk_size`)'''
+
+    def __init__(self, chunk_size:int, tile_size:int=16, size:Tuple[int,int]=(5,13), run_speed:float=2,
+                 jump_speed:float=5, gravity:float=0.2, max_fall_speed:float=3, max_drop:int=None):
+        self.chunk_size = chunk_size
+        self.tile_size = tile_size
+        self.size = size
+        self.run_speed = run_speed
+        self.jump_speed = jump_speed
+        self.gravity = gravity
+        self.max_fall_speed = max_fall_speed
+        self.max_drop = min(max_drop or chunk_size, chunk_size)
+        self.solid:Dict[Tuple[int,int],np.ndarray] = {} # chunk position -> solid tiles [row, column]
+        self.chunks:Dict[Tuple[int,int],Dict[Tuple[int,int],Tuple[Link,...]]] = {} # node -> links
+        self.dirty = set() # chunks to build on next update
+        self.version = 0 # changed by every update building chunks
+        self.clearance = -(-size[1] // tile_size) # empty tiles needed above the ground
+        # (kind, horizontal velocity, ticks to reach the start of the arc from the tile center, events)
+        self.trajectories:List[Tuple[int,float,float,List]] = []
+        for direction in (1, -1):
+            for speed in (run_speed / 2, run_speed):
+                velocity = direction * speed
+                # jump from the edge of the tile, fall once past it
+                edge = tile_size - size[0] if direction > 0 else 0
+                past = tile_size if direction > 0 else -size[0]
+                self.trajectories.append((JUMP, velocity, (tile_size - size[0]) / 2 / speed,
+                                          self.trajectory(edge, velocity, -jump_speed)))
+                self.trajectories.append((FALL, velocity, (tile_size + size[0]) / 2 / speed,
+                                          self.trajectory(past, velocity, 0)))
+
+    def trajectory(self, x:float, velocity_x:float, velocity_y:float)->List[Tuple]:
+        '''Simulate an arc from the tile (0, 0), the feet of the entity on the tile below.
+        return: events (tick, tiles first touched, falling, bottom row, center column),
+        the tiles being (column, row) relative to the starting tile'''
+        tile_size = self.tile_size
+        width, height = self.size
+        y = tile_size - height
+        reach = self.chunk_size
+        seen = set()
+        events = []
+        tick = 0
+        while True:
+            left = math.floor(x)
+            top = math.floor(y)
+            bottom = (top + height - 1) // tile_size
+            tiles = {(column, row) for column in range(left // tile_size, (left + width - 1) // tile_size + 1)
+                     for row in range(top // tile_size, bottom + 1)}
+            new = tiles - seen
+            if new:
+                events.append((tick, tuple(sorted(new)), velocity_y > 0 and tick > 0, bottom,
+                               math.floor(x + width / 2) // tile_size))
+            seen |= tiles
+            if bottom > self.max_drop or abs(left // tile_size) >= reach:
+                return events
+            # as Physics_obj: move, then gravity
+            x += velocity_x
+            y += velocity_y
+            velocity_y = min(velocity_y + self.gravity, self.max_fall_speed)
+            tick += 1
+
+    def add_chunk(self, position:Tuple[int,int], solid:np.ndarray)->None:
+        '''Add a chunk, then link it with its neighbours.
+        * solid: chunk_size x chunk_size booleans, indexed [row, column]'''
+        self.solid[position] = solid
+        self.patch(position)
+
+    def remove_chunk(self, position:Tuple[int,int])->None:
+        '''Forget a chunk and the links of its neighbours leading into it'''
+        if self.solid.pop(position, None) is not None:
+            if self.chunks.pop(position, None) is not None:
+                self.version += 1
+            self.dirty.discard(position)
+            self.patch(position)
+
+    def __contains__(self, position:Tuple[int,int])->bool:
+        return position in self.chunks
+
+    def patch(self, position:Tuple[int,int])->None:
+        '''Rebuild the links of the chunks around `position` on next update'''
+        chunk_x, chunk_y = position
+        for y in range(chunk_y - 1, chunk_y + 2):
+            for x in range(chunk_x - 1, chunk_x + 2):
+                if (x, y) in self.solid:
+                    self.dirty.add((x, y))
+
+    def update(self, max_chunks:int=None, near:Set[Tuple[int,int]]=None)->int:
+        '''Build the chunks changed since the last call.
+        * max_chunks: chunks built at most, the others are left for the next calls
+        * near: positions of the chunks to build (e.g. around the entities looking for paths),
+          the others are left until they are near or `update` is called without `near`
+        return: number of chunks built'''
+        if not self.dirty:
+            return 0
+        waiting = self.dirty if near is None else self.dirty & near
+        built = 0
+        while waiting and (max_chunks is None or built < max_chunks):
+            position = waiting.pop()
+            self.dirty.discard(position)
+            self.chunks[position] = self.build_chunk(position)
+            built += 1
+        if built:
+            self.version += 1
+        return built
+
+    def build_chunk(self, position:Tuple[int,int])->Dict[Tuple[int,int],Tuple[Link,...]]:
+        '''return: links of the nodes of a chunk, from the tiles of the 3x3 chunks around it'''
+        size = self.chunk_size
+        chunk_x, chunk_y = position
+        tiles = self.solid[position]
+        below = self.solid.get((chunk_x, chunk_y + 1))
+        if not ((~tiles[:-1] & tiles[1:]).any() or (below is not None and (~tiles[-1] & below[0]).any())):
+            return {} # no ground to stand on
+        solid = np.ones((3*size, 3*size), dtype=bool) # unknown tiles block
+        known = np.zeros((3*size, 3*size), dtype=bool)
+        for y in range(3):
+            for x in range(3):
+                tiles = self.solid.get((chunk_x + x - 1, chunk_y + y - 1))
+                if tiles is not None:
+                    solid[y*size:(y+1)*size, x*size:(x+1)*size] = tiles
+                    known[y*size:(y+1)*size, x*size:(x+1)*size] = True
+        standable = known & ~solid
+        for row in range(1, self.clearance):
+            standable[row:] &= known[:-row] & ~solid[:-row]
+            standable[:row] = False
+        standable[:-1] &= known[1:] & solid[1:]
+        standable[-1] = False
+        rows, columns = np.nonzero(standable[size:2*size, size:2*size])
+        solid = solid.tolist()
+        known = known.tolist()
+        standable = standable.tolist()
+        walk_cost = self.tile_size / self.run_speed
+        origin_x = (chunk_x - 1) * size
+        origin_y = (chunk_y - 1) * size
+        links = {}
+        for row, column in zip((rows + size).tolist(), (columns + size).tolist()):
+            targets = {}
+            for offset in (-1, 1):
+                if 0 <= column + offset < 3*size and standable[row][column + offset]:
+                    targets[(column + offset, row)] = (walk_cost, WALK, offset * self.run_speed)
+            for kind, velocity, start, events in self.trajectories:
+                for tick, tiles, falling, bottom, center in events:
+                    blocked = []
+                    for x, y in tiles:
+                        x += column
+                        y += row
+                        if not (0 <= x < 3*size and 0 <= y < 3*size and known[y][x]):
+                            blocked = None
+                            break
+                        if solid[y][x]:
+                            blocked.append((x, y))
+                    if blocked is None:
+                        break # leaves the known tiles
+                    if blocked:
+                        if falling and all(y == row + bottom for x, y in blocked):
+                            # landed, standing over the ground tile closest to the center
+                            ground = min(blocked, key=lambda tile: abs(tile[0] - column - center))
+                            target = (ground[0], ground[1] - 1)
+                            cost = start + tick
+                            if (standable[target[1]][target[0]] and target != (column, row) and
+                                    (kind == JUMP or target[1] > row) and
+                                    (target not in targets or targets[target][0] > cost)):
+                                targets[target] = (cost, kind, velocity)
+                        break
+            links[(origin_x + column, origin_y + row)] = tuple(
+                ((origin_x + x, origin_y + y), cost, kind, velocity)
+                for (x, y), (cost, kind, velocity) in targets.items())
+        return links
+
+    def links(self, node:Tuple[int,int])->Tuple[Link,...]:
+        chunk = self.chunks.get((node[0] // self.chunk_size, node[1] // self.chunk_size))
+        if chunk is None:
+            return ()
+        return chunk.get(node, ())
+
+    def is_node(self, node:Tuple[int,int])->bool:
+        chunk = self.chunks.get((node[0] // self.chunk_size, node[1] // self.chunk_size))
+        return chunk is not None and node in chunk
+
+    def nearest_node(self, x:float, y:float)->Tuple[int,int]:
+        '''return: node under an entity whose rect is at (x, y) in pixels (standing or up to
+        `max_drop` tiles above the ground), None if there is none'''
+        tile_size = self.tile_size
+        column = int((x + self.size[0] / 2) // tile_size)
+        row = int((y + self.size[1] - 1) // tile_size)
+        for drop in range(self.max_drop + 1):
+            if self.is_node((column, row + drop)):
+                return (column, row + drop)
+        return None
+
+    def node_position(self, node:Tuple[int,int])->Tuple[float,float]:
+        '''return: position of the rect of an entity standing centered on a node'''
+        tile_size = self.tile_size
+        return ((node[0] + 0.5) * tile_size - self.size[0] / 2, (node[1] + 1) * tile_size - self.size[1])
+
+    def find_path(self, start:Tuple[int,int], goal:Tuple[int,int], max_nodes:int=4096,
+                  partial:bool=False)->List[Tuple[Tuple[int,int],int,float]]:
+        '''A* search from node `start` to node `goal`, at most `max_nodes` nodes are expanded.
+        * partial: when `goal` is not reached, return the path to the node closest to it
+        return: (node, kind of the link reaching it, horizontal velocity) from `start`
+        (with kind None) to `goal`, None when there is no path'''
+        ticks_per_tile = self.tile_size / self.run_speed
+        def estimate(node):
+            return abs(goal[0] - node[0]) * ticks_per_tile
+        came_from = {start: None}
+        costs = {start: 0}
+        queue = [(estimate(start), 0, start)]
+        order = 0
+        best = (estimate(start), start)
+        expanded = 0
+        while queue and expanded < max_nodes:
+            _, _, node = heapq.heappop(queue)
+            if node == goal:
+                break
+            expanded += 1
+            cost = costs[node]
+            for target, link_cost, kind, velocity in self.links(node):
+                new_cost = cost + link_cost
+                if new_cost < costs.get(target, math.inf):
+                    costs[target] = new_cost
+                    came_from[target] = (node, kind, velocity)
+                    order += 1
+                    heapq.heappush(queue, (new_cost + estimate(target), order, target))
+                    best = min(best, (estimate(target) + abs(goal[1] - target[1]), target))
+        end = goal
+        if goal not in came_from:
+            if not partial:
+                return None
+            end = best[1]
+        path = []
+        node = end
+        while True:
+            step = came_from[node]
+            if step is None:
+                path.append((node, None, 0))
+                break
+            path.append((node, step[1], step[2]))
+            node = step[0]
+        path.reverse()
+        return path
+
+
+class PathFinder(object):
+    '''Runs the A* searches of a NavGraph on a pool of workers, so that many entities can ask
+    for paths without stalling the game loop. Identical searches are only run once and
+    their results are kept until the graph changes.
+    * workers: number of threads, 0 to search in `request` (reproducible runs)
+    * max_nodes: nodes expanded at most per search, see NavGraph.find_path'''
+
+    def __init__(self, graph:NavGraph, workers:int=1, executor=None, max_nodes:int=4096, cache_size:int=256):
+        self.graph = graph
+        self.max_nodes = max_nodes
+        self.executor = executor
+        if executor is None and workers:
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending:Dict[Any,Future] = {} # requester -> search
+        self.searches:Dict[Tuple,Future] = {} # (start, goal) -> search running
+        self.cache:OrderedDict = OrderedDict() # (start, goal) -> path, for `cache_version`
+        self.cache_size = cache_size
+        self.cache_version = graph.version
+
+    def __len__(self)->int:
+        return len(self.pending)
+
+    def request(self, key:Any, start:Tuple[int,int], goal:Tuple[int,int])->None:
+        '''Search a path from node `start` to node `goal` (partial if `goal` cannot be reached),
+        returned by `collect` for `key`. Replaces the search of `key` if still running.'''
+        if self.cache_version != self.graph.version:
+            self.cache.clear()
+            self.searches.clear()
+            self.cache_version = self.graph.version
+        query = (start, goal)
+        if query in self.cache:
+            self.cache.move_to_end(query)
+            future = Future()
+            future.set_result(self.cache[query])
+        elif query in self.searches:
+            future = self.searches[query]
+        elif self.executor is None:
+            future = Future()
+            future.set_result(self.graph.find_path(start, goal, self.max_nodes, partial=True))
+        else:
+            future = self.searches[query] = self.executor.submit(self.graph.find_path, start, goal,
+                                                                 self.max_nodes, True)
+        future.query = query
+        self.pending[key] = future
+
+    def cancel(self, key:Any)->None:
+        self.pending.pop(key, None)
+
+    def collect(self)->List[Tuple[Any,List[Tuple[Tuple[int,int],int,float]]]]:
+        '''return: (key, path) of every search finished since the last call'''
+        done = [key for key, future in self.pending.items() if future.done()]
+        results = []
+        for key in done:
+            future = self.pending.pop(key)
+            path = future.result()
+            query = future.query
+            self.searches.pop(query, None)
+            if self.cache_version == self.graph.version:
+                self.cache[query] = path
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+            results.append((key, path))
+        return results
+
+    def shutdown(self)->None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        self.pending.clear()
+        self.searches.clear()
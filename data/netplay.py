@@ -0,0 +1,375 @@
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+from enum import IntEnum
+import argparse, math, struct, time
+import numpy as np
+
+from data.network import NO_TICK, LoopbackHost, SnapshotChannel, SnapshotReceiver, Transport, connect, listen
+from data.replay import Inputs
+
+
+NET_PORT = 5515 # port of --serve and --connect.
+NET_POSITION_SCALE = 8 # NPC positions are sent in 1/8 pixels.
+NET_VIEW_MARGIN = 1 # chunks around the view replicated to the clients (with the NPCs on them).
+NET_ACTIONS = ('idle', 'run') # entity actions replicated, sent as their index.
+NET_INPUT_REDUNDANCY = 16 # inputs not acknowledged yet repeated in every client packet, for the lost ones.
+NET_INPUT_BUFFER = 8 # inputs waiting on the server past which the oldest are skipped.
+NET_TIMEOUT = 5 # seconds without a packet after which the server drops a client.
+
+
+class NetMessage(IntEnum):
+    '''First byte of the packets between NetServer and NetClient'''
+    HELLO = 0 # client -> server, until welcomed
+    WELCOME = 1 # server -> client: WELCOME_PACKET
+    INPUTS = 2 # client -> server: INPUTS_PACKET then the input bits, oldest first
+    STATE = 3 # server -> client: STATE_PACKET then a SnapshotChannel message
+
+
+WELCOME_PACKET = struct.Struct('<BiB') # message, world seed, whether the client drives the player
+# message, SnapshotReceiver.acks (tick of the last state received, bits of the previous ones),
+# sequence number of the last input, number of inputs
+INPUTS_PACKET = struct.Struct('<BIIIB')
+# message, sequence of the last input applied, player_state (x, y, rect x, rect y, vertical momentum, air timer,
+# moving right | moving left << 1), player action (NET_ACTIONS index), animation frame, flip
+STATE_PACKET = struct.Struct('<BIddiidiBBHB')
+NPC_NET_FIELDS = 5 # values sent per NPC: x, y (in 1/NET_POSITION_SCALE pixels), action, animation frame, flip
+
+
+class RemoteClient(object):
+    def __init__(self, transport:Transport, controls:bool):
+        '''A client of a NetServer.
+        * controls: the client drives the player, the others watch'''
+        self.transport = transport
+        self.controls = controls
+        self.channel = SnapshotChannel(NPC_NET_FIELDS)
+        self.inputs:Dict[int,int] = {} # input bits by sequence number, not applied yet
+        self.applied = 0 # sequence number of the last input applied
+        self.held = Inputs() # last input applied
+        self.welcomed = False
+        self.silent = 0 # steps since the last packet
+        self.ticks = 0 # states sent
+
+    def next_inputs(self)->Inputs:
+        '''return: the inputs of the next tick, the keys held stay held when they are late'''
+        if len(self.inputs) > NET_INPUT_BUFFER:
+            # too far behind (the client stalled or all copies of an input were lost)
+            self.applied = sorted(self.inputs)[-NET_INPUT_BUFFER] - 1
+            self.inputs = {sequence: bits for sequence, bits in self.inputs.items() if sequence > self.applied}
+        bits = self.inputs.pop(self.applied + 1, None)
+        if bits is None:
+            inputs = self.held.copy()
+            inputs.clear_presses()
+            return inputs
+        self.applied += 1
+        self.held = Inputs.from_bits(bits)
+        return self.held
+
+
+class NetServer(object):
+    def __init__(self, world:Any, host:Any, tick_rate:int):
+        '''Runs the authoritative `world` (a main.World) for the clients of `host` (a UdpHost,
+        TcpHost or LoopbackHost of data.network), a tick per `step`. The first client drives the
+        player, the next ones watch. Each step sends every client the player state and what changed
+        around the view since the last state the client acknowledged (NPCs and chunks).
+        * tick_rate: steps per second, for NET_TIMEOUT'''
+        self.world = world
+        self.host = host
+        self.timeout = NET_TIMEOUT * tick_rate # steps
+        self.clients:List[RemoteClient] = []
+        self.gone:List[RemoteClient] = [] # disconnected, kept for their statistics
+        self.encode_times:List[float] = [] # seconds spent serializing the states of each step
+
+    def receive(self)->None:
+        for transport in self.host.accept():
+            self.clients.append(RemoteClient(transport, not any(client.controls for client in self.clients)))
+        for client in self.clients:
+            packets = client.transport.receive()
+            client.silent = 0 if packets else client.silent + 1
+            for packet in packets:
+                if packet[0] == NetMessage.HELLO:
+                    client.welcomed = True
+                    client.transport.send(WELCOME_PACKET.pack(NetMessage.WELCOME, self.world.seed, client.controls))
+                elif packet[0] == NetMessage.INPUTS:
+                    _, acked, received, last, count = INPUTS_PACKET.unpack_from(packet)
+                    if acked != NO_TICK:
+                        client.channel.ack(acked, received)
+                    inputs = packet[INPUTS_PACKET.size:INPUTS_PACKET.size + count]
+                    for sequence, bits in enumerate(inputs, last - count + 1):
+                        if sequence > client.applied:
+                            client.inputs[sequence] = bits
+
+    def replicated(self)->Tuple[np.ndarray,np.ndarray,Dict[Tuple[int,int],bytes]]:
+        '''return: ids and values (see NPC_NET_FIELDS) of the NPCs around the view, and its chunks encoded'''
+        world = self.world
+        area = world.view_chunks.inflate(2*NET_VIEW_MARGIN, 2*NET_VIEW_MARGIN)
+        chunks = {}
+        for chunk_y in range(area.top, area.bottom):
+            for chunk_x in range(area.left, area.right):
+                chunk = world.game_map.get((chunk_x, chunk_y))
+                if chunk is not None:
+                    chunks[(chunk_x, chunk_y)] = world.game_map.encode(chunk)
+        npcs = world.npcs
+        slots = world.npcs_on_chunks(area)
+        slots = slots[np.argsort(npcs.ids[slots], kind='stable')]
+        ids = npcs.ids[slots]
+        actions = np.array([NET_ACTIONS.index(action) if action in NET_ACTIONS else 0
+                            for _, action in npcs.animations], dtype=np.int32)
+        values = np.column_stack([np.round(npcs.position[slots] * NET_POSITION_SCALE),
+                                  actions[npcs.animation[slots]], npcs.frame[slots], npcs.flip[slots]])
+        return ids, values.astype(np.int32), chunks
+
+    def send(self)->None:
+        start = time.perf_counter()
+        world = self.world
+        player = world.player
+        ids, values, chunks = self.replicated()
+        x, y, rect_x, rect_y, momentum, air_timer, right, left = world.player_state()
+        action = NET_ACTIONS.index(player.action) if player.action in NET_ACTIONS else 0
+        messages = []
+        for client in self.clients:
+            if client.welcomed:
+                header = STATE_PACKET.pack(NetMessage.STATE, client.applied, x, y, rect_x, rect_y, momentum,
+                                           air_timer, right | left << 1, action, player.animation_frame, player.flip)
+                messages.append((client, header + client.channel.encode(world.tick, ids, values, chunks)))
+        self.encode_times.append(time.perf_counter() - start)
+        for client, message in messages:
+            client.transport.send(message)
+            client.ticks += 1
+
+    def step(self)->None:
+        '''Read the clients, step the world with the inputs of the one driving, send the states'''
+        self.receive()
+        driver = next((client for client in self.clients if client.controls), None)
+        self.world.step(driver.next_inputs() if driver else Inputs())
+        self.send()
+        for client in list(self.clients):
+            if client.transport.closed or client.silent > self.timeout:
+                client.transport.close()
+                self.clients.remove(client)
+                self.gone.append(client)
+
+    def close(self)->None:
+        for client in self.clients:
+            client.transport.close()
+        self.host.close()
+
+
+class NetClient(object):
+    def __init__(self, transport:Transport, make_world:Callable[...,Any]):
+        '''Plays on a NetServer through `transport`. The player moves at once by the local inputs
+        (predicted), then when the server state after an input arrives, the player is put back
+        there and the later inputs are replayed if the prediction was wrong (reconciliation).
+        The NPCs and the chunks around the view are the server's.
+        * make_world: function(seed, path_workers) returning the world to play in (a main.World)'''
+        self.transport = transport
+        self.make_world = make_world
+        self.world:Any = None # made once welcomed by the server, see `step`
+        self.controls = False
+        self.receiver = SnapshotReceiver()
+        self.sequence = 0 # of the last input
+        # (sequence, input bits, player_state predicted after it) of the inputs not acknowledged
+        self.pending:List[Tuple[int,int,Tuple]] = []
+        self.remote:Dict[int,int] = {} # NPC id on the server -> id in world.npcs
+        self.apply_times:List[float] = [] # seconds spent decoding and applying each state
+        self.stats:Dict[str,float] = {'states': 0, 'stale': 0, 'corrections': 0, 'max_error': 0}
+
+    def receive(self)->None:
+        for packet in self.transport.receive():
+            if packet[0] == NetMessage.WELCOME and self.world is None:
+                _, seed, controls = WELCOME_PACKET.unpack(packet)
+                self.world = self.make_world(seed, path_workers=0)
+                self.controls = bool(controls)
+            elif packet[0] == NetMessage.STATE and self.world is not None:
+                self.apply_state(packet)
+
+    def apply_state(self, packet:bytes)->None:
+        start = time.perf_counter()
+        _, sequence, x, y, rect_x, rect_y, momentum, air_timer, moving, action, frame, flip = \
+            STATE_PACKET.unpack_from(packet)
+        decoded = self.receiver.decode(packet[STATE_PACKET.size:])
+        if decoded is None:
+            self.stats['stale'] += 1 # older than a state applied
+            return
+        snapshot, chunks = decoded
+        world = self.world
+        for (chunk_x, chunk_y), data in chunks:
+            chunk = world.game_map.decode(chunk_x, chunk_y, data)
+            current = world.game_map.get((chunk_x, chunk_y))
+            if current is None or not np.array_equal(current.tiles, chunk.tiles):
+                world.set_chunk(chunk)
+        self.apply_npcs(snapshot.ids, snapshot.values)
+        state = (x, y, rect_x, rect_y, momentum, air_timer, bool(moving & 1), bool(moving & 2))
+        if self.controls:
+            self.reconcile(sequence, state)
+        else:
+            world.set_player_state(state)
+            world.player.set_action(NET_ACTIONS[action])
+            world.player.set_frame(frame)
+            world.player.set_flip(bool(flip))
+        self.apply_times.append(time.perf_counter() - start)
+        self.stats['states'] += 1
+
+    def apply_npcs(self, ids:np.ndarray, values:np.ndarray)->None:
+        '''Make the NPCs of the world the ones of a snapshot'''
+        npcs = self.world.npcs
+        remote = self.remote
+        positions = values[:, :2] / NET_POSITION_SCALE
+        seen = set(ids.tolist())
+        for server_id in [server_id for server_id in remote if server_id not in seen]:
+            npcs.remove(remote.pop(server_id))
+        for server_id, (x, y) in zip(ids.tolist(), positions.tolist()):
+            if server_id not in remote:
+                remote[server_id] = self.world.add_npc(x, y)
+        if not len(ids):
+            return
+        slots = np.array([npcs.index(remote[server_id]) for server_id in ids.tolist()])
+        animations = np.array([[npcs.get_animation(e_type, action) for action in NET_ACTIONS] for e_type in npcs.types])
+        npcs.position[slots] = positions
+        npcs.animation[slots] = animations[npcs.type[slots], values[:, 2]]
+        npcs.frame[slots] = values[:, 3]
+        npcs.flip[slots] = values[:, 4] != 0
+
+    def reconcile(self, sequence:int, state:Tuple)->None:
+        '''Compare the server `state` of the player after input `sequence` with the prediction.
+        When they differ, start again from it and replay the inputs sent since.'''
+        pending = self.pending
+        while pending and pending[0][0] < sequence:
+            pending.pop(0)
+        if pending and pending[0][0] == sequence:
+            predicted = pending.pop(0)[2]
+        elif not pending:
+            predicted = self.world.player_state()
+        else:
+            predicted = None # the server stepped without input after `sequence`: already corrected
+        if predicted == state:
+            return
+        if predicted is not None:
+            error = math.hypot(predicted[0] - state[0], predicted[1] - state[1])
+            self.stats['max_error'] = max(self.stats['max_error'], error)
+        self.stats['corrections'] += 1
+        world = self.world
+        sounds = list(world.sound_events)
+        world.set_player_state(state)
+        for index, (later, bits, _) in enumerate(pending):
+            world.apply_inputs(Inputs.from_bits(bits))
+            world.move_player()
+            pending[index] = (later, bits, world.player_state())
+        world.sound_events[:] = sounds # already played
+
+    def step(self, inputs:Inputs)->None:
+        '''Apply what the server sent, move the player by `inputs` and send them.
+        Until the server welcomes the client, only say hello.'''
+        if self.world is not None:
+            self.world.sound_events.clear()
+            if self.world.renderer is None:
+                self.world.changed_chunks.clear()
+        self.receive()
+        world = self.world
+        if world is None:
+            self.transport.send(bytes([NetMessage.HELLO]))
+            return
+        if self.controls:
+            self.sequence += 1
+            world.apply_inputs(inputs)
+        world.update_camera()
+        world.update_chunks()
+        if self.controls:
+            world.move_player()
+            self.pending.append((self.sequence, inputs.bits(), world.player_state()))
+        world.tick += 1
+        unacknowledged = self.pending[-NET_INPUT_REDUNDANCY:]
+        self.transport.send(INPUTS_PACKET.pack(NetMessage.INPUTS, *self.receiver.acks(), self.sequence,
+                                               len(unacknowledged)) +
+                            bytes(bits for _, bits, _ in unacknowledged))
+
+    def close(self)->None:
+        self.transport.close()
+        if self.world is not None:
+            self.world.close()
+
+
+def paced(ticks:int, tick_rate:int)->Iterator[int]:
+    '''Count up to `ticks`, `tick_rate` counts per second (late counts are not caught up)'''
+    tick_time = 1 / tick_rate
+    deadline = time.perf_counter()
+    for tick in range(ticks):
+        yield tick
+        deadline += tick_time
+        now = time.perf_counter()
+        if now < deadline:
+            time.sleep(deadline - now)
+        else:
+            deadline = now
+
+
+def percentiles_ms(times:List[float])->str:
+    ordered = sorted(times) or [0]
+    return (f'p50 {ordered[len(ordered)//2]*1000:.3f}ms  '
+            f'p99 {ordered[min(len(ordered)-1, int(len(ordered)*0.99))]*1000:.3f}ms')
+
+
+def print_server_stats(server:NetServer, tick_rate:int)->None:
+    for index, client in enumerate(server.gone + server.clients):
+        stats = client.transport.stats
+        seconds = max(client.ticks, 1) / tick_rate
+        channel = client.channel.stats
+        print(f'client {index} ({"player" if client.controls else "watching"}): '
+              f'{stats["bytes_sent"]/seconds/1024:.2f} kB/s sent '
+              f'({stats["bytes_sent"]/max(stats["packets_sent"], 1):.0f} B per packet, '
+              f'{channel["full"]} full states, {channel["chunks"]} chunks, {channel["rows"]} NPC updates), '
+              f'{stats["bytes_received"]/seconds/1024:.2f} kB/s received')
+    print(f'state serialization per tick: {percentiles_ms(server.encode_times)}')
+
+
+def print_client_stats(client:NetClient)->None:
+    stats = client.stats
+    print(f'client: {stats["states"]} states applied ({stats["stale"]} stale), {percentiles_ms(client.apply_times)}; '
+          f'{stats["corrections"]} corrections (largest {stats["max_error"]:.1f} px), '
+          f'{len(client.pending)} inputs waiting for the server')
+
+
+def run_network(args:argparse.Namespace, make_world:Callable[...,Any], play:Callable[[Any,Callable],None],
+                script:Iterator[Inputs], tick_rate:int)->None:
+    '''--serve, --connect and --net-test of main.py
+    * make_world: function(seed, path_workers=...) returning a main.World
+    * play: function(world, step) running the game window on `world`, calling step(inputs) every tick
+    * script: inputs of the --headless client, a tick each'''
+    if args.connect:
+        client = NetClient(connect(args.protocol, args.connect, args.port), make_world)
+        for _ in paced(NET_TIMEOUT * tick_rate, tick_rate):
+            client.step(Inputs())
+            if client.world is not None:
+                break
+        else:
+            raise SystemExit(f'no answer from {args.protocol} server {args.connect}:{args.port}')
+        if args.headless:
+            for inputs, _ in zip(script, paced(args.ticks, tick_rate)):
+                client.step(inputs)
+        else:
+            play(client.world, client.step)
+        print_client_stats(client)
+        print(f'received {client.transport.stats["bytes_received"]/1024:.1f} kB, '
+              f'sent {client.transport.stats["bytes_sent"]/1024:.1f} kB')
+        client.close()
+        return
+
+    world = make_world(args.seed)
+    world.spawn_npcs(args.npcs)
+    if args.serve:
+        server = NetServer(world, listen(args.protocol, '127.0.0.1', args.port), tick_rate)
+        print(f'serving on {args.protocol} port {args.port} for {args.ticks} ticks')
+        for _ in paced(args.ticks, tick_rate):
+            server.step()
+        print_server_stats(server, tick_rate)
+    else:
+        # both ends in this process, the link simulated in ticks so that runs do not depend on the machine
+        host = LoopbackHost(args.latency / 1000, args.loss, lambda: world.tick / tick_rate, seed=args.seed)
+        server = NetServer(world, host, tick_rate)
+        client = NetClient(host.connect(), make_world)
+        for inputs in script:
+            client.step(inputs)
+            server.step()
+        print_server_stats(server, tick_rate)
+        print_client_stats(client)
+        client.close()
+    server.close()
+    world.close()
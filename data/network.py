@@ -0,0 +1,492 @@
+from typing import Dict, List, Tuple
+import random, socket, struct, time, zlib
+import numpy as np
+
+
+NO_TICK = 0xffffffff # tick field of a message when there is no tick to give
+MAX_DATAGRAM = 65507 # largest UDP payload
+FRAME = struct.Struct('<I') # length of a message sent over TCP
+# snapshot message: tick, baseline tick, removed rows, changed rows, fields per row, chunks
+DELTA_HEADER = struct.Struct('<IIIIBH')
+CHUNK_HEADER = struct.Struct('<iiH') # chunk x, chunk y, payload size
+
+
+class Transport(object):
+    '''Messages to and from one peer. `send` never blocks, `receive` returns the messages
+    arrived since the last call. The traffic is counted in `stats`.'''
+
+    def __init__(self):
+        self.closed = False
+        self.stats:Dict[str,int] = {'bytes_sent': 0, 'packets_sent': 0, 'bytes_received': 0, 'packets_received': 0}
+
+    def count_sent(self, size:int)->None:
+        self.stats['bytes_sent'] += size
+        self.stats['packets_sent'] += 1
+
+    def count_received(self, messages:List[bytes])->List[bytes]:
+        self.stats['bytes_received'] += sum(len(message) for message in messages)
+        self.stats['packets_received'] += len(messages)
+        return messages
+
+    def send(self, data:bytes)->None:
+        raise NotImplementedError
+
+    def receive(self)->List[bytes]:
+        raise NotImplementedError
+
+    def close(self)->None:
+        self.closed = True
+
+
+class LoopbackTransport(Transport):
+    '''In-memory stand-in for a socket, see `pair`. Messages arrive `latency` seconds
+    after being sent, a `loss` fraction of them never do (as UDP datagrams).
+    * clock: function returning the time in seconds (e.g. ticks / tick rate for runs
+      that do not depend on the machine speed)'''
+
+    def __init__(self, latency:float=0, loss:float=0, clock=time.perf_counter, seed:int=None):
+        super().__init__()
+        self.latency = latency
+        self.loss = loss
+        self.clock = clock
+        self.rng = random.Random(seed)
+        self.peer:LoopbackTransport = None
+        self.inbox:List[Tuple[float,bytes]] = [] # (arrival time, message), in order
+
+    @classmethod
+    def pair(cls, latency:float=0, loss:float=0, clock=time.perf_counter,
+             seed:int=None)->Tuple['LoopbackTransport','LoopbackTransport']:
+        '''return: two transports connected to each other'''
+        first = cls(latency, loss, clock, seed)
+        second = cls(latency, loss, clock, None if seed is None else seed + 1)
+        first.peer, second.peer = second, first
+        return first, second
+
+    def send(self, data:bytes)->None:
+        self.count_sent(len(data))
+        if self.closed or self.peer.closed or (self.loss and self.rng.random() < self.loss):
+            return
+        self.peer.inbox.append((self.clock() + self.latency, bytes(data)))
+
+    def receive(self)->List[bytes]:
+        now = self.clock()
+        inbox = self.inbox
+        arrived = 0
+        while arrived < len(inbox) and inbox[arrived][0] <= now:
+            arrived += 1
+        messages = [message for _, message in inbox[:arrived]]
+        del inbox[:arrived]
+        if self.peer.closed and not inbox:
+            self.closed = True
+        return self.count_received(messages)
+
+
+class LoopbackHost(object):
+    '''In-memory stand-in for a UdpHost or a TcpHost: `connect` makes the client end of
+    a LoopbackTransport pair, `accept` returns the server ends'''
+
+    def __init__(self, latency:float=0, loss:float=0, clock=time.perf_counter, seed:int=None):
+        self.latency = latency
+        self.loss = loss
+        self.clock = clock
+        self.seed = seed
+        self.waiting:List[LoopbackTransport] = []
+
+    def connect(self)->LoopbackTransport:
+        seed = None if self.seed is None else self.seed + 2 * len(self.waiting)
+        server, client = LoopbackTransport.pair(self.latency, self.loss, self.clock, seed)
+        self.waiting.append(server)
+        return client
+
+    def accept(self)->List[Transport]:
+        waiting, self.waiting = self.waiting, []
+        return waiting
+
+    def close(self)->None:
+        pass
+
+
+class UdpTransport(Transport):
+    '''Datagrams to one peer: a message may be lost, duplicated or arrive out of order,
+    but a lost one never delays the next ones. Clients use `connect`, the transports
+    of a server share the socket of its UdpHost.'''
+
+    def __init__(self, sock:socket.socket, peer:Tuple[str,int], inbox:List[bytes]=None):
+        super().__init__()
+        self.sock = sock
+        self.peer = peer
+        self.inbox = inbox # filled by the UdpHost, None: read the socket
+
+    @classmethod
+    def connect(cls, host:str, port:int)->'UdpTransport':
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        sock.connect((host, port))
+        return cls(sock, (host, port))
+
+    def send(self, data:bytes)->None:
+        if len(data) > MAX_DATAGRAM:
+            raise ValueError(f'{len(data)} bytes message, a datagram holds {MAX_DATAGRAM} at most')
+        try:
+            if self.inbox is None:
+                self.sock.send(data)
+            else:
+                self.sock.sendto(data, self.peer)
+        except (BlockingIOError, ConnectionRefusedError):
+            return # dropped, as the network could
+        self.count_sent(len(data))
+
+    def receive(self)->List[bytes]:
+        if self.inbox is not None:
+            messages = list(self.inbox)
+            self.inbox.clear()
+            return self.count_received(messages)
+        messages = []
+        while True:
+            try:
+                messages.append(self.sock.recv(MAX_DATAGRAM))
+            except BlockingIOError:
+                break
+            except ConnectionRefusedError:
+                continue # the server is not there (yet)
+        return self.count_received(messages)
+
+    def close(self)->None:
+        if self.inbox is None:
+            self.sock.close()
+        self.closed = True
+
+
+class UdpHost(object):
+    '''Server socket handing out a UdpTransport per peer address.
+    `accept` reads the socket for every transport: call it before their `receive`.'''
+
+    def __init__(self, host:str='127.0.0.1', port:int=0):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.sock.setblocking(False)
+        self.address = self.sock.getsockname()
+        self.peers:Dict[Tuple[str,int],UdpTransport] = {}
+
+    def accept(self)->List[Transport]:
+        '''return: the transports of the peers heard from for the first time'''
+        new = []
+        while True:
+            try:
+                data, address = self.sock.recvfrom(MAX_DATAGRAM)
+            except BlockingIOError:
+                break
+            except ConnectionResetError:
+                continue
+            peer = self.peers.get(address)
+            if peer is None or peer.closed:
+                peer = self.peers[address] = UdpTransport(self.sock, address, [])
+                new.append(peer)
+            peer.inbox.append(data)
+        return new
+
+    def close(self)->None:
+        self.sock.close()
+
+
+class TcpTransport(Transport):
+    '''Messages over a TCP connection, each one prefixed by its length: nothing is lost
+    nor reordered, but a lost segment holds back the messages behind it'''
+
+    def __init__(self, sock:socket.socket):
+        super().__init__()
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        self.incoming = bytearray()
+        self.outgoing = bytearray() # not taken by the socket yet
+
+    @classmethod
+    def connect(cls, host:str, port:int)->'TcpTransport':
+        return cls(socket.create_connection((host, port)))
+
+    def send(self, data:bytes)->None:
+        if self.closed:
+            return
+        self.outgoing += FRAME.pack(len(data))
+        self.outgoing += data
+        self.count_sent(FRAME.size + len(data))
+        self.flush()
+
+    def flush(self)->None:
+        while self.outgoing:
+            try:
+                sent = self.sock.send(self.outgoing)
+            except BlockingIOError:
+                return
+            except OSError:
+                self.outgoing.clear()
+                self.closed = True
+                return
+            del self.outgoing[:sent]
+
+    def receive(self)->List[bytes]:
+        self.flush()
+        while not self.closed:
+            try:
+                data = self.sock.recv(65536)
+            except BlockingIOError:
+                break
+            except OSError:
+                data = b''
+            if not data:
+                self.closed = True
+                break
+            self.incoming += data
+        messages = []
+        incoming = self.incoming
+        start = 0
+        while len(incoming) - start >= FRAME.size:
+            size, = FRAME.unpack_from(incoming, start)
+            if len(incoming) - start - FRAME.size < size:
+                break
+            messages.append(bytes(incoming[start + FRAME.size:start + FRAME.size + size]))
+            start += FRAME.size + size
+        del incoming[:start]
+        self.count_received(messages)
+        self.stats['bytes_received'] += FRAME.size * len(messages)
+        return messages
+
+    def close(self)->None:
+        self.sock.close()
+        self.closed = True
+
+
+class TcpHost(object):
+    '''Listening socket, `accept` returns a TcpTransport per new connection'''
+
+    def __init__(self, host:str='127.0.0.1', port:int=0):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen()
+        self.sock.setblocking(False)
+        self.address = self.sock.getsockname()
+
+    def accept(self)->List[Transport]:
+        new = []
+        while True:
+            try:
+                sock, _ = self.sock.accept()
+            except BlockingIOError:
+                break
+            new.append(TcpTransport(sock))
+        return new
+
+    def close(self)->None:
+        self.sock.close()
+
+
+def listen(protocol:str, host:str='127.0.0.1', port:int=0)->'UdpHost|TcpHost':
+    '''return: server socket of `protocol` ("udp" or "tcp")'''
+    return {'udp': UdpHost, 'tcp': TcpHost}[protocol](host, port)
+
+
+def connect(protocol:str, host:str, port:int)->Transport:
+    '''return: transport to a server listening with `protocol` ("udp" or "tcp")'''
+    return {'udp': UdpTransport, 'tcp': TcpTransport}[protocol].connect(host, port)
+
+
+class Snapshot(object):
+    '''Replicated rows at a tick: integers by entity id.
+    * ids: sorted entity ids
+    * values: an int32 row per id'''
+
+    def __init__(self, tick:int, ids:np.ndarray, values:np.ndarray):
+        self.tick = tick
+        self.ids = ids
+        self.values = values
+
+
+def empty_snapshot(fields:int)->Snapshot:
+    return Snapshot(NO_TICK, np.zeros(0, dtype=np.int64), np.zeros((0, fields), dtype=np.int32))
+
+
+def diff_rows(base_ids:np.ndarray, base_values:np.ndarray, ids:np.ndarray,
+              values:np.ndarray)->Tuple[np.ndarray,np.ndarray,np.ndarray]:
+    '''return: (ids removed since the base, ids changed or added, their values minus the
+    base ones (the values themselves for added ids)). All ids are sorted.'''
+    position = np.minimum(np.searchsorted(base_ids, ids), max(len(base_ids) - 1, 0))
+    present = base_ids[position] == ids if len(base_ids) else np.zeros(len(ids), dtype=bool)
+    base = np.zeros_like(values)
+    base[present] = base_values[position[present]]
+    changed = ~present | (values != base).any(axis=1)
+    removed = np.setdiff1d(base_ids, ids, assume_unique=True)
+    return removed, ids[changed], values[changed] - base[changed]
+
+
+def patch_rows(base_ids:np.ndarray, base_values:np.ndarray, removed:np.ndarray, changed:np.ndarray,
+               deltas:np.ndarray)->Tuple[np.ndarray,np.ndarray]:
+    '''return: (ids, values) given by `diff_rows`'''
+    keep = ~np.isin(base_ids, removed, assume_unique=True)
+    ids = base_ids[keep]
+    values = base_values[keep]
+    position = np.minimum(np.searchsorted(ids, changed), max(len(ids) - 1, 0))
+    present = ids[position] == changed if len(ids) else np.zeros(len(changed), dtype=bool)
+    values[position[present]] += deltas[present]
+    if not present.all():
+        ids = np.concatenate([ids, changed[~present]])
+        values = np.concatenate([values, deltas[~present]])
+        order = np.argsort(ids, kind='stable')
+        ids = ids[order]
+        values = values[order]
+    return ids, values
+
+
+def pack_ids(ids:np.ndarray)->bytes:
+    '''Sorted ids as the differences between consecutive ids (small numbers, compressing well)'''
+    return np.diff(ids, prepend=0).astype(np.uint32).tobytes()
+
+
+def unpack_ids(data:bytes, offset:int, count:int)->np.ndarray:
+    return np.cumsum(np.frombuffer(data, np.uint32, count, offset), dtype=np.int64)
+
+
+class SnapshotChannel(object):
+    '''Server end of the state replicated to one client. A message only holds the rows that
+    changed since the last snapshot the client acknowledged (see `ack`): the removed ids and
+    the changed rows (as differences). Lost messages are never sent again, the next ones are
+    encoded against an older baseline instead (a full snapshot when no baseline is left).
+    Chunks are sent once in each version, again only when their message is not acknowledged
+    in time.
+    * fields: values per row
+    * history: messages remembered, for the acknowledgements that arrive late
+    * resend_interval: ticks past the round trip time before a chunk that is not
+      acknowledged is sent again
+    * compression: zlib level of the messages'''
+
+    def __init__(self, fields:int, history:int=64, resend_interval:int=4, compression:int=1):
+        self.fields = fields
+        self.history = history
+        self.resend_interval = resend_interval
+        self.compression = compression
+        self.snapshots:Dict[int,Snapshot] = {} # sent and not older than the baseline, by tick
+        self.baseline:Snapshot = None # last snapshot acknowledged
+        self.sent_chunks:Dict[int,List[Tuple[Tuple[int,int],int]]] = {} # tick -> (position, version) sent
+        self.held:Dict[Tuple[int,int],int] = {} # chunk -> version acknowledged by the client
+        self.in_flight:Dict[Tuple[int,int],Tuple[int,int]] = {} # chunk -> (version, tick sent)
+        self.tick = 0 # of the last message
+        self.round_trip = 0 # ticks between the last acknowledged message and its acknowledgement
+        self.stats:Dict[str,int] = {'messages': 0, 'full': 0, 'rows': 0, 'chunks': 0, 'bytes': 0}
+
+    def ack(self, tick:int, received:int=0)->None:
+        '''The client received the message of `tick`, and the ones of the 32 ticks before
+        whose bit is set in `received` (bit 0: tick - 1), see SnapshotReceiver.acks'''
+        for bit in range(-1, 32):
+            if bit < 0 or received >> bit & 1:
+                for position, version in self.sent_chunks.pop(tick - 1 - bit, ()):
+                    if self.in_flight.get(position, (None,))[0] == version:
+                        del self.in_flight[position]
+                        self.held[position] = version
+        snapshot = self.snapshots.get(tick)
+        if snapshot is None or (self.baseline is not None and tick <= self.baseline.tick):
+            return
+        self.baseline = snapshot
+        self.round_trip = self.tick - tick
+        for old in [old for old in self.snapshots if old < tick]:
+            del self.snapshots[old]
+
+    def encode(self, tick:int, ids:np.ndarray, values:np.ndarray, chunks:Dict[Tuple[int,int],bytes])->bytes:
+        '''return: the message of `tick` (ticks must increase)
+        * ids, values: rows of the entities the client should see, ids sorted
+        * chunks: encoded chunks the client should hold, by position. The client may forget
+          the others: they are sent again when they come back.'''
+        baseline = self.baseline or empty_snapshot(self.fields)
+        removed, changed, deltas = diff_rows(baseline.ids, baseline.values, ids, values)
+        sent = []
+        for position, data in chunks.items():
+            version = zlib.crc32(data)
+            if self.held.get(position) == version:
+                continue
+            flight = self.in_flight.get(position)
+            if (flight is not None and flight[0] == version and
+                    tick - flight[1] <= self.round_trip + self.resend_interval):
+                continue
+            self.in_flight[position] = (version, tick)
+            sent.append((position, version, data))
+        for table in (self.held, self.in_flight):
+            for position in [position for position in table if position not in chunks]:
+                del table[position]
+
+        parts = [DELTA_HEADER.pack(tick, baseline.tick, len(removed), len(changed), self.fields, len(sent)),
+                 pack_ids(removed), pack_ids(changed),
+                 np.ascontiguousarray(deltas.T, dtype=np.int32).tobytes()] # by field: alike values together
+        for (chunk_x, chunk_y), version, data in sent:
+            parts.append(CHUNK_HEADER.pack(chunk_x, chunk_y, len(data)))
+            parts.append(data)
+        message = zlib.compress(b''.join(parts), self.compression)
+
+        self.tick = tick
+        self.snapshots[tick] = Snapshot(tick, ids, values)
+        self.sent_chunks[tick] = [(position, version) for position, version, _ in sent]
+        for old in [old for old in self.sent_chunks if old <= tick - self.history]:
+            del self.sent_chunks[old]
+        if len(self.snapshots) > self.history:
+            oldest = min(self.snapshots)
+            del self.snapshots[oldest]
+            if self.baseline is not None and self.baseline.tick == oldest:
+                self.baseline = None
+        stats = self.stats
+        stats['messages'] += 1
+        stats['full'] += self.baseline is None
+        stats['rows'] += len(changed)
+        stats['chunks'] += len(sent)
+        stats['bytes'] += len(message)
+        return message
+
+
+class SnapshotReceiver(object):
+    '''Client end of a SnapshotChannel, rebuilds the snapshots from the messages.
+    Give `acks` to SnapshotChannel.ack.'''
+
+    def __init__(self, history:int=64):
+        self.history = history
+        self.snapshots:Dict[int,Snapshot] = {}
+        self.acked = NO_TICK # newest tick decoded
+        self.received = 0 # bit i: the message of tick acked - 1 - i was decoded too
+
+    def acks(self)->Tuple[int,int]:
+        '''return: (newest tick decoded or NO_TICK, bits of the 32 ticks before it decoded too)'''
+        return self.acked, self.received
+
+    def decode(self, message:bytes)->'Tuple[Snapshot,List[Tuple[Tuple[int,int],bytes]]]|None':
+        '''return: (snapshot, (position, data) of the chunks received), None for a message
+        older than the last one decoded or whose baseline is lost'''
+        data = zlib.decompress(message)
+        tick, base_tick, removed_count, changed_count, fields, sent_count = DELTA_HEADER.unpack_from(data)
+        if self.acked != NO_TICK and tick <= self.acked:
+            return None
+        if base_tick == NO_TICK:
+            baseline = empty_snapshot(fields)
+        elif base_tick in self.snapshots:
+            baseline = self.snapshots[base_tick]
+        else:
+            return None
+        offset = DELTA_HEADER.size
+        removed = unpack_ids(data, offset, removed_count)
+        offset += 4 * removed_count
+        changed = unpack_ids(data, offset, changed_count)
+        offset += 4 * changed_count
+        deltas = np.frombuffer(data, np.int32, changed_count * fields, offset).reshape(fields, changed_count).T
+        offset += 4 * changed_count * fields
+        ids, values = patch_rows(baseline.ids, baseline.values, removed, changed, deltas)
+        received = []
+        for _ in range(sent_count):
+            chunk_x, chunk_y, size = CHUNK_HEADER.unpack_from(data, offset)
+            offset += CHUNK_HEADER.size
+            received.append(((chunk_x, chunk_y), data[offset:offset + size]))
+            offset += size
+
+        snapshot = self.snapshots[tick] = Snapshot(tick, ids, values)
+        if self.acked != NO_TICK:
+            shift = tick - self.acked
+            self.received = ((self.received << shift) | 1 << (shift - 1)) & 0xffffffff if shift <= 32 else 0
+        self.acked = tick
+        for old in [old for old in self.snapshots if old <= tick - self.history]:
+            del self.snapshots[old]
+        return snapshot, received
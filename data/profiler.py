@@ -0,0 +1,159 @@
+from typing import Any, Dict, List, Tuple
+from collections import deque
+from contextlib import nullcontext
+import csv, json, time
+import pygame
+
+
+class Section(object):
+    '''Times the code of a `with` block and adds it to the profiler's current frame'''
+
+    def __init__(self, profiler:'Profiler', name:str):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Profiler(object):
+    '''Named timing sections collected per frame.
+    While disabled, `section` returns a shared do-nothing context manager and
+    instrumented functions are left untouched, so profiling costs next to nothing.
+    * window: number of frames kept for the rolling statistics
+    * record: keep every frame's timings for `dump`'''
+    null_section = nullcontext()
+
+    def __init__(self, enabled:bool=False, window:int=300, record:bool=False):
+        self.enabled = enabled
+        self.window = window
+        self.record = record
+        self.frame:Dict[str,float] = {}
+        self.samples:Dict[str,deque] = {}
+        self.frame_times:deque = deque(maxlen=window)
+        self.frames:List[Dict[str,float]] = []
+        self.frame_start = time.perf_counter()
+        self.instrumented:List[Tuple[Any,str,Any]] = []
+        self.overlay = None
+        self.overlay_age = 0
+        self.overlay_pos = (0, 0)
+
+    def section(self, name:str):
+        '''return: context manager timing its block under `name`'''
+        if not self.enabled:
+            return self.null_section
+        return Section(self, name)
+
+    def add(self, name:str, duration:float)->None:
+        self.frame[name] = self.frame.get(name, 0) + duration
+
+    def end_frame(self)->None:
+        '''Store the timings of the frame that just ended and start a new one'''
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.frame_times.append(now - self.frame_start)
+        self.frame_start = now
+        for name, duration in self.frame.items():
+            if name not in self.samples:
+                self.samples[name] = deque(maxlen=self.window)
+            self.samples[name].append(duration)
+        if self.record:
+            self.frames.append(self.frame)
+        self.frame = {}
+
+    def instrument(self, owner:Any, attribute:str, name:str=None)->None:
+        '''Time every call to `owner.attribute` (a function of a class or module) under `name`.
+        Only wrapped while the profiler is enabled, see `restore`.'''
+        if not self.enabled:
+            return
+        function = getattr(owner, attribute)
+        name = name or attribute
+        profiler = self
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profiler.add(name, time.perf_counter() - start)
+
+        timed.__wrapped__ = function
+        setattr(owner, attribute, timed)
+        self.instrumented.append((owner, attribute, function))
+
+    def restore(self)->None:
+        '''Undo every `instrument`'''
+        for owner, attribute, function in reversed(self.instrumented):
+            setattr(owner, attribute, function)
+        self.instrumented.clear()
+
+    def percentiles(self, name:str)->Tuple[float,float]:
+        '''return: (p50, p99) of the rolling timings of section `name`, in seconds'''
+        values = sorted(self.samples.get(name, ()))
+        if not values:
+            return 0, 0
+        return values[len(values)//2], values[min(len(values)-1, int(len(values)*0.99))]
+
+    def fps(self)->float:
+        total = sum(self.frame_times)
+        return len(self.frame_times) / total if total else 0
+
+    def draw(self, surface:pygame.Surface, pos:Tuple[int,int]=(4,4), refresh:int=15)->pygame.Rect:
+        '''Draw FPS and p50/p99 of every section (in ms) onto `surface`.
+        The text is only rebuilt every `refresh` frames.
+        return: the area drawn, None while disabled'''
+        if not self.enabled:
+            return
+        if self.overlay is None or self.overlay_age >= refresh:
+            if not pygame.font.get_init():
+                pygame.font.init()
+            font = pygame.font.Font(None, 16)
+            rows = [(f'{self.fps():.1f} fps', 'p50', 'p99')]
+            for name in sorted(self.samples):
+                p50, p99 = self.percentiles(name)
+                rows.append((name, f'{p50*1000:.2f}', f'{p99*1000:.2f}'))
+            height = font.get_linesize()
+            name_width = max(font.size(row[0])[0] for row in rows) + 8
+            value_width = max(font.size(value)[0] for row in rows for value in row[1:]) + 8
+            self.overlay = pygame.Surface((name_width + value_width*2 + 4, height*len(rows) + 4))
+            self.overlay.set_alpha(200)
+            for i, row in enumerate(rows):
+                y = 2 + i*height
+                self.overlay.blit(font.render(row[0], False, (255,255,255)), (2, y))
+                for column, value in enumerate(row[1:]):
+                    text = font.render(value, False, (255,255,255))
+                    right = 2 + name_width + value_width*(column+1) - 8
+                    self.overlay.blit(text, (right - text.get_width(), y))
+            self.overlay_age = 0
+        self.overlay_age += 1
+        self.overlay_pos = pos
+        return surface.blit(self.overlay, pos)
+
+    def overlay_rect(self)->pygame.Rect:
+        '''return: area covered by the overlay last time it was drawn'''
+        if self.overlay is None:
+            return pygame.Rect(0, 0, 0, 0)
+        return self.overlay.get_rect(topleft=self.overlay_pos)
+
+    def dump(self, path:str)->None:
+        '''Write the recorded frames (in ms) to `path`, as JSON for a .json file, CSV otherwise'''
+        names = sorted({name for frame in self.frames for name in frame})
+        rows = [{name: round(frame.get(name, 0)*1000, 4) for name in names} for frame in self.frames]
+        with open(path, 'w', newline='') as f:
+            if path.endswith('.json'):
+                json.dump(rows, f)
+            else:
+                writer = csv.DictWriter(f, fieldnames=names)
+                writer.writeheader()
+                writer.writerows(rows)
+
+
+global profiler
+profiler = Profiler() # shared by the game and the engine, disabled by default
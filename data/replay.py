@@ -0,0 +1,126 @@
+from typing import Any, Dict, Iterator, List, Tuple
+import hashlib, io, json, struct
+import numpy as np
+
+
+# recording file: magic, format version, snapshot size, inputs size, digest of the final state
+RECORDING_HEADER = struct.Struct('<4sHII20s')
+RECORDING_MAGIC = b'PFRC'
+RECORDING_VERSION = 1
+
+
+class InputLog(object):
+    '''Inputs of consecutive ticks, each one a small integer (e.g. a bit per key held).
+    Stored as runs of identical inputs: 3 bytes for up to 65535 ticks.'''
+    RUN = struct.Struct('<BH') # inputs, number of ticks
+
+    def __init__(self):
+        self.runs:List[List[int]] = []
+        self.ticks = 0
+
+    def __len__(self)->int:
+        return self.ticks
+
+    def append(self, bits:int)->None:
+        runs = self.runs
+        if runs and runs[-1][0] == bits and runs[-1][1] < 0xffff:
+            runs[-1][1] += 1
+        else:
+            runs.append([bits, 1])
+        self.ticks += 1
+
+    def __iter__(self)->Iterator[int]:
+        for bits, count in self.runs:
+            for _ in range(count):
+                yield bits
+
+    def to_bytes(self)->bytes:
+        return b''.join(self.RUN.pack(bits, count) for bits, count in self.runs)
+
+    @classmethod
+    def from_bytes(cls, data:bytes)->'InputLog':
+        log = cls()
+        log.runs = [list(run) for run in cls.RUN.iter_unpack(data)]
+        log.ticks = sum(count for _, count in log.runs)
+        return log
+
+
+class Inputs(object):
+    def __init__(self, right:bool=False, left:bool=False, jump:bool=False, stop_jump:bool=False):
+        '''Player inputs for one simulation step.
+        * right, left: held keys
+        * jump, stop_jump: key presses, only applied to the next step'''
+        self.right = right
+        self.left = left
+        self.jump = jump
+        self.stop_jump = stop_jump
+
+    def copy(self)->'Inputs':
+        return Inputs(self.right, self.left, self.jump, self.stop_jump)
+
+    def clear_presses(self)->None:
+        self.jump = False
+        self.stop_jump = False
+
+    def bits(self)->int:
+        '''return: the inputs packed in an integer, see InputLog'''
+        return self.right | self.left << 1 | self.jump << 2 | self.stop_jump << 3
+
+    @classmethod
+    def from_bits(cls, bits:int)->'Inputs':
+        return cls(bool(bits & 1), bool(bits & 2), bool(bits & 4), bool(bits & 8))
+
+
+def encode_state(meta:Dict[str,Any], arrays:Dict[str,np.ndarray])->bytes:
+    '''return: `meta` (JSON serializable) and `arrays` packed in a compressed .npz'''
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, meta=np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8), **arrays)
+    return buffer.getvalue()
+
+
+def decode_state(data:bytes)->Tuple[Dict[str,Any],Dict[str,np.ndarray]]:
+    '''return: (meta, arrays) packed by `encode_state`'''
+    with np.load(io.BytesIO(data)) as archive:
+        arrays = {name: archive[name] for name in archive.files}
+    meta = json.loads(arrays.pop('meta').tobytes())
+    return meta, arrays
+
+
+def state_digest(meta:Dict[str,Any], arrays:Dict[str,np.ndarray])->bytes:
+    '''return: SHA-1 of a state, the same for equal states (unlike the compressed bytes)'''
+    digest = hashlib.sha1(json.dumps(meta, sort_keys=True).encode())
+    for name in sorted(arrays):
+        array = np.ascontiguousarray(arrays[name])
+        digest.update(f'{name}:{array.dtype.str}:{array.shape}'.encode())
+        digest.update(array.tobytes())
+    return digest.digest()
+
+
+class Recording(object):
+    '''A snapshot of the world state and the inputs of every tick played from it.
+    * digest: state_digest of the state reached at the end, to check replays (optional)'''
+
+    def __init__(self, snapshot:bytes, inputs:InputLog, digest:bytes=None):
+        self.snapshot = snapshot
+        self.inputs = inputs
+        self.digest = digest
+
+    def save(self, path:str)->None:
+        inputs = self.inputs.to_bytes()
+        with open(path, 'wb') as f:
+            f.write(RECORDING_HEADER.pack(RECORDING_MAGIC, RECORDING_VERSION, len(self.snapshot), len(inputs),
+                                          self.digest or bytes(20)))
+            f.write(self.snapshot)
+            f.write(inputs)
+
+    @classmethod
+    def load(cls, path:str)->'Recording':
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, version, snapshot_size, inputs_size, digest = RECORDING_HEADER.unpack_from(data)
+        if magic != RECORDING_MAGIC or version != RECORDING_VERSION:
+            raise ValueError(f'{path} is not a recording of this version')
+        start = RECORDING_HEADER.size
+        snapshot = data[start:start + snapshot_size]
+        inputs = InputLog.from_bytes(data[start + snapshot_size:start + snapshot_size + inputs_size])
+        return cls(snapshot, inputs, digest if any(digest) else None)
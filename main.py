@@ -1,12 +1,28 @@
-from typing import Dict, List, Tuple, Iterable
-from enum import Enum
-from random import choice, randint, choices
+from typing import Any, Callable, Dict, List, Set, Tuple, Iterable, Iterator
+from bisect import bisect_left, bisect_right
+from enum import Enum, IntEnum
+from random import randint
+import argparse
+import gc
+import math
+import os
+import shutil
 import sys
+import tempfile
+import time
 
+import numpy as np
 import pygame
 from pygame.locals import *
 
 import data.engine as e
+from data.assets import Assets
+from data.audio import AudioManager
+from data.behaviour import BehaviourSystem, Scheduler, State, StateMachine
+from data.navigation import JUMP, NavGraph, PathFinder
+from data.netplay import NET_PORT, run_network
+from data.profiler import profiler
+from data.replay import InputLog, Inputs, Recording, decode_state, encode_state, state_digest
 
 
 WINDOW_SIZE = (600,400)
@@ -14,37 +30,47 @@ DISPLAY_SIZE = (300,200)
 # DISPLAY_SIZE = WINDOW_SIZE
 ZOOM_X = WINDOW_SIZE[0]/DISPLAY_SIZE[0]
 CHUNK_SIZE = 8 # length of chunk (in no. of tiles).
+CHUNK_CACHE_BUDGET = 8*1024*1024 # memory (in bytes) for pre-rendered chunk surfaces.
+PARALLAX_LAYER_RATIO = 2 # background objects whose parallax factors are within this ratio share a layer.
+WORLD_SEED = 0 # chunks generated with the same seed are identical.
+PLANT_CHANCE = 0.2 # probability for a tile above the grass to hold a plant.
+CHUNK_WORKERS = 2 # threads generating chunks in the background.
+PREFETCH_DISTANCE = 2 # chunks generated ahead of the view in the direction of travel.
+MAX_RESIDENT_CHUNKS = 256 # chunks kept in memory, the furthest ones are saved to disk.
+TICK_RATE = 60 # simulation steps per second, independent of the frame rate.
+MAX_STEPS_PER_FRAME = 5 # simulation steps done at most before a frame is drawn.
+ASSET_MANIFEST = 'data/assets.json'
+RUN_SPEED = 2 # player horizontal speed (pixels per tick).
+JUMP_SPEED = 5 # vertical speed given by a jump.
+GRAVITY = 0.2 # added to the vertical speed every tick...
+MAX_FALL_SPEED = 3 # ...up to this.
+NPC_TYPE = 'player' # entity type of the NPCs (sets their animations).
+NPC_DECISION_BUDGET = 0.001 # seconds per step given to the NPC decisions, the others wait.
+MAX_NPC_DECISIONS = 64 # NPC decisions made at most per step.
+NPC_OFFSCREEN_PERIOD = 8 # NPCs outside the view act and decide this many times less often.
+FOLLOW_DISTANCE = 64 # an NPC closer than this to the player follows it...
+LOSE_DISTANCE = 160 # ...until it is further than this.
+CROWD_DISTANCE = 8 # a wandering NPC walks away from other NPCs closer than this.
+NPC_SPEED = 1 # NPC horizontal speed (pixels per tick).
+NPC_SIZE = (5, 13)
+PATH_WORKERS = 1 # threads searching the NPC paths.
+NAV_CHUNKS_PER_STEP = 8 # chunks of the NPC navigation graph rebuilt at most per step.
+NAV_MARGIN = 2 # chunks around the NPCs where the navigation graph is built (reaching LOSE_DISTANCE).
+# World arguments making its steps only depend on its state and inputs (no worker threads, no time budget)
+REPRODUCIBLE_WORLD = {'workers': 0, 'decision_budget': None, 'path_workers': 0}
 
-clock = pygame.time.Clock()
 
-pygame.mixer.pre_init(44100, -16, 2, 512)
-pygame.init()
-pygame.mixer.set_num_channels(64)
+class TileType(IntEnum):
+    '''Tile ids, as stored in the chunk arrays'''
+    NOTHING = 0
+    GRASS = 1
+    DIRT = 2
+    PLANT = 3
 
-pygame.display.set_caption('Pygame Platformer')
 
-screen = pygame.display.set_mode(WINDOW_SIZE,0,32)
-display = pygame.Surface(DISPLAY_SIZE) # used as the surface for rendering, which is scaled
-
-moving_right = False
-moving_left = False
-vertical_momentum = 0
-air_timer = 0
-
-true_scroll = e.Vector(0,0)
-
-
-grass_img = pygame.image.load('data/images/grass.png')
-dirt_img = pygame.image.load('data/images/dirt.png')
-plant_img = pygame.image.load('data/images/plant.png').convert()
-plant_img.set_colorkey((255,255,255))
-
-
-class TileType(Enum):
-    NOTHING = None
-    GRASS = grass_img
-    DIRT = dirt_img
-    PLANT = plant_img
+assets:Assets = None # set by load_assets
+tile_images:Dict[TileType,pygame.Surface] = {} # filled by load_assets, subsurfaces of the atlas
+tile_frames = np.zeros(len(TileType), dtype=np.int32) # atlas image id of each TileType
 
 
 class MoveKey(Enum):
@@ -54,6 +80,10 @@ class MoveKey(Enum):
     LEFT = K_s
 
 
+SOLID_TILES = (TileType.GRASS, TileType.DIRT)
+solid_tiles = np.isin(np.arange(len(TileType)), SOLID_TILES) # whether each TileType is solid
+
+
 class Tile:
     def __init__(self, x:int, y:int, tile_type:'TileType'):
         '''Element occupying one tile in the game map'''
@@ -62,6 +92,39 @@ class Tile:
         self.type = tile_type
 
 
+class Chunk:
+    def __init__(self, x:int, y:int, tiles:np.ndarray):
+        '''Square block of the game map.
+        * tiles: CHUNK_SIZE x CHUNK_SIZE array of TileType ids, indexed [row, column]
+        Tile instances are only created when iterating over the chunk.'''
+        self.x = x
+        self.y = y
+        self.tiles = tiles
+
+    def __iter__(self)->Iterator[Tile]:
+        rows, columns = np.nonzero(self.tiles)
+        for row, column in zip(rows.tolist(), columns.tolist()):
+            yield Tile(x=self.x * CHUNK_SIZE + column,
+                       y=self.y * CHUNK_SIZE + row,
+                       tile_type=TileType(self.tiles[row, column]))
+
+    def __len__(self)->int:
+        return int(np.count_nonzero(self.tiles))
+
+    def tile_at(self, x:int, y:int)->Tile:
+        '''return: Tile at world tile coordinates (x, y), None for empty tiles'''
+        tile_type = TileType(self.tiles[y - self.y * CHUNK_SIZE, x - self.x * CHUNK_SIZE])
+        if tile_type == TileType.NOTHING:
+            return None
+        return Tile(x, y, tile_type)
+
+    def positions(self, *tile_types:TileType)->Iterator[Tuple[int,int]]:
+        '''return: world tile coordinates of the tiles of the given types'''
+        rows, columns = np.nonzero(np.isin(self.tiles, tile_types))
+        return zip((columns + self.x * CHUNK_SIZE).tolist(),
+                   (rows + self.y * CHUNK_SIZE).tolist())
+
+
 class BackgroundObject:
     def __init__(self, parallax: float, rect: pygame.Rect):
         self.parallax = parallax
@@ -84,8 +147,8 @@ class BackgroundObject:
         self.rect.x = self.spawn_x + x if from_spawn else x
         self.rect.y = self.spawn_y + y if from_spawn else y
 
-    def is_viewable(self):
-        view_rect = get_draw_rect(self.rect, self.parallax)
+    def is_viewable(self, player:e.Entity, scroll:e.Vector):
+        view_rect = get_draw_rect(self.rect, self.parallax, player, scroll)
         return view_rect.x > -self.rect.width and view_rect.x < DISPLAY_SIZE[0]
 
 
@@ -95,16 +158,97 @@ class Backgrounds(list):
             self.append(e)
 
 
-def get_draw_rect(rect: pygame.Rect, parallax: int)->pygame.Rect:
+class ParallaxLayer:
+    def __init__(self):
+        '''Background objects of close parallax factors (see PARALLAX_LAYER_RATIO), sorted by x
+        so that only the ones around the camera are visited.'''
+        self.low = math.inf # smallest parallax factor of the objects
+        self.high = -math.inf # largest
+        self.objects:List[BackgroundObject] = []
+        self.xs:List[int] = []
+        self.max_width = 0
+
+    def add(self, background_object:BackgroundObject)->None:
+        i = bisect_right(self.xs, background_object.rect.x)
+        self.objects.insert(i, background_object)
+        self.xs.insert(i, background_object.rect.x)
+        self.max_width = max(self.max_width, background_object.rect.width)
+        self.low = min(self.low, background_object.parallax)
+        self.high = max(self.high, background_object.parallax)
+
+    def refresh(self)->None:
+        '''Sort the objects again, needed after moving them'''
+        self.objects.sort(key=lambda background_object: background_object.rect.x)
+        self.xs = [background_object.rect.x for background_object in self.objects]
+
+    def visible(self, player:e.Entity, scroll:e.Vector, batch:List)->None:
+        '''Append (color, draw rect) of the viewable objects to `batch`, furthest first'''
+        if self.low > 0:
+            # draw x = (player x - scroll.x) - (player x - x) * parallax, solved for x at the display edges
+            # with the factors at both ends of the layer: the widest span holds every object
+            player_x = int(player.x)
+            screen_x = player_x - scroll.x
+            left = player_x + min((-self.max_width - screen_x) / self.low, (-self.max_width - screen_x) / self.high)
+            right = player_x + max((DISPLAY_SIZE[0] - screen_x) / self.low, (DISPLAY_SIZE[0] - screen_x) / self.high)
+            candidates = self.objects[bisect_left(self.xs, left - 1):bisect_right(self.xs, right + 1)]
+        else:
+            candidates = self.objects
+        viewable = []
+        for background_object in candidates:
+            parallax = background_object.parallax
+            draw_rect = get_draw_rect(background_object.rect, parallax, player, scroll)
+            if draw_rect.x > -background_object.rect.width and draw_rect.x < DISPLAY_SIZE[0]:
+                viewable.append((parallax, draw_rect))
+        viewable.sort(key=lambda item: item[0])
+        batch.extend((parallax_color(parallax), draw_rect) for parallax, draw_rect in viewable)
+
+
+class ParallaxLayers:
+    def __init__(self, background_objects:Iterable[BackgroundObject]=()):
+        '''Background objects grouped in a few layers by parallax factor, furthest layer first'''
+        self.layers:Dict[float,ParallaxLayer] = {}
+        self.ordered:List[ParallaxLayer] = []
+        for background_object in background_objects:
+            self.add(background_object)
+
+    def add(self, background_object:BackgroundObject)->None:
+        parallax = background_object.parallax
+        key = math.floor(math.log(parallax, PARALLAX_LAYER_RATIO)) if parallax > 0 else -math.inf
+        layer = self.layers.get(key)
+        if layer is None:
+            layer = self.layers[key] = ParallaxLayer()
+            self.ordered = [self.layers[key] for key in sorted(self.layers)]
+        layer.add(background_object)
+
+    def refresh(self)->None:
+        for layer in self.ordered:
+            layer.refresh()
+
+    def visible(self, player:e.Entity, scroll:e.Vector)->List[Tuple[Tuple[int,int,int],pygame.Rect]]:
+        '''return: (color, draw rect) of every viewable object, in drawing order'''
+        batch = []
+        for layer in self.ordered:
+            layer.visible(player, scroll, batch)
+        return batch
+
+
+def parallax_color(parallax:float)->Tuple[int,int,int]:
+    '''return: color of the background objects of a parallax factor, bluer further away'''
+    return (round((1-(1 - parallax)) * 255), round((1 - parallax) * 255), 255)
+
+
+def get_draw_rect(rect: pygame.Rect, parallax: int, player:e.Entity, scroll:e.Vector)->pygame.Rect:
     '''Returns the draw coordinates considering:
     * a parallax
     * the display size
-    * the zoom levels (defined by the display to screen ratios of the x, y axis)'''
-    adjusted_x = (player.x - scroll.x) - ((player.x-rect.x) * parallax)
+    * the zoom levels (defined by the display to screen ratios of the x, y axis)
+    The player is taken at its drawn (whole pixel) position, so the layers stay still with it.'''
+    player_x, player_y = int(player.x), int(player.y)
+    adjusted_x = (player_x - scroll.x) - ((player_x-rect.x) * parallax)
     # adjusted_x = (rect.x - scroll.x) * parallax
 
     # adjusted_y = (rect.y - scroll.y) * parallax
-    adjusted_y = (player.y - scroll.y) - ((player.y-rect.y) * parallax)
+    adjusted_y = (player_y - scroll.y) - ((player_y-rect.y) * parallax)
     adjusted_width = rect.width * parallax
     adjusted_height = rect.height * parallax
     parallaxed = [adjusted_x, adjusted_y, adjusted_width, adjusted_height]
@@ -112,184 +256,969 @@ def get_draw_rect(rect: pygame.Rect, parallax: int)->pygame.Rect:
     return pygame.Rect(parallaxed)
 
 
-def generate_chunk(chunk_x:int,chunk_y:int)->List[Tile]:
+def viewable(x:np.ndarray, width:np.ndarray, scroll:e.Vector)->np.ndarray:
+    '''return: which objects of the world plane are in view, as BackgroundObject.is_viewable
+    (with a parallax of 1) for arrays of x positions and widths'''
+    draw_x = np.trunc(x) - scroll.x
+    return (draw_x > -width) & (draw_x < DISPLAY_SIZE[0])
+
+
+def chunk_rng(chunk_x:int, chunk_y:int, seed:int=WORLD_SEED)->np.random.Generator:
+    '''Random generator of a chunk, only depends on the world seed and the chunk position'''
+    return np.random.default_rng([seed, chunk_x & 0xffffffff, chunk_y & 0xffffffff])
+
+
+def generate_chunk(chunk_x:int,chunk_y:int,seed:int=WORLD_SEED)->Chunk:
+    '''
+    Generate all the tiles for a new chunk in one pass over the chunk array:
+    * dirt below y 10, grass at y 10, random plants at y 9
+    * a hole for x 6 to 8
     '''
-    Generate all the tiles for a new chunk
-    Tile instances of type empty are discarded.
-    '''    
-    tiles = []
-    for row in range(CHUNK_SIZE):
-        for column in range(CHUNK_SIZE):
-            tile = Tile(x=chunk_x * CHUNK_SIZE + column,
-                        y=chunk_y * CHUNK_SIZE + row,
-                        tile_type = TileType.NOTHING)
-            tile_type = TileType.NOTHING
-
-            # create hole
-            if tile.x >= 6 and tile.x <= 8:
+    rows = np.arange(CHUNK_SIZE)[:, None] + chunk_y * CHUNK_SIZE
+    columns = np.arange(CHUNK_SIZE)[None, :] + chunk_x * CHUNK_SIZE
+    plants = chunk_rng(chunk_x, chunk_y, seed).random((CHUNK_SIZE, CHUNK_SIZE)) < PLANT_CHANCE
+    tiles = np.select([rows > 10, rows == 10, (rows == 9) & plants],
+                      [TileType.DIRT, TileType.GRASS, TileType.PLANT],
+                      TileType.NOTHING).astype(np.uint8)
+    # create hole
+    tiles[:, ((columns >= 6) & (columns <= 8))[0]] = TileType.NOTHING
+    return Chunk(chunk_x, chunk_y, tiles)
+
+
+def chunk_key(chunk_x:int, chunk_y:int)->Tuple[int,int]:
+    '''return: key of a chunk in the game map'''
+    return (chunk_x, chunk_y)
+
+
+def encode_chunk(chunk:Chunk)->bytes:
+    return chunk.tiles.tobytes()
+
+
+def decode_chunk(chunk_x:int, chunk_y:int, data:bytes)->Chunk:
+    tiles = np.frombuffer(data, dtype=np.uint8).reshape((CHUNK_SIZE, CHUNK_SIZE)).copy()
+    return Chunk(chunk_x, chunk_y, tiles)
+
+
+def render_chunk(chunk:Chunk)->pygame.Surface:
+    '''
+    Draw all the tiles of a chunk onto one surface, positioned at the chunk origin.
+    return: None when the chunk has nothing to draw.
+    '''
+    if not chunk.tiles.any():
+        return None
+    surf = pygame.Surface((CHUNK_SIZE*16, CHUNK_SIZE*16)).convert()
+    surf.fill(e.e_colorkey)
+    surf.set_colorkey(e.e_colorkey, RLEACCEL)
+    rows, columns = np.nonzero(chunk.tiles)
+    frames = tile_frames[chunk.tiles[rows, columns]]
+    e.texture_atlas.blits(surf, zip(frames.tolist(), zip((columns*16).tolist(), (rows*16).tolist())))
+    return surf
+
+
+def init_pygame(headless:bool=False, audio:bool=True)->pygame.Surface:
+    '''Initialize pygame and open the window.
+    * headless: use the dummy video and audio drivers, nothing is shown or heard
+    * audio: False to only start the display, no mixer thread (e.g. before forking)
+    return: the screen surface'''
+    if headless:
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'
+        os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    if audio:
+        pygame.mixer.pre_init(44100, -16, 2, 512)
+        pygame.init()
+        pygame.mixer.set_num_channels(64)
+    else:
+        pygame.display.init()
+    pygame.display.set_caption('Pygame Platformer')
+    return pygame.display.set_mode(WINDOW_SIZE,0,32)
+
+
+def load_assets(sounds:bool=True)->Assets:
+    '''Load the assets of ASSET_MANIFEST (after init_pygame)
+    and pack the images into the texture atlas'''
+    global assets
+    assets = Assets(ASSET_MANIFEST).load(sounds)
+    atlas = e.build_atlas({TileType.GRASS: assets.images['grass'],
+                           TileType.DIRT: assets.images['dirt'],
+                           TileType.PLANT: assets.images['plant']})
+    for tile_type in (TileType.GRASS, TileType.DIRT, TileType.PLANT):
+        tile_frames[tile_type] = atlas[tile_type]
+        tile_images[tile_type] = atlas.image(atlas[tile_type])
+    return assets
+
+
+class World:
+    def __init__(self, seed:int=WORLD_SEED, workers:int=CHUNK_WORKERS, save_dir:str=None,
+                 max_chunks:int=MAX_RESIDENT_CHUNKS, decision_budget:float=NPC_DECISION_BUDGET,
+                 path_workers:int=PATH_WORKERS):
+        '''Game simulation: the game map, the player and the NPCs, advanced by fixed time steps.
+        Nothing is drawn or played, sounds to play are listed in `sound_events` with their position.
+        * save_dir: directory where explored chunks are kept (for this seed only),
+          a temporary directory removed by `close` by default
+        * decision_budget: seconds per step for the NPC decisions, None to only limit their
+          number (MAX_NPC_DECISIONS), so that runs can be reproduced
+        * path_workers: threads searching the NPC paths, 0 to search them during the decisions'''
+        self.seed = seed
+        self.temporary_dir = save_dir is None
+        if save_dir is None:
+            save_dir = tempfile.mkdtemp(prefix='platformer_chunks_')
+        self.game_map = e.ChunkStore(save_dir, CHUNK_SIZE*CHUNK_SIZE, encode_chunk, decode_chunk,
+                                     max_chunks=max_chunks)
+        self.chunks_added = 0
+        self.changed_chunks:Set[Tuple[int,int]] = set() # replaced by `set_chunk` or edited, drained by the renderer
+        self.renderer:Any = None # Game drawing the world, without one `changed_chunks` is dropped every step
+        self.tile_listeners:List[Callable] = [] # functions(x, y, old types, new types) given the tiles changed by each edit
+        self.tile_index = e.SpatialHash(16) # collision rects of solid tiles
+        self.grass_index = e.SpatialHash(16) # rects of plants, used for footstep sounds
+        self.chunk_streamer = e.ChunkStreamer(self.load_chunk,
+                                              lambda chunk_x, chunk_y: chunk_key(chunk_x, chunk_y) in self.game_map,
+                                              workers)
+        self.player = e.Entity(0,100,5,13,'player')
+        self.player_movement = e.Vector(x=0,y=0)
+        self.moving_right = False
+        self.moving_left = False
+        self.vertical_momentum = 0
+        self.air_timer = 0
+        self.true_scroll = e.Vector(0,0)
+        self.scroll = e.Vector(0,0)
+        self.view_chunks = pygame.Rect(0,0,7,6) # chunks seen by the camera
+        self.npcs = e.EntityManager(gravity=GRAVITY, max_fall_speed=MAX_FALL_SPEED)
+        self.npcs.add_field('waypoint', default=np.nan) # x to walk to, along the path to the player
+        self.npcs.add_field('leap', bool, default=False) # jump once at `waypoint`
+        self.npc_paths:Dict[int,List[Tuple[float,bool]]] = {} # next waypoints, last one first
+        self.navigation = NavGraph(CHUNK_SIZE, 16, NPC_SIZE, NPC_SPEED, JUMP_SPEED, GRAVITY, MAX_FALL_SPEED)
+        self.pathfinder = PathFinder(self.navigation, path_workers)
+        self.npc_grid = e.EntityGrid(32) # NPC rects by entity id, for proximity queries
+        self.npc_rng = np.random.default_rng(seed)
+        self.behaviours = BehaviourSystem(self.npcs, Scheduler(decision_budget, MAX_NPC_DECISIONS),
+                                          NPC_OFFSCREEN_PERIOD)
+        self.behaviours.add_machine(NPC_TYPE, StateMachine(
+            State('wander', self.wander, self.decide_wander, interval=120),
+            State('follow', self.follow, self.decide_follow, interval=30)))
+        self.tick = 0
+        self.sound_events:List[Tuple[str,float,float]] = [] # (sound group, x, y) of the last step
+        self.input_log:InputLog = None # set to record the inputs of every step
+
+    def load_chunk(self, chunk_x:int, chunk_y:int)->Chunk:
+        '''return: the chunk as saved on disk, generated if it was never explored
+        (called from the chunk streamer's workers)'''
+        chunk = self.game_map.load(chunk_x, chunk_y)
+        if chunk is None:
+            chunk = generate_chunk(chunk_x, chunk_y, self.seed)
+        return chunk
+
+    def index_chunk(self, chunk_position:Tuple[int,int], chunk:Chunk)->None:
+        '''Register the collision rects of a chunk's tiles in the spatial indexes'''
+        for x, y in chunk.positions(*SOLID_TILES):
+            self.tile_index.insert(pygame.Rect(x*16,y*16,16,16), chunk_position)
+        for x, y in chunk.positions(TileType.PLANT):
+            self.grass_index.insert(pygame.Rect(x*16,y*16,16,16), chunk_position)
+
+    def add_chunk(self, chunk:Chunk)->None:
+        '''Insert a generated chunk in the game map'''
+        chunk_position = chunk_key(chunk.x, chunk.y)
+        self.game_map[chunk_position] = chunk
+        self.index_chunk(chunk_position, chunk)
+        self.navigation.add_chunk(chunk_position, np.isin(chunk.tiles, SOLID_TILES))
+        self.chunks_added += 1
+
+    def set_chunk(self, chunk:Chunk)->None:
+        '''Put a chunk in the game map in place of the one there, loaded, saved or being generated
+        (e.g. the server's copy)'''
+        chunk_position = chunk_key(chunk.x, chunk.y)
+        self.chunk_streamer.pending.pop(chunk_position, None)
+        if chunk_position in self.game_map:
+            self.tile_index.remove_owner(chunk_position)
+            self.grass_index.remove_owner(chunk_position)
+        self.add_chunk(chunk)
+        self.changed_chunks.add(chunk_position)
+
+    def tile_rects_index(self, tile_type:int)->e.SpatialHash:
+        '''return: the spatial index holding the rects of tiles of `tile_type`, None if not indexed'''
+        if tile_type in SOLID_TILES:
+            return self.tile_index
+        if tile_type == TileType.PLANT:
+            return self.grass_index
+        return None
+
+    def edit_tiles(self, x, y, tile_types)->int:
+        '''Change tiles of the game map. Only the chunks holding them are updated: their tiles,
+        the rects of the changed tiles in the spatial indexes and, when solid tiles changed, their
+        navigation links (rebuilt over the next steps). The renderer redraws them on next frame.
+        Chunks that are not loaded are loaded first.
+        * x, y: world tile coordinates, sequences or arrays of the same length
+        * tile_types: TileType of each tile, or one TileType for all. If a tile is given several
+          times, the last one is kept
+        return: number of tiles changed, given to the `tile_listeners`'''
+        x = np.asarray(x, dtype=np.int64).ravel()
+        y = np.asarray(y, dtype=np.int64).ravel()
+        tile_types = np.broadcast_to(np.asarray(tile_types, dtype=np.uint8), x.shape)
+        if not len(x):
+            return 0
+        # last edit of each tile, grouped by chunk
+        chunk_x, column = np.divmod(x, CHUNK_SIZE)
+        chunk_y, row = np.divmod(y, CHUNK_SIZE)
+        order = np.lexsort((column, row, chunk_y, chunk_x)) # stable: the edits of a tile stay in order
+        x, y = x[order], y[order]
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = (x[1:] != x[:-1]) | (y[1:] != y[:-1])
+        edits = order[last]
+        chunk_x, chunk_y, row, column, tile_types = (chunk_x[edits], chunk_y[edits], row[edits],
+                                                     column[edits], tile_types[edits])
+        first = np.ones(len(edits), dtype=bool)
+        first[1:] = (chunk_x[1:] != chunk_x[:-1]) | (chunk_y[1:] != chunk_y[:-1])
+        starts = np.flatnonzero(first)
+        changes = []
+        for start, end in zip(starts.tolist(), starts[1:].tolist() + [len(edits)]):
+            chunk_position = chunk_key(int(chunk_x[start]), int(chunk_y[start]))
+            chunk = self.game_map.get(chunk_position)
+            if chunk is None:
+                self.add_chunk(self.chunk_streamer.wait(*chunk_position))
+                chunk = self.game_map[chunk_position]
+            rows, columns, new = row[start:end], column[start:end], tile_types[start:end]
+            old = chunk.tiles[rows, columns]
+            changed = old != new
+            if not changed.any():
                 continue
+            rows, columns, old, new = rows[changed], columns[changed], old[changed], new[changed]
+            chunk.tiles[rows, columns] = new
+            tile_x = (columns + chunk.x * CHUNK_SIZE).tolist()
+            tile_y = (rows + chunk.y * CHUNK_SIZE).tolist()
+            for tx, ty, before, after in zip(tile_x, tile_y, old.tolist(), new.tolist()):
+                before_index = self.tile_rects_index(before)
+                after_index = self.tile_rects_index(after)
+                if before_index is not after_index:
+                    rect = pygame.Rect(tx*16,ty*16,16,16)
+                    if before_index is not None:
+                        before_index.remove(rect, chunk_position)
+                    if after_index is not None:
+                        after_index.insert(rect, chunk_position)
+            if (solid_tiles[old] != solid_tiles[new]).any():
+                self.navigation.add_chunk(chunk_position, solid_tiles[chunk.tiles])
+            self.changed_chunks.add(chunk_position)
+            changes.append((tile_x, tile_y, old, new))
+        if not changes:
+            return 0
+        tile_x, tile_y, old, new = (np.concatenate(arrays) for arrays in zip(*changes))
+        for listener in self.tile_listeners:
+            listener(tile_x, tile_y, old, new)
+        return len(tile_x)
+
+    def set_tile(self, x:int, y:int, tile_type:TileType)->bool:
+        '''Put a tile at world tile coordinates (x, y), see `edit_tiles`.
+        return: whether the tile changed'''
+        return self.edit_tiles([x], [y], tile_type) > 0
+
+    def clear_tile(self, x:int, y:int)->bool:
+        '''Remove the tile at world tile coordinates (x, y).
+        return: whether there was one'''
+        return self.set_tile(x, y, TileType.NOTHING)
+
+    def fill_tiles(self, area:pygame.Rect, tile_type:TileType)->int:
+        '''Set every tile of `area` (in world tile coordinates) to `tile_type`, see `edit_tiles`.
+        return: number of tiles changed'''
+        y, x = np.mgrid[area.top:area.bottom, area.left:area.right]
+        return self.edit_tiles(x, y, tile_type)
+
+    def unload_far_chunks(self)->None:
+        '''Save the chunks furthest from the camera to disk once too many are loaded'''
+        center = self.view_chunks.center
+        for chunk_position in self.game_map.trim(center[0], center[1]):
+            self.tile_index.remove_owner(chunk_position)
+            self.grass_index.remove_owner(chunk_position)
+            self.navigation.remove_chunk(chunk_position)
+
+    def load_chunks_around(self, x:float, y:float)->None:
+        '''Make sure the chunks around world position (x, y) are in the game map,
+        waiting for their generation if needed (needed for collisions).'''
+        center_x = int(x // (CHUNK_SIZE*16))
+        center_y = int(y // (CHUNK_SIZE*16))
+        for chunk_y in range(center_y - 1, center_y + 2):
+            for chunk_x in range(center_x - 1, center_x + 2):
+                if chunk_key(chunk_x, chunk_y) not in self.game_map:
+                    self.add_chunk(self.chunk_streamer.wait(chunk_x, chunk_y))
 
-            if tile.y > 10:
-                tile_type = TileType.DIRT
-                tile.type = TileType.DIRT
-            elif tile.y == 10:
-                tile_type = TileType.GRASS
-                tile.type = TileType.GRASS
-            elif tile.y == 9:
-                if not randint(0,4):
-                    tile_type = TileType.PLANT
-                    tile.type = TileType.PLANT
-            if tile_type != TileType.NOTHING:
-                tiles.append(tile)
-    return tiles
-
-
-e.load_animations('data/images/entities/')
-
-game_map:Dict[str,Tile] = {}
-
-jump_sounds = [pygame.mixer.Sound('data/audio/jump.wav'), pygame.mixer.Sound('data/audio/jump2.wav')]
-grass_sounds = [pygame.mixer.Sound('data/audio/grass_0.wav'),pygame.mixer.Sound('data/audio/grass_1.wav')]
-grass_sounds[0].set_volume(0.2)
-grass_sounds[1].set_volume(0.2)
-
-pygame.mixer.music.load('data/audio/music.wav')
-pygame.mixer.music.play(-1)
-
-grass_sound_timer = 0
-
-player = e.Entity(0,100,5,13,'player')
-grass_tiles:List[pygame.Rect] = []
-
-# background tiles
-BG_OBJ_WIDTH = 40
-BG_OBJ_HEIGHT = 100
-BG_OBJ_X =  0 - round(BG_OBJ_WIDTH/2)
-BG_OBJ_Y = 150+16-BG_OBJ_HEIGHT
-background_objects = [
-    BackgroundObject(parallax/100,          
-                    pygame.Rect(BG_OBJ_X + round(randint(-DISPLAY_SIZE[0]/2, (DISPLAY_SIZE[0]-BG_OBJ_WIDTH)/2+BG_OBJ_WIDTH)*100/parallax),
-                                 BG_OBJ_Y,
-                                 BG_OBJ_WIDTH,
-                                 BG_OBJ_HEIGHT
-                                 )
-                    ) for parallax in range(6, 101)]
-
-####
-# game loop
-###########
-while True:
-    display.fill(color=(146,244,255)) # clear screen by filling it with blue
-
-    # grass sound adjustment
-    grass_sound_timer -= 1
-    grass_sound_timer = max(grass_sound_timer, 0)
-
-    # camera
-    true_scroll.x += (player.x-true_scroll.x-DISPLAY_SIZE[0]/2)#/20
-    true_scroll.y += (player.y-true_scroll.y-106)#/20
-    scroll = true_scroll.copy()
-    scroll.x = int(scroll.x)
-    scroll.y = int(scroll.y)
-
-    # draw background elements
-    ## ground past the tiles
-    pygame.draw.rect(display,
-                     color=(160,150,14),
-                     rect=pygame.Rect(0,
-                                      player.y - scroll.y,
-                                      DISPLAY_SIZE[0],DISPLAY_SIZE[1]))
-
-    ## background structures
-    for background_object in background_objects:
-        if background_object.is_viewable():
-            tint1 = round((1-(1 - background_object.parallax)) * 255)
-            tint2 = round((1 - background_object.parallax) * 255)
-            draw_rect = get_draw_rect(background_object.rect, background_object.parallax)
-            pygame.draw.rect(display,(tint1,tint2,255),draw_rect)
-    
-    # generate and display tiles
-    tile_rects = []
-    grass_tiles = []
-    for y in range(6):
-        for x in range(7):
-            target_x = x - 1 + int(round(scroll.x/(CHUNK_SIZE*16)))
-            target_y = y - 1 + int(round(scroll.y/(CHUNK_SIZE*16)))
-            chunk_position = str(target_x) + ';' + str(target_y)
-            if chunk_position not in game_map:
-                game_map[chunk_position] = generate_chunk(target_x, target_y)
-            for tile in game_map[chunk_position]:
-                display.blit(tile.type.value,(tile.x*16-scroll.x, tile.y*16-scroll.y))
-                if tile.type in [TileType.GRASS, TileType.DIRT]:
-                    tile_rects.append(pygame.Rect(tile.x*16,tile.y*16,16,16))
-                if tile.type == TileType.PLANT:
-                    grass_tiles.append(pygame.Rect(tile.x*16,tile.y*16,16,16))
-
-    # player movement
-    player_movement = e.Vector(x=0,y=0)
-    if moving_right == True:
-        player_movement.x += 2
-    if moving_left == True:
-        player_movement.x -= 2
-    player_movement.y += vertical_momentum
-    vertical_momentum += 0.2
-    if vertical_momentum > 3:
-        vertical_momentum = 3
-
-    # player animations
-    if player_movement.x == 0:
-        player.set_action('idle')
-    if player_movement.x > 0:
-        player.set_flip(False)
-        player.set_action('run')
-    if player_movement.x < 0:
-        player.set_flip(True)
-        player.set_action('run')
-
-    # player collisions
-    collision_types = player.move(player_movement,tile_rects)
-    if collision_types['bottom'] == True:
-        # play grass sound
-        if air_timer > 3 or player_movement.x != 0:
-            if any((player.rect().colliderect(grass) for grass in grass_tiles)):
-                if grass_sound_timer == 0:
-                    grass_sound_timer = 30
-                    choice(grass_sounds).play()
-        air_timer = 0
-        vertical_momentum = 0
+    def apply_inputs(self, inputs:Inputs)->None:
+        self.moving_right = inputs.right
+        self.moving_left = inputs.left
+        if inputs.jump:
+            if self.air_timer < 600:
+                self.sound_events.append(('jump', self.player.x, self.player.y))
+                self.vertical_momentum = -JUMP_SPEED
+        if inputs.stop_jump and self.vertical_momentum < 0:
+            self.vertical_momentum = 0
+
+    def step(self, inputs:Inputs)->None:
+        '''Advance the simulation by one tick'''
+        self.sound_events.clear()
+        if self.renderer is None:
+            self.changed_chunks.clear()
+        if self.input_log is not None:
+            self.input_log.append(inputs.bits())
+        self.apply_inputs(inputs)
+        self.update_camera()
+        with profiler.section('chunks'):
+            self.update_chunks()
+        self.move_player()
+        with profiler.section('npcs'):
+            self.update_npcs()
+        self.tick += 1
+
+    def update_camera(self)->None:
+        player = self.player
+        self.true_scroll.x += (player.x-self.true_scroll.x-DISPLAY_SIZE[0]/2)#/20
+        self.true_scroll.y += (player.y-self.true_scroll.y-106)#/20
+        self.scroll = self.true_scroll.copy()
+        self.scroll.x = int(self.scroll.x)
+        self.scroll.y = int(self.scroll.y)
+
+    def update_chunks(self)->None:
+        '''Add the generated chunks, request the ones coming into view and unload the far ones'''
+        for _, chunk in self.chunk_streamer.collect():
+            self.add_chunk(chunk)
+        self.view_chunks = pygame.Rect(int(round(self.scroll.x/(CHUNK_SIZE*16))) - 1,
+                                       int(round(self.scroll.y/(CHUNK_SIZE*16))) - 1,
+                                       7, 6)
+        self.chunk_streamer.prefetch(self.view_chunks, self.player_movement, PREFETCH_DISTANCE)
+        self.unload_far_chunks()
+
+    def move_player(self)->None:
+        '''Move the player by the inputs applied, against the tiles'''
+        player = self.player
+        player_movement = e.Vector(x=0,y=0)
+        if self.moving_right == True:
+            player_movement.x += RUN_SPEED
+        if self.moving_left == True:
+            player_movement.x -= RUN_SPEED
+        player_movement.y += self.vertical_momentum
+        self.vertical_momentum += GRAVITY
+        if self.vertical_momentum > MAX_FALL_SPEED:
+            self.vertical_momentum = MAX_FALL_SPEED
+        self.player_movement = player_movement
+
+        # player animations
+        if player_movement.x == 0:
+            player.set_action('idle')
+        if player_movement.x > 0:
+            player.set_flip(False)
+            player.set_action('run')
+        if player_movement.x < 0:
+            player.set_flip(True)
+            player.set_action('run')
+
+        # player collisions
+        with profiler.section('physics'):
+            self.load_chunks_around(player.x, player.y)
+            collision_types = player.move(player_movement,self.tile_index,collect_data=False)
+        if collision_types['bottom'] == True:
+            # play grass sound
+            if self.air_timer > 3 or player_movement.x != 0:
+                player_rect = player.rect()
+                if player_rect.collidelist(self.grass_index.query(player_rect)) != -1:
+                    self.sound_events.append(('grass', player.x, player.y))
+            self.air_timer = 0
+            self.vertical_momentum = 0
+        else:
+            self.air_timer += 1
+
+        player.change_frame(1)
+
+    def player_state(self)->Tuple[float,float,int,int,float,int,bool,bool]:
+        '''return: what the next moves of the player depend on, besides the inputs and the tiles'''
+        player = self.player
+        return (player.x, player.y, player.obj.rect.x, player.obj.rect.y, self.vertical_momentum,
+                self.air_timer, self.moving_right, self.moving_left)
+
+    def set_player_state(self, state:Tuple[float,float,int,int,float,int,bool,bool])->None:
+        '''Put the player back in a `player_state`'''
+        x, y, rect_x, rect_y, self.vertical_momentum, self.air_timer, self.moving_right, self.moving_left = state
+        self.player.set_pos(x, y)
+        self.player.obj.rect.topleft = (rect_x, rect_y)
+
+    def spawn_npcs(self, count:int, spread:int=DISPLAY_SIZE[0]*2)->None:
+        '''Add `count` wandering NPCs around the player'''
+        for x in self.npc_rng.uniform(self.player.x - spread/2, self.player.x + spread/2, count).tolist():
+            self.behaviours.add(self.add_npc(x, self.player.y - 16))
+        if count:
+            self.npc_grid.update_many(self.npcs.ids[:len(self.npcs)].tolist(), self.npcs.rects())
+
+    def add_npc(self, x:float, y:float)->int:
+        '''return: id of a new NPC standing still at (x, y), without behaviour (see `spawn_npcs`)'''
+        return self.npcs.add(x, y, *NPC_SIZE, NPC_TYPE)
+
+    def npcs_on_chunks(self, area:pygame.Rect)->np.ndarray:
+        '''return: slots in `npcs` of the NPCs on the chunks of `area`'''
+        size = CHUNK_SIZE*16
+        position = self.npcs.position[:len(self.npcs)]
+        inside = ((position >= (area.left*size, area.top*size)) &
+                  (position < (area.right*size, area.bottom*size))).all(axis=1)
+        return np.flatnonzero(inside)
+
+    # NPC behaviours, see `behaviours`
+    def wander(self, slots:np.ndarray)->None:
+        '''Keep walking, jump over walls'''
+        velocity = self.npcs.velocity
+        jumping = slots[(self.npcs.blocked[slots] != 0) & (velocity[slots, 1] >= 0)]
+        velocity[jumping, 1] = -JUMP_SPEED
+        self.sound_events.extend(('jump', x, y) for x, y in self.npcs.position[jumping].tolist())
+
+    def decide_wander(self, entity_id:int)->str:
+        '''Pick a new direction, away from other NPCs when crowded. Follow the player once close.'''
+        npcs = self.npcs
+        slot = npcs.index(entity_id)
+        x, y = npcs.position[slot].tolist()
+        if np.hypot(self.player.x - x, self.player.y - y) < FOLLOW_DISTANCE:
+            return 'follow'
+        direction = int(self.npc_rng.integers(-1, 2))
+        crowd = [(distance, other) for distance, other in self.npc_grid.query_radius(x, y, CROWD_DISTANCE)
+                 if other != entity_id]
+        if crowd:
+            other_x = self.npc_grid.get(min(crowd)[1])[0]
+            direction = 1 if x >= other_x else -1
+        npcs.velocity[slot, 0] = direction * NPC_SPEED
+
+    def follow(self, slots:np.ndarray)->None:
+        '''Walk along the path to the player (jumping where it does), then to the player.
+        Jump over walls.'''
+        npcs = self.npcs
+        waypoint = npcs.waypoint[slots]
+        pathing = ~np.isnan(waypoint)
+        distance = np.where(pathing, waypoint, self.player.x) - npcs.position[slots, 0]
+        reached = pathing & (np.abs(distance) < 0.5)
+        leaping = reached & npcs.leap[slots]
+        # wait to be on the ground to jump
+        reached &= ~leaping | npcs.on_ground[slots]
+        npcs.velocity[slots, 0] = np.where(pathing, np.clip(distance, -NPC_SPEED, NPC_SPEED),
+                                           np.where(np.abs(distance) > 12, np.sign(distance) * NPC_SPEED, 0))
+        npcs.velocity[slots[leaping & reached], 1] = -JUMP_SPEED
+        for entity_id in npcs.ids[slots[reached]].tolist():
+            self.next_waypoint(entity_id)
+        self.wander(slots)
+
+    def decide_follow(self, entity_id:int)->str:
+        '''Look for a path to the player, or give up when it is too far'''
+        npcs = self.npcs
+        x, y = npcs.position[npcs.index(entity_id)].tolist()
+        if np.hypot(self.player.x - x, self.player.y - y) > LOSE_DISTANCE:
+            self.set_path(entity_id, None)
+            return 'wander'
+        start = self.navigation.nearest_node(x, y)
+        goal = self.navigation.nearest_node(self.player.x, self.player.y)
+        if start is not None and goal is not None:
+            self.pathfinder.request(entity_id, start, goal)
+
+    def set_path(self, entity_id:int, path:List[Tuple[Tuple[int,int],int,float]])->None:
+        '''Make an NPC walk along a path of `navigation` (None to stop)'''
+        waypoints = []
+        for (node, kind, velocity), (previous, _, _) in zip(path[1:] if path else [], path or []):
+            if kind == JUMP:
+                # take off from the edge of the tile
+                takeoff = (previous[0] + 1)*16 - NPC_SIZE[0] if velocity > 0 else previous[0]*16
+                waypoints.append((takeoff, True))
+            waypoints.append((self.navigation.node_position(node)[0], False))
+        waypoints.reverse()
+        self.npc_paths[entity_id] = waypoints
+        self.next_waypoint(entity_id)
+
+    def next_waypoint(self, entity_id:int)->None:
+        slot = self.npcs.index(entity_id)
+        waypoints = self.npc_paths.get(entity_id)
+        x, leap = waypoints.pop() if waypoints else (np.nan, False)
+        self.npcs.waypoint[slot] = x
+        self.npcs.leap[slot] = leap
+
+    def update_npcs(self)->None:
+        '''Build the navigation graph around the NPCs, run their behaviours (off-screen NPCs less
+        often), then move them. NPCs in chunks that are not loaded are frozen. `npc_grid` follows them.'''
+        npcs = self.npcs
+        n = len(npcs)
+        if not n:
+            return
+        chunks = (npcs.position[:n] // (CHUNK_SIZE*16)).astype(np.int64)
+        keys, first, inverse = np.unique(e.SpatialHash.cell_keys(chunks[:,0], chunks[:,1]),
+                                         return_index=True, return_inverse=True)
+        occupied = chunks[first].tolist()
+        if self.navigation.dirty:
+            around = range(-NAV_MARGIN, NAV_MARGIN + 1)
+            self.navigation.update(NAV_CHUNKS_PER_STEP, {(x + dx, y + dy) for x, y in occupied
+                                                         for dy in around for dx in around})
+        with profiler.section('behaviours'):
+            follow = self.behaviours.state_ids[(NPC_TYPE, 'follow')]
+            for entity_id, path in self.pathfinder.collect():
+                if entity_id in npcs and npcs.state[npcs.index(entity_id)] == follow:
+                    self.set_path(entity_id, path)
+            self.behaviours.update(viewable(npcs.position[:n,0], npcs.size[:n,0], self.scroll))
+        velocity = npcs.velocity[:n]
+        walking = velocity[:,0] != 0
+        npcs.set_action(walking, 'run')
+        npcs.set_action(~walking, 'idle')
+        npcs.flip[:n][walking] = velocity[walking, 0] < 0
+
+        loaded = np.array([chunk_key(x, y) in self.game_map for x, y in occupied], dtype=bool)
+        npcs.update(self.tile_index, loaded[inverse])
+        self.npc_grid.update_many(npcs.ids[:n].tolist(), npcs.rects())
+
+    def run(self, inputs:Iterable[Inputs])->int:
+        '''Step the simulation as fast as possible, once per item of `inputs`.
+        return: number of steps done'''
+        steps = 0
+        for tick_inputs in inputs:
+            with profiler.section('step'):
+                self.step(tick_inputs)
+            profiler.end_frame()
+            steps += 1
+        return steps
+
+    def state(self)->Tuple[Dict[str,Any],Dict[str,np.ndarray]]:
+        '''return: (meta, arrays), everything the next steps depend on (see `set_state`):
+        the loaded and saved chunks, the player, the NPCs, the random generator and the timers.
+        The navigation chunks waiting to be rebuilt are built first.'''
+        self.navigation.update()
+        player = self.player
+        resident = list(self.game_map)
+        saved = self.game_map.saved()
+        meta = {
+            'seed': self.seed,
+            'tick': self.tick,
+            'chunks_added': self.chunks_added,
+            'resident_chunks': resident,
+            'saved_chunks': saved,
+            'pending_chunks': list(self.chunk_streamer.pending),
+            'player': [player.x, player.y, player.obj.rect.x, player.obj.rect.y,
+                       player.action, player.animation_frame, player.flip],
+            'player_movement': [self.player_movement.x, self.player_movement.y],
+            'moving': [self.moving_right, self.moving_left],
+            'vertical_momentum': self.vertical_momentum,
+            'air_timer': self.air_timer,
+            'true_scroll': [self.true_scroll.x, self.true_scroll.y],
+            'scroll': [self.scroll.x, self.scroll.y],
+            'view_chunks': list(self.view_chunks),
+            'npc_rng': self.npc_rng.bit_generator.state,
+            'npc_paths': list(self.npc_paths.items()),
+            'path_requests': [[key, future.query] for key, future in self.pathfinder.pending.items()],
+            'behaviour_tick': self.behaviours.tick,
+            'decisions': self.behaviours.scheduler.get_state(),
+        }
+        shape = (-1, CHUNK_SIZE, CHUNK_SIZE)
+        arrays = {
+            'resident_chunks': np.array([self.game_map[position].tiles for position in resident],
+                                        dtype=np.uint8).reshape(shape),
+            'saved_chunks': np.array([self.game_map.load(*position).tiles for position in saved],
+                                     dtype=np.uint8).reshape(shape),
+        }
+        meta['npcs'], npc_arrays = self.npcs.get_state()
+        for name, array in npc_arrays.items():
+            arrays['npcs.' + name] = array
+        return meta, arrays
+
+    def set_state(self, meta:Dict[str,Any], arrays:Dict[str,np.ndarray])->None:
+        '''Put a new World (with the same seed) in a state returned by `state`'''
+        if meta['seed'] != self.seed:
+            raise ValueError(f'state of a world of seed {meta["seed"]}, this one is {self.seed}')
+        if self.tick or len(self.game_map) or len(self.npcs):
+            raise ValueError('only a new World can be set to a state')
+        for position, tiles in zip(meta['saved_chunks'], arrays['saved_chunks']):
+            self.game_map.write(tuple(position), Chunk(*position, tiles.copy()))
+        for position, tiles in zip(meta['resident_chunks'], arrays['resident_chunks']):
+            self.add_chunk(Chunk(*position, tiles.copy()))
+        self.navigation.update()
+        for position in meta['pending_chunks']:
+            self.chunk_streamer.request(*position)
+        self.chunks_added = meta['chunks_added']
+        self.tick = meta['tick']
+
+        player = self.player
+        x, y, rect_x, rect_y, action, frame, flip = meta['player']
+        player.set_pos(x, y)
+        player.obj.rect.topleft = (rect_x, rect_y)
+        player.set_action(action, force=True)
+        player.set_frame(frame)
+        player.set_flip(flip)
+        self.player_movement = e.Vector(*meta['player_movement'])
+        self.moving_right, self.moving_left = meta['moving']
+        self.vertical_momentum = meta['vertical_momentum']
+        self.air_timer = meta['air_timer']
+        self.true_scroll = e.Vector(*meta['true_scroll'])
+        self.scroll = e.Vector(*meta['scroll'])
+        self.view_chunks = pygame.Rect(meta['view_chunks'])
+
+        self.npc_rng.bit_generator.state = meta['npc_rng']
+        npcs = self.npcs
+        npcs.set_state(meta['npcs'], {name[len('npcs.'):]: array for name, array in arrays.items()
+                                      if name.startswith('npcs.')})
+        if len(npcs):
+            self.npc_grid.update_many(npcs.ids[:len(npcs)].tolist(), npcs.rects())
+        self.npc_paths = {entity_id: [tuple(waypoint) for waypoint in waypoints]
+                          for entity_id, waypoints in meta['npc_paths']}
+        for key, (start, goal) in meta['path_requests']:
+            self.pathfinder.request(key, tuple(start), tuple(goal))
+        self.behaviours.tick = meta['behaviour_tick']
+        self.behaviours.scheduler.set_state(meta['decisions'], self.behaviours.decide_task)
+
+    def snapshot(self)->bytes:
+        '''return: the state of the world (see `state`), compressed'''
+        return encode_state(*self.state())
+
+    def restore(self, snapshot:bytes)->None:
+        '''Put a new World (with the same seed) in the state of `snapshot`'''
+        self.set_state(*decode_state(snapshot))
+
+    @classmethod
+    def from_snapshot(cls, snapshot:bytes, save_dir:str=None)->'World':
+        '''return: a reproducible World (see REPRODUCIBLE_WORLD) in the state of `snapshot`'''
+        meta, arrays = decode_state(snapshot)
+        world = cls(meta['seed'], save_dir=save_dir, **REPRODUCIBLE_WORLD)
+        world.set_state(meta, arrays)
+        return world
+
+    def digest(self)->bytes:
+        '''return: hash of the state, equal for worlds in the same state'''
+        return state_digest(*self.state())
+
+    def close(self)->None:
+        self.chunk_streamer.shutdown()
+        self.pathfinder.shutdown()
+        if self.temporary_dir:
+            shutil.rmtree(self.game_map.path, ignore_errors=True)
+        else:
+            self.game_map.flush()
+
+
+def make_background_objects()->List[BackgroundObject]:
+    # background tiles
+    BG_OBJ_WIDTH = 40
+    BG_OBJ_HEIGHT = 100
+    BG_OBJ_X =  0 - round(BG_OBJ_WIDTH/2)
+    BG_OBJ_Y = 150+16-BG_OBJ_HEIGHT
+    return [
+        BackgroundObject(parallax/100,
+                        pygame.Rect(BG_OBJ_X + round(randint(-DISPLAY_SIZE[0]/2, (DISPLAY_SIZE[0]-BG_OBJ_WIDTH)/2+BG_OBJ_WIDTH)*100/parallax),
+                                     BG_OBJ_Y,
+                                     BG_OBJ_WIDTH,
+                                     BG_OBJ_HEIGHT
+                                     )
+                        ) for parallax in range(6, 101)]
+
+
+class Game:
+    def __init__(self, world:World, screen:pygame.Surface, dirty_rects:bool=False, step=None):
+        '''Window front end of a World: reads the keyboard, draws and plays sounds.
+        * dirty_rects: while the camera and the player stand still, only redraw and
+          push to the window the areas where other entities moved or animated
+        * step: function(inputs) advancing `world` by a tick, world.step by default
+          (e.g. NetClient.step)'''
+        self.world = world
+        world.renderer = self
+        self.step = step or world.step
+        self.screen = screen
+        self.display = pygame.Surface(DISPLAY_SIZE) # used as the surface for rendering, which is scaled
+        self.clock = pygame.time.Clock()
+        self.chunk_cache = e.ChunkCache(CHUNK_CACHE_BUDGET)
+        self.background_layers = ParallaxLayers(make_background_objects())
+        self.entities:List[e.Entity] = [] # drawn after the player
+        self.inputs = Inputs()
+        self.running = True
+
+        self.zoom = (WINDOW_SIZE[0] // DISPLAY_SIZE[0], WINDOW_SIZE[1] // DISPLAY_SIZE[1])
+        # partial redraws need the display to map onto whole screen pixels
+        self.dirty_rects = (dirty_rects and
+                            (DISPLAY_SIZE[0]*self.zoom[0], DISPLAY_SIZE[1]*self.zoom[1]) == WINDOW_SIZE)
+        self.full_redraw = True
+        self.dirty_areas:List[pygame.Rect] = [] # display areas to redraw on next frame
+        self.last_scene = None
+        self.last_sprites = []
+        self.last_npc_sprites = set() # EntityManager.drawn_sprites of the NPCs
+
+        self.audio = AudioManager(pan_width=DISPLAY_SIZE[0]/2)
+        self.audio.add_banks(assets.sounds, assets.manifest.get('sounds', {}))
+
+        if assets.music and os.path.exists(assets.music):
+            pygame.mixer.music.load(assets.music)
+            pygame.mixer.music.play(-1)
+
+    def handle_events(self)->None:
+        with profiler.section('events'):
+            events = pygame.event.get()
+        inputs = self.inputs
+        for event in events: # event loop
+            if event.type == QUIT:
+                self.running = False
+            if event.type == VIDEOEXPOSE:
+                self.full_redraw = True
+            if event.type == KEYDOWN:
+                if event.key == K_w:
+                    pygame.mixer.music.fadeout(1000)
+                if event.key == MoveKey.RIGHT.value:
+                    inputs.right = True
+                if event.key == MoveKey.LEFT.value:
+                    inputs.left = True
+                if event.key == MoveKey.UP.value:
+                    inputs.jump = True
+                if event.key == MoveKey.DOWN.value:
+                    inputs.stop_jump = True
+            if event.type == KEYUP:
+                if event.key == MoveKey.RIGHT.value:
+                    inputs.right = False
+                if event.key == MoveKey.LEFT.value:
+                    inputs.left = False
+                if event.key == MoveKey.UP.value:
+                    inputs.stop_jump = True
+
+    def play_sounds(self)->None:
+        '''Queue the sounds of the last step, played by the next `flush_sounds`'''
+        for name, x, y in self.world.sound_events:
+            self.audio.play(name, x, y)
+
+    def flush_sounds(self)->None:
+        '''Play the queued sounds heard from the center of the view'''
+        scroll = self.world.scroll
+        with profiler.section('audio'):
+            self.audio.set_listener(scroll.x + DISPLAY_SIZE[0]/2, scroll.y + DISPLAY_SIZE[1]/2)
+            self.audio.flush()
+
+    def mark_dirty(self, rect:pygame.Rect)->None:
+        '''Redraw an area of the display (e.g. an animated tile) on next frame'''
+        self.dirty_areas.append(rect)
+
+    def draw_scene(self)->None:
+        world = self.world
+        display = self.display
+        player = world.player
+        scroll = world.scroll
+        display.fill(color=(146,244,255)) # clear screen by filling it with blue
+
+        # draw background elements
+        with profiler.section('background'):
+            ## ground past the tiles
+            pygame.draw.rect(display,
+                             color=(160,150,14),
+                             rect=pygame.Rect(0,
+                                              int(player.y) - scroll.y,
+                                              DISPLAY_SIZE[0],DISPLAY_SIZE[1]))
+
+            ## background structures
+            for color, draw_rect in self.background_layers.visible(player, scroll):
+                pygame.draw.rect(display, color, draw_rect)
+
+        # display tiles
+        with profiler.section('tiles'):
+            view_chunks = world.view_chunks
+            for y in range(view_chunks.height):
+                for x in range(view_chunks.width):
+                    target_x = view_chunks.x + x
+                    target_y = view_chunks.y + y
+                    chunk_position = chunk_key(target_x, target_y)
+                    if chunk_position not in world.game_map:
+                        continue # still being generated
+                    if chunk_position not in self.chunk_cache:
+                        self.chunk_cache[chunk_position] = render_chunk(world.game_map[chunk_position])
+                    chunk_surface = self.chunk_cache[chunk_position]
+                    if chunk_surface is not None:
+                        display.blit(chunk_surface, (target_x*CHUNK_SIZE*16-scroll.x, target_y*CHUNK_SIZE*16-scroll.y))
+
+        # player visuals
+        with profiler.section('entities'):
+            player.display(display,scroll)
+            world.npcs.display(display,scroll)
+            for entity in self.entities:
+                entity.display(display,scroll)
+
+    def present(self, areas:List[pygame.Rect]=None)->None:
+        '''Scale the display (or only `areas` of it) onto the screen and push it to the window'''
+        zoom_x, zoom_y = self.zoom
+        with profiler.section('scale'):
+            if areas is None:
+                pygame.transform.scale(self.display, WINDOW_SIZE, self.screen)
+            else:
+                screen_areas = []
+                for area in areas:
+                    screen_area = pygame.Rect(area.x*zoom_x, area.y*zoom_y, area.w*zoom_x, area.h*zoom_y)
+                    pygame.transform.scale(self.display.subsurface(area), screen_area.size,
+                                           self.screen.subsurface(screen_area))
+                    screen_areas.append(screen_area)
+        overlay = profiler.draw(self.screen)
+        with profiler.section('update'):
+            if areas is None:
+                pygame.display.update()
+            else:
+                pygame.display.update(screen_areas + ([overlay] if overlay else []))
+
+    def render(self)->None:
+        world = self.world
+        scroll = world.scroll
+        player = world.player
+        # chunks replaced or edited: rendered again and redrawn
+        chunk_areas = []
+        for chunk_x, chunk_y in world.changed_chunks:
+            self.chunk_cache.invalidate(chunk_key(chunk_x, chunk_y))
+            chunk_areas.append(pygame.Rect(chunk_x*CHUNK_SIZE*16-scroll.x, chunk_y*CHUNK_SIZE*16-scroll.y,
+                                           CHUNK_SIZE*16, CHUNK_SIZE*16))
+        world.changed_chunks.clear()
+        scene = (scroll.x, scroll.y, int(player.x), int(player.y), world.chunks_added)
+        sprites = [(entity.get_current_img(), entity.get_drawn_rect(scroll)) for entity in [player] + self.entities]
+        npc_sprites = world.npcs.drawn_sprites(self.display, scroll) if self.dirty_rects else set()
+        full_redraw = (not self.dirty_rects or self.full_redraw or scene != self.last_scene
+                       or len(sprites) != len(self.last_sprites))
+        areas = None
+        if not full_redraw:
+            areas = self.dirty_areas + chunk_areas
+            for sprite, last_sprite in zip(sprites, self.last_sprites):
+                if sprite != last_sprite:
+                    areas.extend((sprite[1], last_sprite[1]))
+            # NPCs that appeared, moved, changed frame or went away
+            areas.extend(pygame.Rect(sprite[2:]) for sprite in npc_sprites ^ self.last_npc_sprites)
+            if profiler.enabled:
+                overlay = profiler.overlay_rect()
+                areas.append(pygame.Rect(overlay.x // self.zoom[0], overlay.y // self.zoom[1],
+                                         -(-overlay.w // self.zoom[0]) + 1, -(-overlay.h // self.zoom[1]) + 1))
+            display_rect = self.display.get_rect()
+            areas = [area.inflate(2, 2).clip(display_rect) for area in areas if area]
+            areas = [area for area in areas if area.w and area.h]
+            if len(areas) > 8:
+                areas = [areas[0].unionall(areas[1:])]
+        self.last_scene = scene
+        self.last_sprites = sprites
+        self.last_npc_sprites = npc_sprites
+        self.full_redraw = False
+        self.dirty_areas.clear()
+
+        if areas is None:
+            self.draw_scene()
+            self.present()
+        elif areas:
+            for area in areas:
+                self.display.set_clip(area)
+                self.draw_scene()
+            self.display.set_clip(None)
+            self.present(areas)
+
+    def run(self)->None:
+        '''Game loop: the world is stepped TICK_RATE times per second whatever the frame rate'''
+        tick_time = 1 / TICK_RATE
+        lag = tick_time # step once before the first frame
+        previous = time.perf_counter()
+        while self.running:
+            self.handle_events()
+            now = time.perf_counter()
+            lag += now - previous
+            previous = now
+            steps = 0
+            while lag >= tick_time and steps < MAX_STEPS_PER_FRAME:
+                with profiler.section('step'):
+                    self.step(self.inputs)
+                self.inputs.clear_presses()
+                self.play_sounds()
+                lag -= tick_time
+                steps += 1
+            if steps == MAX_STEPS_PER_FRAME:
+                lag = 0 # too far behind, slow the game down instead of spiraling
+            self.flush_sounds()
+            self.render()
+            profiler.end_frame()
+            self.clock.tick(60)
+
+
+def demo_inputs(ticks:int)->Iterator[Inputs]:
+    '''Scripted inputs: run right and jump every second'''
+    for tick in range(ticks):
+        yield Inputs(right=True, jump=tick % TICK_RATE == 0)
+
+
+def enable_profiler(dump:bool=False)->None:
+    '''Turn on the timing sections and time the engine's hot functions'''
+    profiler.enabled = True
+    profiler.record = dump
+    profiler.instrument(e.Physics_obj, 'move', 'Physics_obj.move')
+    profiler.instrument(e.Entity, 'display', 'Entity.display')
+    profiler.instrument(e.ChunkStreamer, 'wait', 'chunk_wait')
+    profiler.instrument(sys.modules[__name__], 'render_chunk')
+
+
+def main(argv:List[str]=None)->None:
+    parser = argparse.ArgumentParser(description='Pygame Platformer')
+    parser.add_argument('--headless', action='store_true',
+                        help='run the simulation without window, sound nor frame limit')
+    parser.add_argument('--ticks', type=int, default=TICK_RATE*60,
+                        help='number of simulation steps to run in headless mode')
+    parser.add_argument('--seed', type=int, default=WORLD_SEED, help='world seed')
+    parser.add_argument('--save-dir', help='directory keeping the explored chunks between runs')
+    parser.add_argument('--npcs', type=int, default=0, help='number of wandering NPCs around the player')
+    parser.add_argument('--dirty-rects', action='store_true',
+                        help='only redraw and update the parts of the window that changed')
+    parser.add_argument('--asset-report', action='store_true',
+                        help='print the load time of each asset')
+    parser.add_argument('--profile', action='store_true',
+                        help='time the game loop and show the timings on screen')
+    parser.add_argument('--profile-dump', metavar='PATH',
+                        help='profile and write every frame timings to a .csv or .json file')
+    parser.add_argument('--record', metavar='PATH',
+                        help='save the starting state and the inputs of every tick, for --replay')
+    parser.add_argument('--replay', metavar='PATH',
+                        help='replay a recording without window as fast as possible')
+    parser.add_argument('--serve', action='store_true',
+                        help='run the simulation without window for --ticks ticks, for the clients of --connect')
+    parser.add_argument('--connect', metavar='HOST', help='play on the server of --serve on HOST')
+    parser.add_argument('--port', type=int, default=NET_PORT, help='port of --serve and --connect')
+    parser.add_argument('--protocol', choices=('udp', 'tcp'), default='udp', help='of --serve and --connect')
+    parser.add_argument('--net-test', action='store_true',
+                        help='run a server and a client in this process over a simulated link, print the traffic')
+    parser.add_argument('--latency', type=float, default=100, help='of the --net-test link (ms, one way)')
+    parser.add_argument('--loss', type=float, default=0, help='fraction of the --net-test packets lost')
+    args = parser.parse_args(argv)
+    if args.profile or args.profile_dump:
+        enable_profiler(dump=bool(args.profile_dump))
+
+    headless = args.headless or bool(args.replay) or args.serve or args.net_test
+    screen = init_pygame(headless)
+    load_assets(sounds=not headless)
+    if args.asset_report:
+        print(assets.report())
+    if args.serve or args.connect or args.net_test:
+        run_network(args, World, lambda world, step: Game(world, screen, args.dirty_rects, step).run(),
+                    demo_inputs(args.ticks), TICK_RATE)
+        pygame.quit()
+        return
+    recording = None
+    if args.replay:
+        recording = Recording.load(args.replay)
+        world = World.from_snapshot(recording.snapshot, args.save_dir)
+    elif args.record:
+        world = World(args.seed, save_dir=args.save_dir, **REPRODUCIBLE_WORLD)
+        world.spawn_npcs(args.npcs)
+        recording = Recording(world.snapshot(), InputLog())
+        world.input_log = recording.inputs
     else:
-        air_timer += 1
-
-    # player visuals
-    player.change_frame(1)
-    player.display(display,scroll)
-
-    # key inputs
-    for event in pygame.event.get(): # event loop
-        if event.type == QUIT:
-            pygame.quit()
-            sys.exit()
-        if event.type == KEYDOWN:
-            if event.key == K_w:
-                pygame.mixer.music.fadeout(1000)
-            if event.key == MoveKey.RIGHT.value:
-                moving_right = True
-            if event.key == MoveKey.LEFT.value:
-                moving_left = True
-            if event.key == MoveKey.UP.value:
-                if air_timer < 600:
-                    choice(jump_sounds).play()
-                    vertical_momentum = -5
-            if event.key == MoveKey.DOWN.value and vertical_momentum < 0:
-                    vertical_momentum = 0
-        if event.type == KEYUP:
-            if event.key == MoveKey.RIGHT.value:
-                moving_right = False
-            if event.key == MoveKey.LEFT.value:
-                moving_left = False
-            if event.key == MoveKey.UP.value and vertical_momentum < 0:
-                vertical_momentum = 0
-        
-    screen.blit(pygame.transform.scale(display,WINDOW_SIZE),(0,0))
-    pygame.display.update()
-    clock.tick(60)
+        world = World(args.seed, save_dir=args.save_dir)
+        world.spawn_npcs(args.npcs)
+    # what exists by now lives until the end, keep the garbage collector from scanning it
+    gc.freeze()
+    if headless:
+        if args.replay:
+            inputs = (Inputs.from_bits(bits) for bits in recording.inputs)
+        else:
+            inputs = demo_inputs(args.ticks)
+        start = time.perf_counter()
+        steps = world.run(inputs)
+        duration = time.perf_counter() - start
+        print(f'{steps} ticks in {duration:.3f}s ({steps/duration:.0f} ticks/s), '
+              f'player at {world.player.x:.1f}, {world.player.y:.1f}')
+    else:
+        Game(world, screen, args.dirty_rects).run()
+    if args.replay and recording.digest is not None:
+        same = world.digest() == recording.digest
+        print('final state ' + ('matches the recording' if same else 'differs from the recording'))
+    elif args.record:
+        recording.digest = world.digest()
+        recording.save(args.record)
+    world.close()
+    pygame.quit()
+    if args.profile_dump:
+        profiler.dump(args.profile_dump)
+    if profiler.enabled:
+        for name in sorted(profiler.samples):
+            p50, p99 = profiler.percentiles(name)
+            print(f'{name:<18} p50 {p50*1000:7.3f}ms  p99 {p99*1000:7.3f}ms')
+
+
+if __name__ == '__main__':
+    main()
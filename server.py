@@ -0,0 +1,125 @@
+'''Runs many independent worlds headless, spread over a pool of processes.
+
+    python server.py --worlds 8                  # 8 worlds at TICK_RATE ticks per second
+    python server.py --worlds 8 --rate 0         # as fast as possible, to measure throughput
+    python server.py --worlds 8 --processes 2 --npcs 200 --ticks 3600
+
+The assets are loaded once by the server process before the workers are forked, so the
+images and the engine's animation database are shared (copy-on-write) by every world.
+Each world is stepped by scripted bot inputs; the tick times of every world are reported.
+'''
+from typing import Dict, List, Tuple
+import argparse
+import gc
+import multiprocessing
+import os
+import sys
+import time
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+# SDL would turn SIGTERM into a quit event: the pool could not stop its workers
+os.environ.setdefault('SDL_NO_SIGNAL_HANDLERS', '1')
+
+import main
+
+
+def tick_metrics(times:List[float], late:int)->Dict[str,float]:
+    '''return: statistics (in ms) of the tick times of a world'''
+    ordered = sorted(times)
+    def percentile(p):
+        return ordered[min(len(ordered)-1, int(len(ordered)*p))] * 1000 if ordered else 0
+    return {'ticks': len(times),
+            'mean_ms': sum(times) / len(times) * 1000 if times else 0,
+            'p50_ms': percentile(0.5),
+            'p99_ms': percentile(0.99),
+            'max_ms': ordered[-1] * 1000 if ordered else 0,
+            'late': late}
+
+
+def run_worlds(task:Tuple[List[int],argparse.Namespace])->List[Tuple[int,Dict[str,float]]]:
+    '''Step the worlds of `indexes` in turn at `args.rate` ticks per second (0: as fast as possible).
+    Runs in a worker process. A world is late on the ticks its step takes more than its share of
+    the tick time (the tick time over the number of worlds of the worker), which makes the
+    worker miss the rate if the other worlds take their whole share.
+    return: (world index, tick metrics) of each world'''
+    indexes, args = task
+    if main.assets is None:
+        # started without fork: nothing is inherited from the server process
+        main.init_pygame(headless=True, audio=False)
+        main.load_assets(sounds=False)
+    worlds = []
+    for index in indexes:
+        world = main.World(args.seed + index, **main.REPRODUCIBLE_WORLD)
+        world.spawn_npcs(args.npcs)
+        worlds.append(world)
+    gc.freeze()
+    inputs = list(main.demo_inputs(args.ticks))
+    times:List[List[float]] = [[] for _ in worlds]
+    late = [0] * len(worlds)
+    tick_time = 1 / args.rate if args.rate else 0
+    share = tick_time / len(worlds) # of a tick, for each world stepped by this worker
+    deadline = time.perf_counter()
+    for tick_inputs in inputs:
+        deadline += tick_time
+        for i, (world, world_times) in enumerate(zip(worlds, times)):
+            start = time.perf_counter()
+            world.step(tick_inputs)
+            duration = time.perf_counter() - start
+            world_times.append(duration)
+            if tick_time and duration > share:
+                late[i] += 1
+        now = time.perf_counter()
+        if tick_time:
+            if now > deadline:
+                deadline = now # do not try to catch up
+            else:
+                time.sleep(deadline - now)
+    for world in worlds:
+        world.close()
+    return [(index, tick_metrics(world_times, world_late))
+            for index, world_times, world_late in zip(indexes, times, late)]
+
+
+def main_server(argv:List[str]=None)->int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--worlds', type=int, default=4, help='number of worlds')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help='worker processes (default: one per core)')
+    parser.add_argument('--ticks', type=int, default=main.TICK_RATE*10, help='ticks run by every world')
+    parser.add_argument('--rate', type=float, default=main.TICK_RATE,
+                        help='ticks per second of every world, 0 for as fast as possible')
+    parser.add_argument('--npcs', type=int, default=0, help='NPCs in every world')
+    parser.add_argument('--seed', type=int, default=main.WORLD_SEED, help='seed of the first world')
+    args = parser.parse_args(argv)
+
+    processes = max(1, min(args.processes, args.worlds))
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+    if context.get_start_method() == 'fork':
+        # loaded once, shared by the forked workers; frozen so the collector does not touch their pages.
+        # No mixer: its thread could hold a lock at fork time and deadlock a worker
+        main.init_pygame(headless=True, audio=False)
+        main.load_assets(sounds=False)
+        gc.freeze()
+    tasks = [(list(range(worker, args.worlds, processes)), args) for worker in range(processes)]
+    start = time.perf_counter()
+    with context.Pool(processes) as pool:
+        results = [result for worker_results in pool.map(run_worlds, tasks) for result in worker_results]
+        pool.close()
+        pool.join()
+    duration = time.perf_counter() - start
+
+    print(f'{"world":<8}{"ticks":>8}{"mean":>10}{"p50":>10}{"p99":>10}{"max":>10}{"late":>8}')
+    for index, metrics in sorted(results):
+        print(f'{index:<8}{metrics["ticks"]:>8}{metrics["mean_ms"]:>8.3f}ms{metrics["p50_ms"]:>8.3f}ms'
+              f'{metrics["p99_ms"]:>8.3f}ms{metrics["max_ms"]:>8.3f}ms{metrics["late"]:>8}')
+    ticks = sum(metrics['ticks'] for _, metrics in results)
+    busy = sum(metrics['mean_ms'] * metrics['ticks'] for _, metrics in results) / 1000
+    print(f'{args.worlds} worlds on {processes} processes: {ticks} ticks in {duration:.2f}s '
+          f'({ticks/duration:.0f} ticks/s, {busy/duration/processes:.0%} of the workers busy stepping)')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_server())
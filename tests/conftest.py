@@ -0,0 +1,12 @@
+import pytest
+
+import main
+
+
+@pytest.fixture(scope='session')
+def assets():
+    '''Headless pygame with the game assets loaded, as main.World needs them'''
+    if main.assets is None:
+        main.init_pygame(headless=True, audio=False)
+        main.load_assets(sounds=False)
+    return main.assets
@@ -0,0 +1,54 @@
+import numpy as np
+
+import data.engine as e
+import main
+from main import CHUNK_SIZE, TileType
+
+
+def chunk_store(path, max_chunks:int=None)->e.ChunkStore:
+    return e.ChunkStore(str(path), CHUNK_SIZE*CHUNK_SIZE, main.encode_chunk, main.decode_chunk, max_chunks=max_chunks)
+
+
+def test_evicted_chunk_reloads_edited(tmp_path):
+    store = chunk_store(tmp_path)
+    chunk = main.generate_chunk(-3, 1, seed=7)
+    chunk.tiles[2, 4] = TileType.NOTHING
+    chunk.tiles[0, :] = TileType.DIRT
+    store[(-3, 1)] = chunk
+    store.evict((-3, 1))
+    assert (-3, 1) not in store
+    loaded = store.load(-3, 1)
+    assert (loaded.x, loaded.y) == (-3, 1)
+    assert np.array_equal(loaded.tiles, chunk.tiles)
+    assert store.saved() == [(-3, 1)]
+
+
+def test_never_stored_chunk_loads_none(tmp_path):
+    store = chunk_store(tmp_path)
+    assert store.load(0, 0) is None # no region file
+    store[(1, 1)] = main.generate_chunk(1, 1)
+    store.evict((1, 1))
+    assert store.load(2, 1) is None # in the region file of (1, 1)
+    assert store.load(100, -100) is None
+
+
+def test_trim_evicts_furthest(tmp_path):
+    store = chunk_store(tmp_path, max_chunks=2)
+    for chunk_x in range(4):
+        store[(chunk_x, 0)] = main.generate_chunk(chunk_x, 0)
+    assert sorted(store.trim(0, 0)) == [(2, 0), (3, 0)]
+    assert sorted(store) == [(0, 0), (1, 0)]
+    assert np.array_equal(store.load(3, 0).tiles, main.generate_chunk(3, 0).tiles)
+
+
+def test_world_keeps_edits_of_unloaded_chunks(assets):
+    world = main.World(2, **main.REPRODUCIBLE_WORLD)
+    try:
+        world.update_chunks()
+        assert world.clear_tile(3, 10) # grass of chunk (0, 1)
+        world.game_map.evict((0, 1))
+        chunk = world.load_chunk(0, 1)
+        assert chunk.tiles[10 - CHUNK_SIZE, 3] == TileType.NOTHING
+        assert not np.array_equal(chunk.tiles, main.generate_chunk(0, 1, world.seed).tiles)
+    finally:
+        world.close()
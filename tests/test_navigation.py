@@ -0,0 +1,32 @@
+import numpy as np
+
+from data.navigation import NavGraph
+
+
+def ground(chunk_size:int=8)->np.ndarray:
+    solid = np.zeros((chunk_size, chunk_size), dtype=bool)
+    solid[-1] = True
+    return solid
+
+
+def test_update_only_builds_chunks_near():
+    graph = NavGraph(8)
+    for chunk_x in range(10):
+        graph.add_chunk((chunk_x, 0), ground())
+    assert graph.update(near={(0, 0), (1, 0), (20, 0)}) == 2
+    assert (0, 0) in graph and (1, 0) in graph and (5, 0) not in graph
+    assert graph.nearest_node(0, 16*7 - 13) == (0, 6)
+    assert graph.update() == 8 # the others, once asked for all
+    assert (9, 0) in graph
+
+
+def test_dirty_chunks_are_resident():
+    graph = NavGraph(8)
+    graph.add_chunk((0, 0), ground())
+    assert graph.dirty == {(0, 0)} # the neighbours are built once added
+    graph.add_chunk((1, 0), ground())
+    graph.remove_chunk((0, 0))
+    assert graph.dirty == {(1, 0)}
+    version = graph.version
+    assert graph.update(near=set()) == 0
+    assert graph.version == version # nothing changed, paths found before still hold
@@ -0,0 +1,151 @@
+from typing import List
+
+import numpy as np
+import pytest
+
+import main
+from data.netplay import NET_POSITION_SCALE, NetClient, NetServer
+from data.network import NO_TICK, LoopbackHost, SnapshotChannel, SnapshotReceiver, Transport
+
+
+def rows(*pairs):
+    '''return: (ids, values) of rows given as (id, value), a single field each'''
+    ids = np.array([entity_id for entity_id, _ in pairs], dtype=np.int64)
+    values = np.array([[value] for _, value in pairs], dtype=np.int32).reshape(-1, 1)
+    return ids, values
+
+
+def assert_snapshot(decoded, ids, values):
+    snapshot, _ = decoded
+    assert snapshot.ids.tolist() == ids.tolist()
+    assert snapshot.values.tolist() == values.tolist()
+
+
+def test_snapshot_deltas_against_acknowledged_state():
+    channel = SnapshotChannel(1)
+    receiver = SnapshotReceiver()
+    first = rows((1, 10), (2, 20), (3, 30))
+    assert_snapshot(receiver.decode(channel.encode(1, *first, {})), *first)
+    channel.ack(*receiver.acks())
+    second = rows((1, 10), (3, 31), (4, 40)) # 2 removed, 3 changed, 4 added
+    assert_snapshot(receiver.decode(channel.encode(2, *second, {})), *second)
+    assert channel.stats['full'] == 1
+    assert channel.stats['rows'] == 3 + 2
+
+
+def test_ack_bitfield():
+    channel = SnapshotChannel(1)
+    receiver = SnapshotReceiver()
+    assert receiver.acks() == (NO_TICK, 0)
+    messages = [channel.encode(tick, *rows((1, tick)), {}) for tick in range(1, 6)]
+    for tick in (1, 2, 4, 5): # 3 is lost
+        receiver.decode(messages[tick - 1])
+    # bit i: tick 5 - 1 - i was received
+    assert receiver.acks() == (5, 0b1101)
+    channel.ack(*receiver.acks())
+    assert channel.baseline.tick == 5
+
+
+def test_lost_messages_encoded_against_older_baseline():
+    channel = SnapshotChannel(1)
+    receiver = SnapshotReceiver()
+    receiver.decode(channel.encode(1, *rows((1, 1), (2, 2)), {}))
+    channel.ack(*receiver.acks())
+    channel.encode(2, *rows((1, 5), (2, 2)), {}) # lost
+    channel.encode(3, *rows((1, 6)), {}) # lost
+    latest = rows((1, 7), (3, 3))
+    assert_snapshot(receiver.decode(channel.encode(4, *latest, {})), *latest)
+    assert channel.stats['full'] == 1
+
+
+def test_out_of_order_messages_are_stale():
+    channel = SnapshotChannel(1)
+    receiver = SnapshotReceiver()
+    older = channel.encode(1, *rows((1, 1)), {})
+    newer = channel.encode(2, *rows((1, 2)), {})
+    assert_snapshot(receiver.decode(newer), *rows((1, 2)))
+    assert receiver.decode(older) is None
+    assert receiver.acks() == (2, 0)
+
+
+def test_lost_chunk_sent_again():
+    channel = SnapshotChannel(1, resend_interval=4)
+    receiver = SnapshotReceiver()
+    chunks = {(0, 0): b'tiles'}
+    ids, values = rows()
+    channel.encode(1, ids, values, chunks) # lost
+    for tick in range(2, 6):
+        _, received = receiver.decode(channel.encode(tick, ids, values, chunks))
+        assert received == [] # still in flight
+        channel.ack(*receiver.acks())
+    _, received = receiver.decode(channel.encode(6, ids, values, chunks))
+    assert received == [((0, 0), b'tiles')]
+    channel.ack(*receiver.acks())
+    _, received = receiver.decode(channel.encode(7, ids, values, chunks))
+    assert received == [] # held by the client
+
+
+class Reordering(Transport):
+    '''Delivers every third batch of messages of `transport` after the next one'''
+
+    def __init__(self, transport:Transport):
+        super().__init__()
+        self.transport = transport
+        self.held:List[bytes] = []
+        self.calls = 0
+
+    def send(self, data:bytes)->None:
+        self.transport.send(data)
+
+    def receive(self)->List[bytes]:
+        messages = self.transport.receive()
+        self.calls += 1
+        if self.calls % 3 == 0:
+            self.held += messages
+            return []
+        messages, self.held = messages + self.held, []
+        return messages
+
+    def close(self)->None:
+        self.transport.close()
+        self.closed = True
+
+
+def play_over_loopback(latency:float, loss:float, reorder:bool=False):
+    '''return: (server, client) after the client played the demo inputs on a LoopbackHost,
+    then idled until the server applied them all'''
+    world = main.World(3, **main.REPRODUCIBLE_WORLD)
+    world.spawn_npcs(20)
+    host = LoopbackHost(latency, loss, lambda: world.tick / main.TICK_RATE, seed=1)
+    server = NetServer(world, host, main.TICK_RATE)
+    transport = host.connect()
+    client = NetClient(Reordering(transport) if reorder else transport,
+                       lambda seed, **kwargs: main.World(seed, **main.REPRODUCIBLE_WORLD))
+    for inputs in list(main.demo_inputs(150)) + [main.Inputs()] * 60:
+        client.step(inputs)
+        server.step()
+    return server, client
+
+
+@pytest.mark.parametrize('latency, loss, reorder', [(0, 0, False), (0.05, 0.2, False), (0.05, 0, True)])
+def test_client_reconciles_with_server(assets, latency, loss, reorder):
+    server, client = play_over_loopback(latency, loss, reorder)
+    try:
+        assert client.controls
+        assert server.clients[0].applied > 150 # all the demo inputs, then some idle ones
+        assert client.world.player_state() == server.world.player_state()
+        assert client.world.player.x > 0
+        # the client holds the NPCs of the last snapshot it decoded, as the server sent them
+        tick = client.receiver.acked
+        sent = server.clients[0].channel.snapshots[tick]
+        assert len(sent.ids) > 0
+        npcs = client.world.npcs
+        local = [npcs.index(client.remote[server_id]) for server_id in sent.ids.tolist()]
+        assert sorted(client.remote) == sent.ids.tolist()
+        assert np.array_equal(np.round(npcs.position[local] * NET_POSITION_SCALE), sent.values[:, :2])
+        if reorder:
+            assert client.stats['stale'] > 0
+    finally:
+        client.close()
+        server.close()
+        server.world.close()
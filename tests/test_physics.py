@@ -0,0 +1,57 @@
+import pygame
+
+import data.engine as e
+
+
+def test_diagonal_fast_mover_stops_at_block():
+    obj = e.Physics_obj(0,0,10,10)
+    collisions = obj.move(e.Vector(100,100), [pygame.Rect(50,50,10,10)])
+    # reaches the corner of the block: lands on it, then slides along its top
+    assert obj.rect.topleft == (100,40)
+    assert collisions['bottom']
+    assert collisions['data'] == [[pygame.Rect(50,50,10,10), e.BOTTOM_MARKERS]]
+
+
+def test_diagonal_fast_mover_hits_wall():
+    obj = e.Physics_obj(0,0,10,10)
+    collisions = obj.move(e.Vector(100,60), [pygame.Rect(50,-100,2,300)])
+    assert obj.rect.topleft == (40,60)
+    assert collisions['right'] and not collisions['bottom']
+    assert obj.x == 40
+
+
+def test_walking_over_tile_seams():
+    tiles = [pygame.Rect(x*16,160,16,16) for x in range(4)]
+    obj = e.Physics_obj(10,147,5,13)
+    for _ in range(20):
+        collisions = obj.move(e.Vector(2,1), tiles)
+        assert collisions['bottom'] and not collisions['right']
+    assert obj.rect.topleft == (50,147)
+
+
+def test_embedded_rect_pushed_out():
+    ground = [pygame.Rect(x*16,160,16,16) for x in range(4)]
+    obj = e.Physics_obj(20,150,5,13) # feet 3 pixels in the ground
+    collisions = obj.move(e.Vector(0,0), ground)
+    assert obj.rect.topleft == (20,147)
+    assert collisions['bottom']
+    assert obj.y == 147
+
+
+def test_embedded_rect_pushed_out_of_wall():
+    wall = [pygame.Rect(16,0,16,16*4)]
+    obj = e.Physics_obj(29,20,5,13) # 2 pixels past the right side of the wall
+    collisions = obj.move(e.Vector(1,0), wall)
+    assert obj.rect.topleft == (33,20)
+    assert collisions['left']
+
+
+def test_embedded_rect_pushed_out_of_spatial_hash():
+    index = e.SpatialHash(16)
+    for y in range(10, 20):
+        for x in range(-5, 5):
+            index.insert(pygame.Rect(x*16,y*16,16,16))
+    obj = e.Physics_obj(0,170,5,13) # deep in the ground: out through the top
+    collisions = obj.move(e.Vector(0,1), index)
+    assert obj.rect.topleft == (0,147)
+    assert collisions['bottom']